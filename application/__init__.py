@@ -4,10 +4,10 @@ In this file we define our app and api.
 """
 from flask import Flask
 from flask.ext.restful import Api
-from flask.ext.sqlalchemy import SQLAlchemy # Our ORM
+from .engine import ProfiledSQLAlchemy # Our ORM, tuned by DATABASE_PROFILE
 app = Flask(__name__) # Initialize flask application
 app.config.from_object('config') # Configure from a python module
-db = SQLAlchemy(app)
+db = ProfiledSQLAlchemy(app)
 
 # We are using Flask-Restful extension to provide some convenient functionality
 # For creating restful apis
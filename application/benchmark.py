@@ -0,0 +1,133 @@
+"""
+Endpoint benchmarks.
+Runs every endpoint through the test client against the current database,
+normally one filled by seed, and checks how many SQL statements and how much
+time each request takes against its budget. The response cache is turned off
+while they run so that every request does the real work.
+"""
+import base64
+import time
+from sqlalchemy import event
+from . import app, db
+from .httpcache import response_cache
+from .models import User, Subreddit, Entry, Post, Vote
+from .seed import PASSWORD, WORDS
+
+# name, method, url, how the request authenticates, SQL statement budget, latency budget in ms
+# The budgets fit the default seed. Listings are shallow unless asked to
+# expand relations, the expanded forms are not budgeted.
+BUDGETS = [
+    ('token', 'POST', '/tokens', 'password', 2, 500),
+    ('users', 'GET', '/users', None, 2, 250),
+    ('user', 'GET', '/u/{user}', 'token', 10, 1000),
+    ('user feed', 'GET', '/u/{user}/feed', None, 15, 250),
+    ('feed', 'GET', '/feed', 'token', 15, 250),
+    ('subreddits', 'GET', '/subreddits', None, 2, 250),
+    ('subreddit', 'GET', '/r/{subreddit}', None, 6, 250),
+    ('subreddit top', 'GET', '/r/{subreddit}?sort=top&t=month', 'token', 8, 250),
+    ('post', 'GET', '/r/{subreddit}/posts/{title}', 'token', 8, 150),
+    ('comment', 'GET', '/comments/{comment}', 'token', 8, 150),
+    ('search', 'GET', '/search?q={word}', 'token', 5, 100),
+    ('upvote', 'POST', '/entry/{entry}/up', 'token', 15, 150),
+    ('remove vote', 'DELETE', '/entry/{entry}/up', 'token', 10, 100),
+]
+
+
+class QueryCounter(object):
+
+    """Records the SQL statements run on the engine while in a with block."""
+
+    def __init__(self):
+        self.statements = []
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    def __len__(self):
+        return len(self.statements)
+
+
+def targets():
+    """
+    Picks what the benchmarked urls point at: the busiest user, subreddit,
+    thread and comment, and a post the user has not voted on.
+    """
+    user_id, user = db.session.query(User.id, User.username).join(
+        Entry, Entry.user_id == User.id).group_by(User.id).order_by(db.func.count().desc()).first()
+    subreddit_id, subreddit = db.session.query(Subreddit.id, Subreddit.name).join(
+        Post, Post.subreddit_id == Subreddit.id).group_by(Subreddit.id).order_by(
+        db.func.count().desc()).first()
+    busiest = db.session.query(Entry.parent_id).filter(Entry.parent_id != None).group_by(
+        Entry.parent_id).order_by(db.func.count().desc())
+    post = Post.query.filter_by(subreddit_id=subreddit_id).filter(
+        Post.id.in_(busiest.subquery())).order_by(Post.top_rank.desc()).first()
+    comment = busiest.filter(~Entry.parent_id.in_(db.session.query(Post.id))).first()
+    voted = db.session.query(Vote.entry_id).filter(Vote.voter_id == user_id)
+    entry = Post.query.filter(~Post.id.in_(voted)).first()
+    return {
+        'user': user,
+        'subreddit': subreddit,
+        'title': post.title if post else '',
+        'comment': comment[0] if comment else 0,
+        'entry': entry.id if entry else 0,
+        'word': WORDS[0]
+    }
+
+
+def run(budgets=BUDGETS, repeat=5):
+    """
+    Requests every endpoint repeat times after a warm up round.
+    Returns a result dict per endpoint with its status, statement count,
+    median latency and budgets.
+    """
+    values = targets()
+    client = app.test_client()
+    user = User.query.filter_by(username=values['user']).first()
+    token = user.generate_auth_token(3600)
+    cost = int(user.password_hash.split('$')[2])
+    db.session.remove()
+    headers = {
+        None: {},
+        'token': {'X-Auth-Token': token},
+        'password': {'X-Auth': base64.b64encode("{0}:{1}".format(values['user'], PASSWORD))}
+    }
+    results = [{'name': name, 'url': url.format(**values), 'queries': None, 'times': [],
+                'query_budget': queries, 'ms_budget': ms}
+               for name, _, url, _, queries, ms in budgets]
+    cache_size, response_cache.maxsize = response_cache.maxsize, 0
+    rounds = app.config['BCRYPT_LOG_ROUNDS']
+    # Logging in must not upgrade the seeded low cost hashes
+    app.config['BCRYPT_LOG_ROUNDS'] = cost
+    try:
+        for round in range(repeat + 1):
+            for result, (_, method, _, auth, _, _) in zip(results, budgets):
+                # A fresh app context, so that g and the session do not carry
+                # over between requests even when run from within a request
+                with app.app_context(), QueryCounter() as counter:
+                    start = time.time()
+                    response = client.open(result['url'], method=method, headers=headers[auth])
+                    elapsed = (time.time() - start) * 1000
+                result['status'] = response.status_code
+                if round:
+                    result['times'].append(elapsed)
+                    result['queries'] = max(result['queries'], len(counter))
+    finally:
+        response_cache.maxsize = cache_size
+        app.config['BCRYPT_LOG_ROUNDS'] = rounds
+    for result in results:
+        times = sorted(result.pop('times'))
+        result['ms'] = times[len(times) // 2] if times else None
+    return results
+
+
+def failures(results, latency=True):
+    """Returns the results that failed, were over their statement budget or, if latency, too slow."""
+    return [r for r in results if r['status'] >= 400 or r['queries'] > r['query_budget'] or
+            latency and r['ms'] > r['ms_budget']]
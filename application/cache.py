@@ -0,0 +1,96 @@
+"""
+In-memory caches.
+LRUCache is a size bounded, thread safe mapping whose entries also expire
+after a time to live. Entries can carry tags, invalidating a tag drops
+every entry carrying it.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+
+    def __init__(self, maxsize, ttl=None):
+        """
+        :maxsize number of entries kept before the least recently used are evicted.
+        :ttl default time to live of an entry in seconds, None for no expiry.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, expires at, tags)
+        self._tags = {}  # tag -> set of keys
+        self._lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        """Returns the cached value of key, default if missing or expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] is not None and entry[1] <= time.time():
+                if entry is not None:
+                    self._untag(key, entry[2])
+                self.misses += 1
+                return default
+            self._entries[key] = entry  # Most recently used goes last
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None, tags=()):
+        """
+        Caches value under key for ttl seconds, at most the cache's own ttl.
+        tags are names under which the entry can be invalidated later.
+        """
+        ttls = [t for t in (ttl, self.ttl) if t is not None]
+        expires = time.time() + min(ttls) if ttls else None
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, expires, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                old_key, (_, _, old_tags) = self._entries.popitem(last=False)
+                self._untag(old_key, old_tags)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def invalidate(self, *tags):
+        """Drops every entry carrying any of tags."""
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        """Counters for sizing the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._untag(key, entry[2])
+
+    def _untag(self, key, tags):
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
@@ -0,0 +1,158 @@
+"""
+Opaque continuation cursors.
+Clients only ever receive them inside links and send them back untouched,
+which leaves us free to change what goes into them.
+"""
+import base64
+import heapq
+import json
+from flask.ext.restful import abort
+from sqlalchemy import and_, or_, literal, select, union_all
+
+
+def encode(*values):
+    """Packs key values into a url safe cursor."""
+    data = json.dumps(values, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def _coerce(value, kind):
+    """value as a kind, the python type of a key column, None if it is not one."""
+    if isinstance(value, bool):
+        return None
+    if issubclass(kind, basestring):
+        return value if isinstance(value, basestring) else None
+    if issubclass(kind, (int, long)):
+        return value if isinstance(value, (int, long)) else None
+    if issubclass(kind, float) and isinstance(value, (int, long, float)) and value == value:
+        return float(value)
+    return None
+
+
+def decode(cursor, kinds):
+    """
+    Unpacks a cursor made by encode into a list of values of kinds,
+    the python types of the key columns.
+    Calls abort if the cursor was tampered with.
+    """
+    try:
+        cursor = str(cursor)
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        abort(400, message="Invalid cursor.")
+    if not isinstance(values, list) or len(values) != len(kinds):
+        abort(400, message="Invalid cursor.")
+    values = [_coerce(value, kind) for value, kind in zip(values, kinds)]
+    if None in values:
+        abort(400, message="Invalid cursor.")
+    return values
+
+
+def _kinds(keys):
+    return [column.type.python_type for column, _ in keys]
+
+
+def _after(keys, values):
+    """Criterion selecting the rows that sort after values in keys order."""
+    clauses = []
+    for i, (column, descending) in enumerate(keys):
+        same = [c == v for (c, _), v in zip(keys[:i], values[:i])]
+        clauses.append(and_(*(same + [column < values[i] if descending else column > values[i]])))
+    return or_(*clauses)
+
+
+def _order(keys):
+    return [column.desc() if descending else column for column, descending in keys]
+
+
+def _values(row, keys):
+    return [getattr(row, column.key) for column, _ in keys]
+
+
+def ordered(query, keys, after=None):
+    """Orders query by keys and skips the rows up to and including cursor after."""
+    if after:
+        query = query.filter(_after(keys, decode(after, _kinds(keys))))
+    return query.order_by(*_order(keys))
+
+
+def page(query, keys, limit, after=None):
+    """
+    Fetches one page of query in keyset order.
+    keys is a list of (column, descending) pairs which together identify a row,
+    after a cursor returned for the previous page.
+    Returns the rows and the cursor of the next page, None on the last page.
+    Pages are found with an indexed range scan, so deep pages cost the same as the first.
+    """
+    rows = ordered(query, keys, after).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode(*_values(rows[-1], keys))
+
+
+def _fetch(query, heads, keys, wanted):
+    """
+    Reads the next rows of several heads in one statement, wanted maps the
+    index of a head to the values to read after and the number of rows.
+    Returns head index -> rows of query, in no particular order.
+    """
+    selects = []
+    for i, (values, count) in sorted(wanted.items()):
+        head = heads[i]
+        if values is not None:
+            head = head.filter(_after(keys, values))
+        # Wrapped, a compound select may not order or limit its members
+        head = head.order_by(*_order(keys)).limit(count).subquery()
+        selects.append(select([list(head.c)[0].label('id'), literal(i).label('head')]))
+    ids = (selects[0] if len(selects) == 1 else union_all(*selects)).alias()
+    fetched = dict((i, []) for i in wanted)
+    for row, i in query.add_columns(ids.c.head).join(ids, keys[-1][0] == ids.c.id):
+        fetched[i].append(row)
+    return fetched
+
+
+def merge_page(query, heads, keys, limit, after=None):
+    """
+    Like page, but for the rows of query among those of several heads
+    ordered together. heads are queries of just the ids, the last of keys.
+    Every head is read in keys order a few rows at a time, off its own
+    index, and the heads are merged with a heap. The first rows of all of
+    them come in one statement and only the heads that run dry are read
+    again, so the rows read grow with limit rather than with the size or,
+    beyond a couple of rows each, the number of heads.
+    """
+    if not heads:
+        return [], None
+    values = decode(after, _kinds(keys)) if after else None
+    sizes = dict((i, limit // len(heads) + 2) for i in range(len(heads)))
+    buffered = {}  # head -> (its rows not merged yet, whether more may follow)
+    heap = []
+
+    def sort_key(row):
+        return tuple(-v if descending else v for v, (_, descending) in zip(_values(row, keys), keys))
+
+    def read(starts):
+        wanted = dict((i, (start, sizes[i])) for i, start in starts.items())
+        for i, rows in _fetch(query, heads, keys, wanted).items():
+            rows.sort(key=sort_key)
+            buffered[i] = (rows, len(rows) == sizes[i])
+            if rows:
+                heapq.heappush(heap, (sort_key(rows[0]), i))
+
+    read(dict((i, values) for i in range(len(heads))))
+    rows = []
+    while heap and len(rows) <= limit:
+        _, i = heapq.heappop(heap)
+        pending, more = buffered[i]
+        row = pending.pop(0)
+        rows.append(row)
+        if pending:
+            heapq.heappush(heap, (sort_key(pending[0]), i))
+        elif more:
+            sizes[i] *= 2
+            read({i: _values(row, keys)})
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode(*_values(rows[-1], keys))
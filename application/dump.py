@@ -0,0 +1,183 @@
+"""
+Bulk import and export of JSONL dumps.
+A dump has one JSON object per line, each with a "kind" of user, subreddit,
+subscription, post, comment or vote, written so that everything a row refers
+to comes before it:
+
+    {"kind": "user", "username": "ann", "password_hash": "$2a$12$..."}
+    {"kind": "subreddit", "name": "funny"}
+    {"kind": "subscription", "username": "ann", "subreddit": "funny"}
+    {"kind": "post", "id": 1, "author": "ann", "subreddit": "funny", "title": "...", "body": "...", "created": "..."}
+    {"kind": "comment", "id": 2, "author": "ann", "parent": 1, "body": "...", "created": "..."}
+    {"kind": "vote", "voter": "ann", "entry": 1, "weight": 1}
+
+Users may come with a plain "password" instead, which is then hashed, slowly.
+Users and subreddits are referred to by name and get new ids on import, the
+inserts look the ids up by name in SQL. Entries keep their ids. A vote's
+weight is 1 or -1. Vote counters, karma, subscriber counts, ranks and the
+search index are not part of a dump, they are rebuilt once the rows are in.
+Both directions stream, memory stays bounded by the batch size however big
+the dump is.
+"""
+import json
+from datetime import datetime
+from . import app, db, hashing, migrations, search
+from .models import User, Subreddit, Entry, Post, Vote, subscriptions
+
+KINDS = ('user', 'subreddit', 'subscription', 'post', 'comment', 'vote')
+
+
+def _datetime(value):
+    if value is None:
+        return datetime.utcnow()
+    return datetime.strptime(value.split('.')[0], '%Y-%m-%dT%H:%M:%S')
+
+
+def _user(record):
+    password_hash = record.get('password_hash') or hashing.hash_password(record['password'])
+    return [(User.__table__, {'username': record['username'], 'password_hash': password_hash})]
+
+
+def _subreddit(record):
+    return [(Subreddit.__table__, {'name': record['name']})]
+
+
+def _subscription(record):
+    return [(subscriptions, {'_user': record['username'], '_subreddit': record['subreddit']})]
+
+
+def _post(record):
+    return [(Entry.__table__, {'id': record['id'], 'type': 'post', '_user': record['author'],
+                               'body': record['body'], 'parent_id': None,
+                               'created': _datetime(record.get('created'))}),
+            (Post.__table__, {'id': record['id'], 'title': record['title'],
+                              '_subreddit': record['subreddit']})]
+
+
+def _comment(record):
+    return [(Entry.__table__, {'id': record['id'], 'type': 'entry', '_user': record['author'],
+                               'body': record['body'], 'parent_id': record['parent'],
+                               'created': _datetime(record.get('created'))})]
+
+
+def _vote(record):
+    if record['weight'] not in (1, -1):
+        raise ValueError("weight must be 1 or -1")
+    return [(Vote.__table__, {'_user': record['voter'], 'entry_id': record['entry'],
+                              'weight': record['weight']})]
+
+
+ROWS = {
+    'user': _user,
+    'subreddit': _subreddit,
+    'subscription': _subscription,
+    'post': _post,
+    'comment': _comment,
+    'vote': _vote
+}
+# Tables in the order their rows must go in
+TABLES = (User.__table__, Subreddit.__table__, subscriptions, Entry.__table__,
+          Post.__table__, Vote.__table__)
+_user_id = db.select([User.id]).where(User.username == db.bindparam('_user')).as_scalar()
+_subreddit_id = db.select([Subreddit.id]).where(Subreddit.name == db.bindparam('_subreddit')).as_scalar()
+# Inserts of each table, with the names rows refer to turned into ids
+INSERTS = {
+    User.__table__: User.__table__.insert(),
+    Subreddit.__table__: Subreddit.__table__.insert(),
+    subscriptions: subscriptions.insert().values(user_id=_user_id, subreddit_id=_subreddit_id),
+    Entry.__table__: Entry.__table__.insert().values(user_id=_user_id),
+    Post.__table__: Post.__table__.insert().values(subreddit_id=_subreddit_id),
+    Vote.__table__: Vote.__table__.insert().values(voter_id=_user_id)
+}
+
+
+def load(lines, batch=None):
+    """
+    Inserts the records of a dump with one executemany per batch and table,
+    then rebuilds everything derived from them. Returns counts per kind.
+    """
+    batch = batch or app.config['IMPORT_BATCH_SIZE']
+    pending = dict((table, []) for table in TABLES)
+    counts = dict((kind, 0) for kind in KINDS)
+
+    def flush():
+        for table in TABLES:
+            if pending[table]:
+                db.session.execute(INSERTS[table], pending[table])
+                pending[table] = []
+
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            rows = ROWS[record['kind']](record)
+        except (ValueError, KeyError, TypeError) as error:
+            raise ValueError("Line {0} is not a valid record: {1!r}".format(number, error))
+        counts[record['kind']] += 1
+        for table, row in rows:
+            pending[table].append(row)
+            if len(pending[table]) >= batch:
+                flush()
+    flush()
+    migrations.reset_sequences()
+    Entry.rebuild_counters()
+    User.rebuild_karma()
+    Subreddit.rebuild_subscriber_counts()
+    Post.rerank_all()
+    if search.available():
+        search.reindex()
+    db.session.commit()
+    return counts
+
+
+def _stream(query, batch):
+    """Rows of a core select, fetched a batch at a time off a server side cursor."""
+    result = db.session.connection().execution_options(stream_results=True).execute(query)
+    while True:
+        rows = result.fetchmany(batch)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def _created(value):
+    return value.replace(microsecond=0).isoformat() if value is not None else None
+
+
+def records(batch=None):
+    """Yields every record of the database in dump order."""
+    batch = batch or app.config['IMPORT_BATCH_SIZE']
+    user, sub, entry, post, vote = (User.__table__, Subreddit.__table__, Entry.__table__,
+                                    Post.__table__, Vote.__table__)
+    # Users and subreddits in id order, so that importing gives them the same ids
+    for row in _stream(db.select([user.c.username, user.c.password_hash]).order_by(user.c.id), batch):
+        yield {'kind': 'user', 'username': row.username, 'password_hash': row.password_hash}
+    for row in _stream(db.select([sub.c.name]).order_by(sub.c.id), batch):
+        yield {'kind': 'subreddit', 'name': row.name}
+    for row in _stream(db.select([user.c.username, sub.c.name]).select_from(
+            subscriptions.join(user).join(sub)).order_by(subscriptions.c.user_id, subscriptions.c.subreddit_id),
+            batch):
+        yield {'kind': 'subscription', 'username': row.username, 'subreddit': row.name}
+    for row in _stream(db.select([entry, user.c.username, post.c.title, sub.c.name]).select_from(
+            entry.join(user).join(post).join(sub)).order_by(entry.c.id), batch):
+        yield {'kind': 'post', 'id': row.id, 'author': row.username, 'subreddit': row.name,
+               'title': row.title, 'body': row.body, 'created': _created(row.created)}
+    # Replies always have larger ids than what they reply to
+    for row in _stream(db.select([entry, user.c.username]).select_from(entry.join(user)).where(
+            entry.c.parent_id != None).order_by(entry.c.id), batch):
+        yield {'kind': 'comment', 'id': row.id, 'author': row.username, 'parent': row.parent_id,
+               'body': row.body, 'created': _created(row.created)}
+    for row in _stream(db.select([vote, user.c.username]).select_from(vote.join(user)).order_by(
+            vote.c.entry_id, vote.c.voter_id), batch):
+        yield {'kind': 'vote', 'voter': row.username, 'entry': row.entry_id, 'weight': row.weight}
+
+
+def dump(out, batch=None):
+    """Writes every record to the file out, returns counts per kind."""
+    counts = dict((kind, 0) for kind in KINDS)
+    for record in records(batch):
+        out.write(json.dumps(record, sort_keys=True) + '\n')
+        counts[record['kind']] += 1
+    return counts
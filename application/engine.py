@@ -0,0 +1,61 @@
+"""
+Database engine profiles.
+DATABASE_PROFILE picks how the engine is tuned:
+"sqlite" sets the SQLITE_PRAGMAS on every new connection, most importantly
+WAL journaling so that readers no longer wait behind writers.
+"server" pools connections to a database server such as postgres and pings
+them before use so that connections dropped by the server are replaced.
+"""
+import sqlite3
+from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool, QueuePool
+
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+
+    def apply_driver_hacks(self, app, info, options):
+        super(ProfiledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if app.config['DATABASE_PROFILE'] == 'server':
+            options['poolclass'] = QueuePool
+            options['pool_size'] = app.config['SERVER_POOL_SIZE']
+            options['max_overflow'] = app.config['SERVER_MAX_OVERFLOW']
+            options['pool_recycle'] = app.config['SERVER_POOL_RECYCLE']
+            if info.drivername == 'sqlite':
+                # Pooled sqlite connections move between threads
+                options['connect_args'] = {'check_same_thread': False}
+
+
+def _profile():
+    from . import app
+    return app.config['DATABASE_PROFILE']
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    from . import app
+    if not isinstance(dbapi_connection, sqlite3.Connection) or _profile() != 'sqlite':
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS']:
+        cursor.execute('PRAGMA {0} = {1}'.format(name, value))
+    cursor.close()
+
+
+@event.listens_for(Pool, 'checkout')
+def _ping_connection(dbapi_connection, connection_record, connection_proxy):
+    """Pessimistic disconnect handling, the pool retries with a fresh connection."""
+    from . import app
+    if _profile() != 'server' or not app.config['SERVER_PRE_PING']:
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('SELECT 1')
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        try:
+            cursor.close()
+        except Exception:
+            pass
@@ -1,5 +1,7 @@
 """
 Here we define marshaling, which map python dicts to JSON
+Read endpoints take ?fields= and ?expand= to pick from these, the lists of
+nested fields are the relations that can be expanded, see serializers.Fieldset.
 """
 from flask.ext.restful import fields
 
@@ -11,8 +13,12 @@ comment_fields = {
     "myvote": fields.Integer,
     "upvote_url": fields.Url(endpoint="upvote_ep"),
     "downvote_url": fields.Url(endpoint="downvote_ep"),
+    "vote_url": fields.Url(endpoint="vote_ep"),
+    "more": fields.String,
     'url': fields.Url(endpoint='comment_ep')
 }
+# Replies are comments too
+comment_fields["comments"] = fields.List(fields.Nested(comment_fields))
 
 post_fields = {
     "id": fields.String,
@@ -23,13 +29,17 @@ post_fields = {
     "myvote": fields.Integer,
     "downvotes": fields.Integer,
     "comments": fields.List(fields.Nested(comment_fields)),
+    "comment_count": fields.Integer,  # Replies directly under the post
+    "more": fields.String,
     "upvote_url": fields.Url(endpoint="upvote_ep"),
     "downvote_url": fields.Url(endpoint="downvote_ep"),
+    "vote_url": fields.Url(endpoint="vote_ep"),
     'url': fields.Url(endpoint='post_ep')
 }
 
 subreddit_fields = {
     "name": fields.String,
+    "subscriber_count": fields.Integer,
     'url': fields.Url(endpoint='subreddit_ep'),
     "posts": fields.List(fields.Nested(post_fields)),
     'subscription_url': fields.Url(endpoint='subreddit_subscription_ep')
@@ -45,6 +55,20 @@ user_fields = {
     'url': fields.Url(endpoint='user_ep')
 }
 
+# Search hits, without replies
+search_fields = {
+    "id": fields.String,
+    "type": fields.String,
+    "title": fields.String,
+    "body": fields.String,
+    "author": fields.String,
+    "subreddit": fields.String,
+    "upvotes": fields.Integer,
+    "downvotes": fields.Integer,
+    "myvote": fields.Integer,
+    "url": fields.String
+}
+
 token_fields = {
     "token": fields.String,
     "expires_in": fields.Integer
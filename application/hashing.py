@@ -0,0 +1,72 @@
+"""
+Password hashing.
+bcrypt is slow on purpose, so instead of tying up the request thread it runs
+in a pool of HASH_POOL_SIZE worker processes. At most HASH_QUEUE_DEPTH jobs
+may wait for a free worker, requests beyond that get a 503 right away so a
+burst of logins cannot starve every other endpoint.
+"""
+import os
+from multiprocessing import Pool
+from threading import BoundedSemaphore, Lock
+from werkzeug.exceptions import ServiceUnavailable
+from flask.ext.bcrypt import generate_password_hash, check_password_hash
+from . import app
+from .instrumentation import timed
+
+
+class HashingBusy(ServiceUnavailable):
+    description = "Too many password checks in progress, please retry shortly."
+
+
+_lock = Lock()
+_state = {}  # pool and free slots, along with the pid and config they were made for
+
+
+def _pool():
+    """
+    Returns the worker pool and its semaphore of free slots.
+    A new pool is made after a fork or when the config changed.
+    """
+    key = (os.getpid(), app.config['HASH_POOL_SIZE'], app.config['HASH_QUEUE_DEPTH'])
+    with _lock:
+        if _state.get('key') != key:
+            if _state.get('pool') is not None and _state['key'][0] == key[0]:
+                _state['pool'].terminate()
+            _, size, depth = key
+            _state['pool'] = Pool(size) if size else None
+            _state['slots'] = BoundedSemaphore(size + depth)
+            _state['key'] = key
+        return _state['pool'], _state['slots']
+
+
+def _run(func, *args):
+    """Runs func in the pool, raises HashingBusy if the queue is full."""
+    pool, slots = _pool()
+    with timed('bcrypt'):
+        if pool is None:
+            return func(*args)
+        if not slots.acquire(False):
+            raise HashingBusy()
+        try:
+            return pool.apply_async(func, args).get()
+        finally:
+            slots.release()
+
+
+def hash_password(password, rounds=None):
+    """Hashes password with BCRYPT_LOG_ROUNDS unless told otherwise."""
+    return _run(generate_password_hash, password, rounds or app.config['BCRYPT_LOG_ROUNDS'])
+
+
+def check_password(pw_hash, password):
+    """Checks password against pw_hash in constant time."""
+    return _run(check_password_hash, pw_hash, password)
+
+
+def needs_rehash(pw_hash):
+    """Tells if pw_hash was made with a different work factor than configured."""
+    try:
+        rounds = int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return rounds != app.config['BCRYPT_LOG_ROUNDS']
@@ -0,0 +1,77 @@
+"""
+Response cache for the read endpoints.
+Responses are cached per url and viewer. While a response is built, every
+model it serializes records a tag through depends_on, write handlers then
+call invalidate with the tags of what they changed, which drops exactly the
+responses that showed it. All responses carry an ETag and Last-Modified so
+clients can revalidate and get a 304.
+"""
+from datetime import datetime
+from functools import wraps
+from flask import g, request, has_request_context
+from flask.ext.restful.utils import unpack
+from sqlalchemy import event
+from werkzeug.wrappers import BaseResponse
+from . import app, api, db
+from .cache import LRUCache
+
+response_cache = LRUCache(app.config['RESPONSE_CACHE_SIZE'], app.config['RESPONSE_CACHE_TTL'])
+
+
+def depends_on(*tags):
+    """Records that the response being built shows the objects behind tags."""
+    if has_request_context() and getattr(g, 'cache_tags', None) is not None:
+        g.cache_tags.update(tags)
+
+
+def invalidate(*tags):
+    """Drops every cached response that depends on any of tags."""
+    response_cache.invalidate(*tags)
+
+
+@event.listens_for(db.metadata, 'after_create')
+@event.listens_for(db.metadata, 'after_drop')
+def _schema_changed(*args, **kwargs):
+    """Nothing cached survives a new schema."""
+    response_cache.clear()
+
+
+def _viewer():
+    """
+    Who the response is built for. Authenticated responses carry the
+    viewer's own votes, so they are cached per user.
+    """
+    user = getattr(g, 'user', None)
+    return 'anonymous' if user is None else 'user:' + user.username
+
+
+def cached(func):
+    """
+    Serves a GET method from response_cache, place it below token_optional.
+    Only 200 responses are stored.
+    """
+    @wraps(func)
+    def decorator(*args, **kwargs):
+        key = (request.full_path, _viewer())
+        entry = response_cache.get(key) if response_cache.maxsize else None
+        if entry is None:
+            g.cache_tags = set()
+            resp = func(*args, **kwargs)
+            if isinstance(resp, BaseResponse):
+                # Streamed, there is no body to keep
+                g.cache_tags = None
+                return resp
+            data, code, headers = unpack(resp)
+            response = api.make_response(data, code, headers=headers)
+            response.add_etag()
+            response.last_modified = datetime.utcnow().replace(microsecond=0)
+            if code == 200 and response_cache.maxsize:
+                entry = (response.get_data(), response.headers.items())
+                response_cache.set(key, entry, tags=g.cache_tags)
+            g.cache_tags = None
+        else:
+            body, headers = entry
+            response = app.response_class(body, 200, headers)
+        response.vary.add('X-Auth-Token')
+        return response.make_conditional(request)
+    return decorator
@@ -0,0 +1,152 @@
+"""
+Per request instrumentation, off unless INSTRUMENTATION is set.
+Engine events count and time every SQL statement of a request and timed
+blocks measure password hashing and serialization. Responses then carry
+X-Query-Count and a Server-Timing header, requests slower than
+SLOW_REQUEST_MS are logged along with their slowest SQL, and the timings of
+every endpoint are aggregated into histograms served by /stats.
+Streamed responses are measured up to their first byte only.
+"""
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from . import app
+
+MS_BOUNDS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+QUERY_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram(object):
+
+    """Counts values into buckets with the given upper bounds."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        labels = ["<={0}".format(bound) for bound in self.bounds] + [">{0}".format(self.bounds[-1])]
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": OrderedDict(zip(labels, self.buckets))
+        }
+
+
+class RequestTimings(object):
+
+    """Time spent per phase of one request, and the SQL it ran."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = OrderedDict([('db', 0.0)])
+        self.statements = []  # (seconds, sql)
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+_lock = Lock()
+_endpoints = {}  # "METHOD endpoint" -> histograms by metric
+
+
+def current():
+    """The timings of the request being served, None when not instrumented."""
+    if not has_request_context():
+        return None
+    return getattr(g, 'timings', None)
+
+
+@contextmanager
+def timed(phase):
+    """Adds the time spent in the with block to phase of the current request."""
+    timings = current()
+    if timings is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.add(phase, time.time() - start)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _statement_started(conn, cursor, statement, parameters, context, executemany):
+    if current() is not None:
+        conn.info['statement_start'] = time.time()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _statement_done(conn, cursor, statement, parameters, context, executemany):
+    timings = current()
+    start = conn.info.pop('statement_start', None)
+    if timings is None or start is None:
+        return
+    elapsed = time.time() - start
+    timings.add('db', elapsed)
+    timings.statements.append((elapsed, statement))
+
+
+@app.before_request
+def _start_request():
+    if app.config['INSTRUMENTATION']:
+        g.timings = RequestTimings()
+
+
+@app.after_request
+def _finish_request(response):
+    timings = current()
+    if timings is None:
+        return response
+    g.timings = None
+    total = time.time() - timings.start
+    response.headers['X-Query-Count'] = str(len(timings.statements))
+    response.headers['Server-Timing'] = ", ".join(
+        "{0};dur={1:.1f}".format(phase, seconds * 1000)
+        for phase, seconds in timings.phases.items() + [('total', total)])
+    _record("{0} {1}".format(request.method, request.endpoint), timings, total)
+    if total * 1000 >= app.config['SLOW_REQUEST_MS']:
+        slowest = sorted(timings.statements, reverse=True)[:app.config['SLOW_REQUEST_STATEMENTS']]
+        app.logger.warning(
+            "Slow request %s %s: %.1f ms, %d statements, %.1f ms in the database%s",
+            request.method, request.full_path, total * 1000, len(timings.statements),
+            timings.phases['db'] * 1000,
+            "".join("\n  {0:.1f} ms: {1}".format(seconds * 1000, " ".join(sql.split()))
+                    for seconds, sql in slowest))
+    return response
+
+
+def _record(endpoint, timings, total):
+    with _lock:
+        metrics = _endpoints.setdefault(endpoint, {'queries': Histogram(QUERY_BOUNDS)})
+        metrics['queries'].add(len(timings.statements))
+        for phase, seconds in timings.phases.items() + [('total', total)]:
+            metrics.setdefault(phase + '_ms', Histogram(MS_BOUNDS)).add(seconds * 1000)
+
+
+def stats():
+    """Histograms of every endpoint served since the process started."""
+    with _lock:
+        return dict((endpoint, dict((name, histogram.to_dict()) for name, histogram in metrics.items()))
+                    for endpoint, metrics in _endpoints.items())
+
+
+def reset():
+    with _lock:
+        _endpoints.clear()
@@ -0,0 +1,145 @@
+"""
+Request scoped loaders.
+Serializing a response touches the same kind of data for many rows,
+these loaders fetch it for a whole batch of rows in one query and keep
+it until the request ends.
+"""
+from flask import g, has_request_context, _request_ctx_stack
+from sqlalchemy.orm.util import identity_key
+from . import db
+from .models import Vote
+from .votequeue import queue
+
+
+class Loader(object):
+
+    """
+    Rows of one model by id, or by a unique column, for one request.
+    Ids primed are fetched together with a single IN query the first time
+    any row is asked for, rows the session holds already cost no query and
+    every row is only looked up once.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.rows = {}  # id -> row, None if there is none
+        self.ids = {}  # (column, value) -> id, None if there is none
+        self.pending = set()
+
+    def prime(self, ids):
+        """Queues ids to be fetched with the next batch."""
+        self.pending.update(id for id in ids if id is not None and id not in self.rows)
+
+    def add(self, row, *columns):
+        """Keeps a row loaded elsewhere, also by the values of columns."""
+        self.rows[row.id] = row
+        for column in columns:
+            self.ids[(column, getattr(row, column))] = row.id
+
+    def get(self, id):
+        """Returns the row with this id or None, fetching it along with the pending ones."""
+        if id is None:
+            return None
+        if id not in self.rows:
+            self.pending.add(id)
+            self._fetch()
+        return self.rows[id]
+
+    def get_by(self, column, value):
+        """Returns the row whose unique column is value or None."""
+        key = (column, value)
+        if key not in self.ids:
+            row = self.model.query.filter_by(**{column: value}).first()
+            self.ids[key] = None if row is None else row.id
+            if row is not None:
+                self.rows[row.id] = row
+        id = self.ids[key]
+        return None if id is None else self.rows[id]
+
+    def _fetch(self):
+        ids, self.pending = self.pending, set()
+        missing = []
+        for id in ids:
+            row = db.session.identity_map.get(identity_key(self.model, id))
+            self.rows[id] = row
+            if row is None:
+                missing.append(id)
+        if missing:
+            self.rows.update((row.id, row) for row in self.model.query.filter(self.model.id.in_(missing)))
+
+
+def loader(model):
+    """Returns the current request's loader of model, None outside of requests."""
+    # Not on g: g lives on the app context, which a test or script may push
+    # once around several requests. Loaders kept there would hand the next
+    # request rows of a session removed at the end of the previous one.
+    context = _request_ctx_stack.top
+    if context is None:
+        return None
+    loaders = context.__dict__.setdefault('loaders', {})
+    if model not in loaders:
+        loaders[model] = Loader(model)
+    return loaders[model]
+
+
+def load(model, id):
+    """The row of model with this id, through the request's loader when there is one."""
+    rows = loader(model)
+    return model.query.get(id) if rows is None else rows.get(id)
+
+
+def load_by(model, column, value):
+    """The row of model whose unique column is value, through the request's loader if any."""
+    rows = loader(model)
+    if rows is None:
+        return model.query.filter_by(**{column: value}).first()
+    return rows.get_by(column, value)
+
+
+def prime(model, ids):
+    """Queues ids for the request's loader of model, so they are fetched in one batch."""
+    rows = loader(model)
+    if rows is not None:
+        rows.prime(ids)
+
+
+class VoteMap(object):
+
+    """
+    Maps entry ids to the weight of one user's vote on them, 0 if none.
+    Votes still waiting in the write-behind queue win over stored ones.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.weights = {}
+
+    def prime(self, entries):
+        """Loads the user's votes on all entries not seen yet with a single IN query."""
+        ids = set(e.id for e in entries if e.id not in self.weights)
+        if not ids:
+            return
+        self.weights.update((id, 0) for id in ids)
+        self.weights.update(db.session.query(Vote.entry_id, Vote.weight).filter(
+            Vote.voter_id == self.user.id, Vote.entry_id.in_(ids)))
+        self.weights.update((id, weight) for id, weight in
+                            queue.overlay(self.user.id).items() if id in ids)
+
+    def weight(self, entry):
+        """Returns the user's vote on entry, loading it alone if it was not primed."""
+        if entry.id not in self.weights:
+            self.prime([entry])
+        return self.weights[entry.id]
+
+
+def vote_map():
+    """
+    Returns the vote map of the user making the current request,
+    or None if the request is anonymous.
+    """
+    if not has_request_context() or getattr(g, 'user', None) is None:
+        return None
+    votes = getattr(g, 'vote_map', None)
+    if votes is None or votes.user is not g.user:
+        votes = g.vote_map = VoteMap(g.user)
+    return votes
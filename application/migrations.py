@@ -0,0 +1,340 @@
+"""
+Versioned schema migrations.
+Every migration brings the schema from the previous version to its own and the
+applied version is kept in the schema_version table. Migrations use their own
+DDL and SQL rather than the models, so they keep working as the models change,
+and they check what already exists so a half applied one can simply be rerun.
+"""
+from datetime import datetime
+from sqlalchemy import inspect
+from . import db, search
+from .models import hot, controversy
+
+schema_version = db.Table('schema_version', db.MetaData(),
+                          db.Column('version', db.Integer, nullable=False))
+
+MIGRATIONS = []
+
+
+def migration(func):
+    """Registers func as the next migration."""
+    MIGRATIONS.append(func)
+    return func
+
+
+def head():
+    return len(MIGRATIONS)
+
+
+def _quote(name):
+    return db.engine.dialect.identifier_preparer.quote(name)
+
+
+def _inspector():
+    return inspect(db.session.connection())
+
+
+def _columns(table):
+    return [c['name'] for c in _inspector().get_columns(table)]
+
+
+def _execute(sql, params=None):
+    return db.session.execute(db.text(sql), params)
+
+
+def add_column(table, column):
+    """Adds column to table unless it is already there."""
+    if column.name in _columns(table):
+        return
+    ddl = "ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+        _quote(table), _quote(column.name), column.type.compile(dialect=db.engine.dialect))
+    if column.server_default is not None:
+        ddl += " DEFAULT {0}".format(column.server_default.arg)
+    if not column.nullable:
+        ddl += " NOT NULL"
+    _execute(ddl)
+
+
+def create_index(name, table, columns, unique=False):
+    """Creates the index unless an index of that name exists on table."""
+    if name in [i['name'] for i in _inspector().get_indexes(table)]:
+        return
+    _execute("CREATE {0}INDEX {1} ON {2} ({3})".format(
+        "UNIQUE " if unique else "", _quote(name), _quote(table),
+        ", ".join(_quote(column) for column in columns)))
+
+
+# Tables whose ids come from a sequence on postgres
+SEQUENCED = ('user', 'subreddit', 'entry')
+
+
+def reset_sequences(tables=SEQUENCED):
+    """
+    Moves the id sequences of tables past their largest id, which rows
+    inserted with their ids leave behind. Only postgres has them.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        _execute("SELECT setval(pg_get_serial_sequence(:name, 'id'), coalesce(max(id), 0) + 1, false) "
+                 "FROM {0}".format(_quote(table)), {'name': _quote(table)})
+
+
+def current():
+    """Returns the schema version of the database, None when it has no schema yet."""
+    tables = _inspector().get_table_names()
+    if 'entry' not in tables:
+        return None
+    if 'schema_version' not in tables:
+        return 0
+    return db.session.execute(db.select([schema_version.c.version])).scalar() or 0
+
+
+def stamp(version):
+    """Records version as applied without running any migration."""
+    schema_version.create(db.session.connection(), checkfirst=True)
+    db.session.execute(schema_version.delete())
+    db.session.execute(schema_version.insert().values(version=version))
+    db.session.commit()
+
+
+def upgrade(target=None):
+    """
+    Migrates the database up to target, the latest version by default.
+    A database without tables is created from the models and stamped instead.
+    Returns the list of migrations that ran.
+    """
+    target = head() if target is None else target
+    version = current()
+    if version is None:
+        db.session.commit()
+        db.create_all()
+        stamp(head())
+        return []
+    applied = []
+    for number in range(version + 1, target + 1):
+        func = MIGRATIONS[number - 1]
+        func()
+        db.session.commit()
+        stamp(number)
+        applied.append(func.__name__)
+    return applied
+
+
+@migration
+def vote_counters():
+    """Denormalized vote counters on entries and karma on users."""
+    for name in ('upvotes', 'downvotes', 'score'):
+        add_column('entry', db.Column(name, db.Integer, nullable=False, server_default='0'))
+    add_column('user', db.Column('karma', db.Integer, nullable=False, server_default='0'))
+    _execute("""
+        UPDATE entry SET
+            upvotes = (SELECT count(*) FROM vote WHERE vote.entry_id = entry.id AND vote.weight = 1),
+            downvotes = (SELECT count(*) FROM vote WHERE vote.entry_id = entry.id AND vote.weight = -1)
+    """)
+    _execute("UPDATE entry SET score = upvotes - downvotes")
+    _execute("""
+        UPDATE {0} SET karma = (
+            SELECT coalesce(sum(vote.weight), 0) FROM vote JOIN entry ON vote.entry_id = entry.id
+            WHERE entry.user_username = {0}.username)
+    """.format(_quote('user')))
+
+
+@migration
+def feed_ranks():
+    """Creation times and stored feed ranks of posts."""
+    add_column('entry', db.Column('created', db.DateTime))
+    _execute("UPDATE entry SET created = :now WHERE created IS NULL", {'now': datetime.utcnow()})
+    add_column('post', db.Column('hot_rank', db.Float, nullable=False, server_default='0'))
+    add_column('post', db.Column('top_rank', db.Integer, nullable=False, server_default='0'))
+    add_column('post', db.Column('controversy_rank', db.Float, nullable=False, server_default='0'))
+    rows = _execute("""
+        SELECT post.id, entry.upvotes, entry.downvotes, entry.created
+        FROM post JOIN entry ON post.id = entry.id
+    """).fetchall()
+    ranks = []
+    for id, ups, downs, created in rows:
+        if not isinstance(created, datetime):
+            # sqlite hands back the raw string for a plain text query
+            created = datetime.strptime(created.split('.')[0], '%Y-%m-%d %H:%M:%S')
+        ranks.append({'id': id, 'hot': hot(ups, downs, created), 'top': ups - downs,
+                      'controversy': controversy(ups, downs)})
+    if ranks:
+        _execute("UPDATE post SET hot_rank = :hot, top_rank = :top, "
+                 "controversy_rank = :controversy WHERE id = :id", ranks)
+    for sort, column in (('hot', 'hot_rank'), ('top', 'top_rank'),
+                         ('controversy', 'controversy_rank')):
+        create_index('ix_post_subreddit_' + sort, 'post', ['subreddit_name', column, 'id'])
+    create_index('ix_post_subreddit_new', 'post', ['subreddit_name', 'id'])
+
+
+@migration
+def hot_path_indexes():
+    """Indexes behind the post, comment, vote and subscription lookups."""
+    create_index('ix_post_subreddit_title', 'post', ['subreddit_name', 'title'])
+    create_index('ix_entry_parent', 'entry', ['parent_id', 'id'])
+    create_index('ix_entry_author', 'entry', ['user_username'])
+    create_index('ix_vote_entry_weight', 'vote', ['entry_id', 'weight'])
+    # Subscribing twice used to add a second row, which the unique index rejects
+    _execute("CREATE TABLE subscriptions_dedupe AS "
+             "SELECT DISTINCT user_username, subreddit_name FROM subscriptions")
+    _execute("DELETE FROM subscriptions")
+    _execute("INSERT INTO subscriptions (user_username, subreddit_name) "
+             "SELECT user_username, subreddit_name FROM subscriptions_dedupe")
+    _execute("DROP TABLE subscriptions_dedupe")
+    create_index('ux_subscriptions_user_subreddit', 'subscriptions',
+                 ['user_username', 'subreddit_name'], unique=True)
+    create_index('ix_subscriptions_subreddit', 'subscriptions', ['subreddit_name'])
+
+
+@migration
+def entry_search():
+    """Full text index of posts and comments, where sqlite has FTS5."""
+    if not search.available():
+        return
+    _execute("DROP TABLE IF EXISTS entry_search")
+    _execute("CREATE VIRTUAL TABLE entry_search USING fts5(title, body, subreddit UNINDEXED)")
+    _execute("""
+        INSERT INTO entry_search (rowid, title, body, subreddit)
+        WITH RECURSIVE thread(id, subreddit) AS (
+            SELECT id, subreddit_name FROM post
+            UNION ALL
+            SELECT entry.id, thread.subreddit FROM entry JOIN thread ON entry.parent_id = thread.id
+        )
+        SELECT entry.id, post.title, entry.body, thread.subreddit
+        FROM thread JOIN entry ON entry.id = thread.id LEFT JOIN post ON post.id = entry.id
+    """)
+
+
+@migration
+def subscriber_counts():
+    """Stored subscriber counts of subreddits."""
+    add_column('subreddit', db.Column('subscriber_count', db.Integer, nullable=False, server_default='0'))
+    _execute("""
+        UPDATE subreddit SET subscriber_count = (
+            SELECT count(*) FROM subscriptions WHERE subscriptions.subreddit_name = subreddit.name)
+    """)
+
+
+def _keyed_tables():
+    """
+    The tables as surrogate_keys leaves them, under temporary names,
+    parents first. Their foreign keys follow the tables when renamed.
+    """
+    metadata = db.MetaData()
+    db.Table('user_keyed', metadata,
+             db.Column('id', db.Integer, primary_key=True),
+             db.Column('username', db.String(256), nullable=False),
+             db.Column('password_hash', db.String(60), unique=True, nullable=False),
+             db.Column('karma', db.Integer, nullable=False),
+             db.Index('ux_user_username', 'username', unique=True))
+    db.Table('subreddit_keyed', metadata,
+             db.Column('id', db.Integer, primary_key=True),
+             db.Column('name', db.String(256), nullable=False),
+             db.Column('subscriber_count', db.Integer, nullable=False),
+             db.Index('ux_subreddit_name', 'name', unique=True))
+    db.Table('subscriptions_keyed', metadata,
+             db.Column('user_id', db.Integer, db.ForeignKey('user_keyed.id')),
+             db.Column('subreddit_id', db.Integer, db.ForeignKey('subreddit_keyed.id')),
+             db.Index('ux_subscriptions_user_subreddit', 'user_id', 'subreddit_id', unique=True),
+             db.Index('ix_subscriptions_subreddit', 'subreddit_id'))
+    db.Table('entry_keyed', metadata,
+             db.Column('id', db.Integer, primary_key=True),
+             db.Column('user_id', db.Integer, db.ForeignKey('user_keyed.id')),
+             db.Column('body', db.Text),
+             db.Column('parent_id', db.Integer, db.ForeignKey('entry_keyed.id')),
+             db.Column('type', db.String(128)),
+             db.Column('upvotes', db.Integer, nullable=False),
+             db.Column('downvotes', db.Integer, nullable=False),
+             db.Column('score', db.Integer, nullable=False),
+             db.Column('created', db.DateTime, nullable=False),
+             db.Index('ix_entry_parent', 'parent_id', 'id'),
+             db.Index('ix_entry_author', 'user_id'))
+    db.Table('post_keyed', metadata,
+             db.Column('id', db.Integer, db.ForeignKey('entry_keyed.id'), primary_key=True),
+             db.Column('title', db.String(512), nullable=False),
+             db.Column('subreddit_id', db.Integer, db.ForeignKey('subreddit_keyed.id')),
+             db.Column('hot_rank', db.Float, nullable=False),
+             db.Column('top_rank', db.Integer, nullable=False),
+             db.Column('controversy_rank', db.Float, nullable=False),
+             db.Index('ix_post_title', 'title'),
+             db.Index('ix_post_subreddit_title', 'subreddit_id', 'title'),
+             db.Index('ix_post_subreddit_hot', 'subreddit_id', 'hot_rank', 'id'),
+             db.Index('ix_post_subreddit_top', 'subreddit_id', 'top_rank', 'id'),
+             db.Index('ix_post_subreddit_controversy', 'subreddit_id', 'controversy_rank', 'id'),
+             db.Index('ix_post_subreddit_new', 'subreddit_id', 'id'))
+    db.Table('vote_keyed', metadata,
+             db.Column('voter_id', db.Integer, db.ForeignKey('user_keyed.id'), primary_key=True),
+             db.Column('entry_id', db.Integer, db.ForeignKey('entry_keyed.id'), primary_key=True),
+             db.Column('weight', db.Integer),
+             db.Index('ix_vote_entry_weight', 'entry_id', 'weight'))
+    return metadata.sorted_tables
+
+
+# A column only the migrated table has, and how its rows are copied over
+KEYED = {
+    'user': ('id', """
+        INSERT INTO user_keyed (username, password_hash, karma)
+        SELECT username, password_hash, karma FROM {user} ORDER BY username
+    """),
+    'subreddit': ('id', """
+        INSERT INTO subreddit_keyed (name, subscriber_count)
+        SELECT name, subscriber_count FROM subreddit ORDER BY name
+    """),
+    'subscriptions': ('user_id', """
+        INSERT INTO subscriptions_keyed (user_id, subreddit_id)
+        SELECT user_keyed.id, subreddit_keyed.id FROM subscriptions
+        JOIN user_keyed ON user_keyed.username = subscriptions.user_username
+        JOIN subreddit_keyed ON subreddit_keyed.name = subscriptions.subreddit_name
+    """),
+    'entry': ('user_id', """
+        INSERT INTO entry_keyed (id, user_id, body, parent_id, type, upvotes, downvotes, score, created)
+        SELECT entry.id, user_keyed.id, entry.body, entry.parent_id, entry.type,
+               entry.upvotes, entry.downvotes, entry.score, entry.created
+        FROM entry LEFT JOIN user_keyed ON user_keyed.username = entry.user_username
+    """),
+    'post': ('subreddit_id', """
+        INSERT INTO post_keyed (id, title, subreddit_id, hot_rank, top_rank, controversy_rank)
+        SELECT post.id, post.title, subreddit_keyed.id, post.hot_rank, post.top_rank, post.controversy_rank
+        FROM post LEFT JOIN subreddit_keyed ON subreddit_keyed.name = post.subreddit_name
+    """),
+    'vote': ('voter_id', """
+        INSERT INTO vote_keyed (voter_id, entry_id, weight)
+        SELECT user_keyed.id, vote.entry_id, vote.weight FROM vote
+        JOIN user_keyed ON user_keyed.username = vote.voter_username
+    """),
+}
+
+
+@migration
+def surrogate_keys():
+    """
+    Integer ids for users and subreddits, the other tables refer to them by
+    id instead of repeating names. Every table involved is rebuilt: a copy
+    with the new schema is filled from the old one, which is then dropped.
+    """
+    keyed = _keyed_tables()
+    connection = db.session.connection()
+    for table in keyed:
+        name = table.name[:-len('_keyed')]
+        tables = _inspector().get_table_names()
+        if name in tables and KEYED[name][0] in _columns(name):
+            continue
+        if table.name not in tables:
+            # Index names are shared by the whole schema
+            for index in _inspector().get_indexes(name):
+                if index['name'] in [i.name for i in table.indexes]:
+                    _execute("DROP INDEX {0}".format(_quote(index['name'])))
+            table.create(connection)
+        if name in tables and not _execute("SELECT count(*) FROM " + table.name).scalar():
+            _execute(KEYED[name][1].format(user=_quote('user')))
+    for table in reversed(keyed):
+        name = table.name[:-len('_keyed')]
+        tables = _inspector().get_table_names()
+        if table.name not in tables:
+            continue
+        if name in tables:
+            _execute("DROP TABLE {0}".format(_quote(name)))
+        _execute("ALTER TABLE {0} RENAME TO {1}".format(table.name, _quote(name)))
+    # Entry ids were copied, their sequence has to continue after them
+    reset_sequences(['entry'])
@@ -1,31 +1,80 @@
 """
 We define all of our models here
 """
+import time
+from datetime import datetime, timedelta
+from math import log10
 from . import db, app
-from flask.ext.bcrypt import generate_password_hash, check_password_hash
+from .cache import LRUCache
+from . import hashing
+from .httpcache import depends_on
+from .serializers import expands, shows, nested
+from sqlalchemy import event
+from sqlalchemy.orm.attributes import set_committed_value, get_history
 from itsdangerous import TimedJSONWebSignatureSerializer, SignatureExpired, BadSignature
 
+# Maps verified tokens to the ids of their users, tagged with User.tag,
+# entries never outlive their token
+token_cache = LRUCache(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
+_token_serializers = {}
+
+
+def _token_serializer():
+    """The serializer used to verify tokens, built once per secret key."""
+    key = app.config['SECRET_KEY']
+    if key not in _token_serializers:
+        _token_serializers[key] = TimedJSONWebSignatureSerializer(key)
+    return _token_serializers[key]
+
 # Secondary table for subscriptions
 subscriptions = db.Table('subscriptions',
-                         db.Column(
-                             'user_username', db.String(256), db.ForeignKey('user.username')),
-                         db.Column('subreddit_name', db.String(
-                             256), db.ForeignKey('subreddit.name'))
+                         db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
+                         db.Column('subreddit_id', db.Integer, db.ForeignKey('subreddit.id')),
+                         db.Index('ux_subscriptions_user_subreddit',
+                                  'user_id', 'subreddit_id', unique=True),
+                         db.Index('ix_subscriptions_subreddit', 'subreddit_id')
                          )
 
+# Larger than any id, for comparisons with a bound that may be missing
+MAX_ID = 2 ** 62
+
+# Ranking functions, these are the ones reddit uses.
+# hot grows with the age of reddit itself, so newer posts outrank older ones
+# without anything having to be recomputed as time passes.
+RANK_EPOCH = datetime(2005, 12, 8, 7, 46, 43)
+
+
+def hot(ups, downs, created):
+    score = ups - downs
+    order = log10(max(abs(score), 1))
+    sign = 1 if score > 0 else -1 if score < 0 else 0
+    seconds = (created - RANK_EPOCH).total_seconds()
+    return round(sign * order + seconds / 45000, 7)
+
+
+def controversy(ups, downs):
+    if ups <= 0 or downs <= 0:
+        return 0.0
+    balance = float(downs) / ups if ups > downs else float(ups) / downs
+    return (ups + downs) ** balance
+
+
 # Association object for Karma
 
 
 class Vote(db.Model):
-    voter_username = db.Column(
-        db.String(256), db.ForeignKey('user.username'), primary_key=True)
+    voter_id = db.Column(
+        db.Integer, db.ForeignKey('user.id'), primary_key=True)
     entry_id = db.Column(
         db.Integer, db.ForeignKey('entry.id'), primary_key=True)
     weight = db.Column(db.Integer)
+    __table_args__ = (
+        db.Index('ix_vote_entry_weight', 'entry_id', 'weight'),
+    )
 
     def __init__(self, voter=None, up=True, entry=None):
         self.weight = 1 if up else -1
-        self.voter_username = voter.username
+        self.voter_id = voter.id
         self.entry_id = entry.id
         super(Vote, self).__init__()
 
@@ -33,14 +82,20 @@ class Vote(db.Model):
 class User(db.Model):
 
     """
-    We are using username as primary_key here for semantic sense.
-    However it is important to note that using autogenerated integers make index
-    maintenence much easier.
+    Users are looked up by username, which has a unique index of its own,
+    while the other tables refer to them by their autogenerated integer id,
+    which keeps foreign keys and their indexes small.
     """
-    username = db.Column(db.String(256), primary_key=True)
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(256), nullable=False)
     password_hash = db.Column(db.String(60), unique=True, nullable=False)
+    # Sum of the votes on this user's entries, kept in step by Entry.count_vote
+    karma = db.Column(db.Integer, nullable=False, default=0)
     entries = db.relationship('Entry', backref='author')
     votes = db.relationship('Vote', lazy='dynamic', backref='voter')
+    __table_args__ = (
+        db.Index('ux_user_username', 'username', unique=True),
+    )
 
     def __init__(self, username=None, password=None):
         self.username = username
@@ -48,20 +103,129 @@ class User(db.Model):
             self.password = password
         super(User, self).__init__()
 
+    @staticmethod
+    def _karma_query():
+        """Aggregates vote weights per entry author in a single join."""
+        return db.session.query(
+            User.username, db.func.sum(Vote.weight).label('karma')
+        ).join(Entry, Entry.user_id == User.id).join(Vote, Vote.entry_id == Entry.id).group_by(User.username)
+
+    @staticmethod
+    def compute_karma(usernames=None):
+        """
+        Computes karma from the vote table for a batch of users in one query.
+        Returns a dict of username to karma, covering every user when usernames is None.
+        """
+        query = User._karma_query()
+        if usernames is not None:
+            if not usernames:
+                return {}
+            query = query.filter(User.username.in_(usernames))
+        karma = dict((username, 0) for username in usernames or ())
+        karma.update((username, int(total)) for username, total in query)
+        return karma
+
+    @staticmethod
+    def karma_drift():
+        """Returns (username, karma, actual karma) rows for users whose stored karma is wrong."""
+        actual = User.compute_karma()
+        return [(username, karma, actual.get(username, 0))
+                for username, karma in db.session.query(User.username, User.karma).order_by(User.username)
+                if karma != actual.get(username, 0)]
+
+    @staticmethod
+    def rebuild_karma():
+        """Recomputes every user's karma from the vote table."""
+        total = db.select([db.func.coalesce(db.func.sum(Vote.weight), 0)]).select_from(
+            Vote.__table__.join(Entry.__table__, Vote.entry_id == Entry.id)
+        ).where(Entry.user_id == User.id).correlate_except(Vote, Entry).as_scalar()
+        db.session.execute(User.__table__.update().values(karma=total))
+
+    def subscribed_to(self, ids):
+        """Which of the subreddit ids this user subscribes to, with one indexed query."""
+        if not ids:
+            return set()
+        return set(id for id, in db.session.query(subscriptions.c.subreddit_id).filter(
+            subscriptions.c.user_id == self.id,
+            subscriptions.c.subreddit_id.in_(ids)))
+
+    def subscribe(self, ids):
+        """
+        Subscribes to the subreddits in ids not subscribed to already and
+        counts the new subscribers. Returns the ids subscribed to.
+        Only the rows the insert actually makes are counted, so a concurrent
+        subscription to the same subreddit is skipped instead of failing on
+        the unique index or being counted twice.
+        """
+        insert = db.text(
+            "INSERT INTO subscriptions (user_id, subreddit_id) VALUES (:user, :subreddit) "
+            "ON CONFLICT (user_id, subreddit_id) DO NOTHING")
+        added = [id for id in sorted(set(ids) - self.subscribed_to(ids))
+                 if db.session.execute(insert, {'user': self.id, 'subreddit': id}).rowcount]
+        if added:
+            Subreddit.count_subscribers(added, 1)
+        return added
+
+    def unsubscribe(self, ids):
+        """
+        Unsubscribes from the subreddits in ids, returns those that were subscribed to.
+        Like subscribe, only the rows actually deleted are counted.
+        """
+        removed = [id for id in sorted(self.subscribed_to(ids))
+                   if db.session.execute(subscriptions.delete().where(db.and_(
+                       subscriptions.c.user_id == self.id,
+                       subscriptions.c.subreddit_id == id))).rowcount]
+        if removed:
+            Subreddit.count_subscribers(removed, -1)
+        return removed
+
+    def subscribed_ids(self):
+        """Ids of the subreddits this user subscribes to, without loading them."""
+        return [id for id, in db.session.query(subscriptions.c.subreddit_id).filter(
+            subscriptions.c.user_id == self.id).order_by(subscriptions.c.subreddit_id)]
+
+    def feed_page(self, limit=None, after=None, sort='hot', period='all'):
+        """
+        Returns a page of the posts of every subreddit this user subscribes to,
+        ranked together, and the next page's cursor. The head of each subreddit's
+        feed is read off its own rank index, see cursors.merge_page.
+        """
+        from . import cursors
+        ids = self.subscribed_ids()
+        depends_on(self.cache_tag, *[Subreddit.tag(id) for id in ids])
+        heads = [Post.feed_query(id, sort, period, db.session.query(Post.id).select_from(Post)) for id in ids]
+        return cursors.merge_page(Post.query, heads, Post.SORTS[sort], limit or app.config['PAGE_SIZE'], after)
+
+    @staticmethod
+    def tag(id):
+        """Cache tag of the user with this id."""
+        return 'u:{0}'.format(id)
+
     @property
-    def karma(self):
-        sums = [post.votes.with_entities(
-            db.func.sum(Vote.weight).label('sum')).all()[0][0] for post in self.entries]
-        return sum(sums)
+    def cache_tag(self):
+        return User.tag(self.id)
 
-    def to_dict(self):
-        return {
+    def to_dict(self, view=None):
+        """Serializes the user with the relations view expands, see serializers.Fieldset."""
+        depends_on(self.cache_tag)
+        data = {
             "username": self.username,
-            "subscriptions": [s.to_dict() for s in self.subscriptions],
-            "posts": [e.to_dict() for e in self.entries if isinstance(e, Post)],
-            "comments": [e.to_dict() for e in self.entries if not isinstance(e, Post)],
             "karma": self.karma
         }
+        if expands(view, 'subscriptions'):
+            data["subscriptions"] = [s.to_dict(view=nested(view, 'subscriptions'))
+                                     for s in self.subscriptions]
+        if expands(view, 'posts') or expands(view, 'comments'):
+            entries = Entry.query.with_polymorphic([Post]).filter_by(
+                user_id=self.id).order_by(Entry.id).all()
+            # Posts and comments in one query, kept as the loaded entries
+            set_committed_value(self, 'entries', entries)
+            for key, rows in (('posts', [e for e in entries if isinstance(e, Post)]),
+                              ('comments', [e for e in entries if not isinstance(e, Post)])):
+                if expands(view, key):
+                    Entry.load_for(rows, nested(view, key))
+                    data[key] = [e.to_dict(nested(view, key)) for e in rows]
+        return data
 
     @property
     def password(self):
@@ -71,11 +235,11 @@ class User(db.Model):
     @password.setter
     def password(self, value):
         """Hashes password."""
-        self.password_hash = generate_password_hash(value, 12)
+        self.password_hash = hashing.hash_password(value)
 
     def verify_pass(self, password):
         """Checks if a password matches the stored hash"""
-        return check_password_hash(self.password_hash, password)
+        return hashing.check_password(self.password_hash, password)
 
     def generate_auth_token(self, expires_in):
         """
@@ -91,68 +255,384 @@ class User(db.Model):
         """
         Retrieves user who is identified by this token.
         Raises SignatureExpired, BadSignature if expired or malformed.
+        Tokens seen before are looked up in token_cache instead of being verified again.
         """
-        serializer = TimedJSONWebSignatureSerializer(app.config['SECRET_KEY'])
-        data = serializer.loads(token)
-        user = User.query.get(data['username'])
+        id = token_cache.get(token)
+        if id is not None:
+            user = User.query.get(id)
+        else:
+            data, header = _token_serializer().loads(token, return_header=True)
+            user = User.query.filter_by(username=data['username']).first()
+            if user is not None:
+                token_cache.set(token, user.id, ttl=header['exp'] - time.time(),
+                                tags=[User.tag(user.id)])
         if user is None:
+            token_cache.delete(token)
             raise BadSignature("Could not identify owner.")
         return user
 
+    def forget_tokens(self):
+        """Drops this user's tokens from the verification cache."""
+        token_cache.invalidate(User.tag(self.id))
+
+
+@event.listens_for(User, 'after_update')
+def _password_changed(mapper, connection, user):
+    if get_history(user, 'password_hash').has_changes():
+        user.forget_tokens()
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, user):
+    user.forget_tokens()
+
+
+@event.listens_for(db.metadata, 'after_drop')
+def _users_dropped(target, connection, **kwargs):
+    # The ids cached would name the users of a new database
+    token_cache.clear()
+
 
 class Subreddit(db.Model):
-    name = db.Column(db.String(256), primary_key=True)
+
+    """Looked up by name, referred to by id, like User."""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(256), nullable=False)
+    # Denormalized, kept in step by User.subscribe and User.unsubscribe
+    subscriber_count = db.Column(db.Integer, nullable=False, default=0)
     subscribers = db.relationship(
         'User', secondary=subscriptions, backref=db.backref('subscriptions'))
     posts = db.relationship('Post', backref='subreddit')
+    __table_args__ = (
+        db.Index('ux_subreddit_name', 'name', unique=True),
+    )
 
     def __init__(self, name=None):
         self.name = name
         super(Subreddit, self).__init__()
 
-    def to_dict(self):
-        return {
-            "name": self.name,
-            "posts": [p.to_dict() for p in self.posts]
-        }
+    @staticmethod
+    def count_subscribers(ids, change):
+        """Moves the subscriber counts of the subreddits in ids by change, in SQL."""
+        Subreddit.query.filter(Subreddit.id.in_(ids)).update(
+            {Subreddit.subscriber_count: Subreddit.subscriber_count + change},
+            synchronize_session=False)
+
+    @staticmethod
+    def _counted_subscribers():
+        return db.select([db.func.count()]).where(
+            subscriptions.c.subreddit_id == Subreddit.id).correlate(Subreddit).as_scalar()
+
+    @staticmethod
+    def subscriber_drift():
+        """Returns (name, subscriber count, actual count) rows for subreddits whose count is wrong."""
+        actual = Subreddit._counted_subscribers()
+        return db.session.query(Subreddit.name, Subreddit.subscriber_count, actual).filter(
+            Subreddit.subscriber_count != actual).order_by(Subreddit.name).all()
+
+    @staticmethod
+    def rebuild_subscriber_counts():
+        """Recomputes every subreddit's subscriber count from the subscriptions table."""
+        db.session.execute(Subreddit.__table__.update().values(
+            subscriber_count=Subreddit._counted_subscribers()))
+
+    def posts_page(self, limit=None, after=None, sort='hot', period='all'):
+        """
+        Returns a page of this subreddit's posts and the next page's cursor.
+        sort is one of Post.SORTS, period one of Post.PERIODS and only narrows
+        the top and controversial feeds.
+        """
+        from . import cursors
+        return cursors.page(Post.feed_query(self.id, sort, period), Post.SORTS[sort],
+                            limit or app.config['PAGE_SIZE'], after)
+
+    @staticmethod
+    def tag(id):
+        """Cache tag of the subreddit with this id."""
+        return 'r:{0}'.format(id)
+
+    @property
+    def cache_tag(self):
+        return Subreddit.tag(self.id)
+
+    def to_dict(self, posts=None, view=None):
+        """
+        Serializes the subreddit, with the given posts or the first page of
+        posts if None when view expands posts.
+        """
+        depends_on(self.cache_tag)
+        data = {"name": self.name, "subscriber_count": self.subscriber_count}
+        if expands(view, 'posts'):
+            if posts is None:
+                posts = self.posts_page()[0]
+            Entry.load_for(posts, nested(view, 'posts'))
+            data["posts"] = [p.to_dict(nested(view, 'posts')) for p in posts]
+        return data
 
 
 class Entry(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_username = db.Column(db.String(256), db.ForeignKey('user.username'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     body = db.Column(db.Text)
     parent_id = db.Column(db.Integer, db.ForeignKey('entry.id'))
     parent = db.relationship(
         'Entry', backref=db.backref('comments', lazy='dynamic'), remote_side=[id])
     type = db.Column('type', db.String(128))  # discriminator
     votes = db.relationship('Vote', lazy='dynamic', backref='entry')
-
-    @property
-    def upvotes(self):
-        return self.votes.filter(Vote.weight == 1).count()
-
-    @property
-    def downvotes(self):
-        return self.votes.filter(Vote.weight == -1).count()
+    # Denormalized vote counters, see count_vote
+    upvotes = db.Column(db.Integer, nullable=False, default=0)
+    downvotes = db.Column(db.Integer, nullable=False, default=0)
+    score = db.Column(db.Integer, nullable=False, default=0)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_entry_parent', 'parent_id', 'id'),
+        db.Index('ix_entry_author', 'user_id'),
+    )
 
     def __init__(self, body=None):
         self.body = body
         super(Entry, self).__init__()
 
-    def to_dict(self):
-        from flask import g
-        myvote = 0
-        if hasattr(g, 'user') and self.votes.filter_by(voter=g.user).first():
-            myvote = self.votes.filter_by(voter=g.user).first().weight
-        return {
+    def count_vote(self, old_weight, new_weight):
+        """
+        Moves the stored counters of this entry and its author's karma
+        from old_weight to new_weight, 0 meaning no vote.
+        Must be called in the same transaction that writes or deletes the Vote row.
+        The counters are incremented in SQL so concurrent votes are not lost.
+        """
+        if self.id is None:
+            db.session.flush()
+        Entry.query.filter_by(id=self.id).update({
+            Entry.upvotes: Entry.upvotes + ((new_weight == 1) - (old_weight == 1)),
+            Entry.downvotes: Entry.downvotes + ((new_weight == -1) - (old_weight == -1)),
+            Entry.score: Entry.score + (new_weight - old_weight)
+        })
+        User.query.filter_by(id=self.user_id).update({
+            User.karma: User.karma + (new_weight - old_weight)
+        })
+        if isinstance(self, Post):
+            self.rerank()
+
+    def set_vote(self, voter_id, weight):
+        """
+        Makes the user's vote on this entry weight, 0 removing it, with the
+        same few statements whatever the vote was before: the entry's row is
+        locked first, then the counters and karma move by the difference to
+        the stored vote, read within those updates, and the vote is upserted
+        or deleted. The updates only start once the lock is held, so under
+        READ COMMITTED they see the vote of whoever held it before; locking
+        with the first update instead would leave its subquery reading from
+        the snapshot taken before it waited.
+        """
+        vote = Vote.__table__
+        db.session.query(Entry.id).filter(Entry.id == self.id).with_for_update().scalar()
+        old = db.func.coalesce(db.select([vote.c.weight]).where(db.and_(
+            vote.c.voter_id == voter_id, vote.c.entry_id == self.id)).as_scalar(), 0)
+        Entry.query.filter_by(id=self.id).update({
+            Entry.upvotes: Entry.upvotes + int(weight == 1) - db.case([(old == 1, 1)], else_=0),
+            Entry.downvotes: Entry.downvotes + int(weight == -1) - db.case([(old == -1, 1)], else_=0),
+            Entry.score: Entry.score + weight - old
+        }, synchronize_session=False)
+        User.query.filter_by(id=self.user_id).update({
+            User.karma: User.karma + weight - old
+        }, synchronize_session=False)
+        params = {'voter': voter_id, 'entry': self.id, 'weight': weight}
+        if weight:
+            db.session.execute(db.text(
+                "INSERT INTO vote (voter_id, entry_id, weight) VALUES (:voter, :entry, :weight) "
+                "ON CONFLICT (voter_id, entry_id) DO UPDATE SET weight = excluded.weight"), params)
+        else:
+            db.session.execute(vote.delete().where(db.and_(
+                vote.c.voter_id == voter_id, vote.c.entry_id == self.id)))
+        db.session.expire(self, ['upvotes', 'downvotes', 'score'])
+        if isinstance(self, Post):
+            self.rerank()
+
+    @staticmethod
+    def _counted_votes(weight):
+        """Correlated subquery counting the votes of an entry with this weight."""
+        return db.select([db.func.count()]).where(
+            db.and_(Vote.entry_id == Entry.id, Vote.weight == weight)).correlate_except(Vote).as_scalar()
+
+    @staticmethod
+    def counter_drift():
+        """
+        Returns (id, upvotes, actual upvotes, downvotes, actual downvotes) rows
+        for every entry whose stored counters disagree with the vote table.
+        """
+        ups, downs = Entry._counted_votes(1), Entry._counted_votes(-1)
+        return db.session.query(
+            Entry.id, Entry.upvotes, ups.label('actual_upvotes'),
+            Entry.downvotes, downs.label('actual_downvotes')).filter(
+            db.or_(Entry.upvotes != ups, Entry.downvotes != downs,
+                   Entry.score != ups - downs)).order_by(Entry.id).all()
+
+    @staticmethod
+    def rebuild_counters():
+        """Recomputes every entry's counters from the vote table."""
+        ups, downs = Entry._counted_votes(1), Entry._counted_votes(-1)
+        db.session.execute(Entry.__table__.update().values(
+            upvotes=ups, downvotes=downs, score=ups - downs))
+
+    @staticmethod
+    def comment_tree_query(root_ids, max_depth, after=None, limit=None):
+        """
+        Query for (entry, depth, has replies) of every comment up to max_depth
+        levels below the roots, parents before their replies.
+        With a limit, only the first limit replies of each entry are loaded,
+        plus one more to tell that there are more, whose own replies are not.
+        """
+        table = Entry.__table__
+        # The roots themselves are the anchor at depth 0, this also keeps the
+        # result from ever being empty, which the sqlite driver mishandles
+        # for statements starting with WITH. cut marks the replies past the limit.
+        tree = db.select([table.c.id, db.literal(0).label('depth'), db.literal(0).label('cut')]).where(
+            table.c.id.in_(root_ids)).cte('tree', recursive=True)
+        parent, child = tree.alias('parent'), table.alias()
+        step = db.and_(child.c.parent_id == parent.c.id, parent.c.depth < max_depth, parent.c.cut == 0)
+        if after is not None:
+            step = db.and_(step, db.or_(parent.c.depth > 0, child.c.id > after))
+        cut = db.literal(0)
+        if limit is not None:
+            # The id of the reply just past the limit bounds the index range
+            # read for each parent, so replies further on are never visited.
+            # Written out with its numbers, sqlalchemy misplaces the bound
+            # LIMIT parameters of subqueries within a CTE.
+            siblings = "sibling.parent_id = parent.id"
+            if after is not None:
+                siblings += " AND (parent.depth > 0 OR sibling.id > {0:d})".format(int(after))
+            last = db.literal_column(
+                "(SELECT sibling.id FROM entry AS sibling WHERE {0} "
+                "ORDER BY sibling.id LIMIT 1 OFFSET {1:d})".format(siblings, int(limit)))
+            step = db.and_(step, child.c.id <= db.func.coalesce(last, MAX_ID))
+            cut = db.case([(child.c.id == last, 1)], else_=0)
+        tree = tree.union_all(db.select([child.c.id, parent.c.depth + 1, cut]).where(step))
+        reply = table.alias()
+        has_replies = db.exists().where(reply.c.parent_id == Entry.id)
+        return db.session.query(Entry, tree.c.depth, has_replies.label('has_replies')).join(
+            tree, Entry.id == tree.c.id).order_by(tree.c.depth, Entry.id)
+
+    @staticmethod
+    def load_comment_trees(roots, max_depth=None, limit=None, after=None):
+        """
+        Loads the comments under all roots with one recursive query and links
+        them up in memory, so that to_dict never queries for comments.
+        max_depth is how many levels are loaded and limit how many replies an
+        entry shows, entries cut short get a continuation link in "more".
+        after is a comment id, only the roots' replies after it are loaded.
+        """
+        from .loaders import vote_map
+        from flask import url_for
+        from . import cursors
+        if max_depth is None:
+            max_depth = app.config['COMMENT_TREE_DEPTH']
+        if limit is None:
+            limit = app.config['COMMENT_TREE_LIMIT']
+        nodes = dict((root.id, root) for root in roots)
+        for root in roots:
+            root._comments, root._more = [], None
+        if nodes and max_depth > 0:
+            rows = Entry.comment_tree_query(nodes.keys(), max_depth, after, limit)
+            loaded = set()
+            for entry, depth, replies in rows:
+                # A root may also sit below another root, keep its first appearance
+                if depth == 0 or entry.id in loaded:
+                    continue
+                loaded.add(entry.id)
+                if entry.id not in nodes:
+                    entry._comments, entry._more = [], None
+                    if depth == max_depth and replies:
+                        entry._more = url_for('comment_ep', id=entry.id)
+                    nodes[entry.id] = entry
+                nodes[entry.parent_id]._comments.append(entry)
+        Entry.prime_related(nodes.values())
+        if after is None and max_depth > 0:
+            # Every direct reply of the roots got loaded, unless cut short
+            for root in roots:
+                if len(root._comments) <= limit:
+                    root._comment_count = len(root._comments)
+        for entry in nodes.values():
+            if len(entry._comments) > limit:
+                entry._comments = entry._comments[:limit]
+                entry._more = url_for('comment_ep', id=entry.id,
+                                      after=cursors.encode(entry._comments[-1].id))
+        votes = vote_map()
+        if votes is not None:
+            votes.prime(nodes.values())
+
+    @property
+    def cache_tag(self):
+        return 'e:{0}'.format(self.id)
+
+    def vote_tags(self):
+        """Cache tags of everything a vote on this entry changes."""
+        tags = [self.cache_tag, User.tag(self.user_id)]
+        if isinstance(self, Post):
+            # Feed order moves with the ranks
+            tags.append(Subreddit.tag(self.subreddit_id))
+        return tags
+
+    @staticmethod
+    def prime_related(entries):
+        """Queues the authors of entries and the subreddits of posts to be loaded in one batch each."""
+        from .loaders import prime
+        prime(User, [e.user_id for e in entries])
+        prime(Subreddit, [e.subreddit_id for e in entries if isinstance(e, Post)])
+
+    @staticmethod
+    def load_comment_counts(entries):
+        """Counts the replies directly under each of entries with one grouped query."""
+        entries = [e for e in entries if '_comment_count' not in e.__dict__]
+        if not entries:
+            return
+        counts = dict(db.session.query(Entry.parent_id, db.func.count(Entry.id)).filter(
+            Entry.parent_id.in_([e.id for e in entries])).group_by(Entry.parent_id))
+        for entry in entries:
+            entry._comment_count = counts.get(entry.id, 0)
+
+    @staticmethod
+    def load_for(entries, view=None):
+        """
+        Loads everything view shows of entries in a batch: the comment trees
+        if it expands comments, the comment counts of posts, the reader's votes,
+        and queues their authors and subreddits with the request's loaders.
+        Comment trees expanded in a listing are shallow unless view asks for a depth.
+        """
+        from .loaders import vote_map
+        if expands(view, 'comments'):
+            depth = view.depth if view is not None else None
+            if depth is None:
+                depth = app.config['EXPANDED_COMMENT_DEPTH']
+            Entry.load_comment_trees([e for e in entries if '_comments' not in e.__dict__],
+                                     depth, app.config['EXPANDED_COMMENT_LIMIT'])
+        if shows(view, 'comment_count'):
+            Entry.load_comment_counts([e for e in entries if isinstance(e, Post)])
+        Entry.prime_related(entries)
+        votes = vote_map()
+        if votes is not None:
+            votes.prime(entries)
+
+    def to_dict(self, view=None):
+        """Serializes the entry, with its replies if view expands comments."""
+        from .loaders import vote_map, load
+        depends_on(self.cache_tag)
+        votes = vote_map()
+        # Through the request's loader, which fetches the authors of a batch at once
+        set_committed_value(self, 'author', load(User, self.user_id))
+        data = {
             "id": self.id,
             "body": self.body,
-            "comments": [c.to_dict() for c in self.comments],
             "author": self.author.username,
             "upvotes": self.upvotes,
-            "myvote": myvote,
+            "myvote": votes.weight(self) if votes is not None else 0,
             "downvotes": self.downvotes
         }
+        if expands(view, 'comments'):
+            if '_comments' not in self.__dict__:
+                Entry.load_comment_trees([self])
+            data["comments"] = [c.to_dict(nested(view, 'comments')) for c in self._comments]
+            data["more"] = self._more
+        return data
 
     __mapper_args__ = {
         'polymorphic_identity': 'entry',
@@ -163,17 +643,88 @@ class Entry(db.Model):
 class Post(Entry):
     id = db.Column(db.Integer, db.ForeignKey('entry.id'), primary_key=True)
     title = db.Column(db.String(512), index=True, nullable=False)
-    subreddit_name = db.Column(db.String(256), db.ForeignKey('subreddit.name'))
+    subreddit_id = db.Column(db.Integer, db.ForeignKey('subreddit.id'))
+    # Stored ranks so that subreddit feeds are read off an index, see rerank
+    hot_rank = db.Column(db.Float, nullable=False, default=0)
+    top_rank = db.Column(db.Integer, nullable=False, default=0)
+    controversy_rank = db.Column(db.Float, nullable=False, default=0)
+    __table_args__ = (
+        db.Index('ix_post_subreddit_title', 'subreddit_id', 'title'),
+        db.Index('ix_post_subreddit_hot', 'subreddit_id', 'hot_rank', 'id'),
+        db.Index('ix_post_subreddit_top', 'subreddit_id', 'top_rank', 'id'),
+        db.Index('ix_post_subreddit_controversy', 'subreddit_id', 'controversy_rank', 'id'),
+        db.Index('ix_post_subreddit_new', 'subreddit_id', 'id'),
+    )
     __mapper_args__ = {
         'polymorphic_identity': 'post'
     }
 
+    # Keyset orderings of the subreddit feeds
+    SORTS = {
+        'hot': [(hot_rank, True), (id, True)],
+        'top': [(top_rank, True), (id, True)],
+        'new': [(id, True)],
+        'controversial': [(controversy_rank, True), (id, True)]
+    }
+    # Time windows of the top and controversial feeds
+    PERIODS = {
+        'hour': timedelta(hours=1),
+        'day': timedelta(days=1),
+        'week': timedelta(weeks=1),
+        'month': timedelta(days=30),
+        'year': timedelta(days=365),
+        'all': None
+    }
+
     def __init__(self, title=None, **kwargs):
         self.title = title
         super(Post, self).__init__(**kwargs)
 
-    def to_dict(self):
-        dic = super(Post, self).to_dict()
+    @staticmethod
+    def feed_query(subreddit_id, sort='hot', period='all', query=None):
+        """
+        Posts of one subreddit's feed, to be ordered by Post.SORTS[sort],
+        narrowed from query if given.
+        period only narrows the top and controversial feeds.
+        """
+        query = (query or Post.query).filter(Post.subreddit_id == subreddit_id)
+        window = Post.PERIODS[period]
+        if window is not None and sort in ('top', 'controversial'):
+            query = query.filter(Post.created >= datetime.utcnow() - window)
+        return query
+
+    def rerank(self):
+        """Recomputes the stored ranks from the vote counters."""
+        created = self.created or datetime.utcnow()
+        self.hot_rank = hot(self.upvotes, self.downvotes, created)
+        self.top_rank = self.upvotes - self.downvotes
+        self.controversy_rank = controversy(self.upvotes, self.downvotes)
+
+    @staticmethod
+    def rerank_all(since=None, batch=1000):
+        """
+        Recomputes the ranks of every post, or of those created after since.
+        Meant to run on a schedule to repair ranks that raced with votes.
+        """
+        query = Post.query
+        if since is not None:
+            query = query.filter(Post.created >= since)
+        count = 0
+        for post in query.yield_per(batch):
+            post.rerank()
+            count += 1
+            if count % batch == 0:
+                db.session.flush()
+        return count
+
+    def to_dict(self, view=None):
+        from .loaders import load
+        dic = super(Post, self).to_dict(view)
         dic['title'] = self.title
+        set_committed_value(self, 'subreddit', load(Subreddit, self.subreddit_id))
         dic['subreddit'] = self.subreddit.name
+        if shows(view, 'comment_count'):
+            if '_comment_count' not in self.__dict__:
+                Entry.load_comment_counts([self])
+            dic['comment_count'] = self._comment_count
         return dic
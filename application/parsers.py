@@ -1,7 +1,8 @@
 """
 Here we define how to parse JSON parameters sent by the client
 """
-from flask.ext.restful import reqparse
+from flask.ext.restful import reqparse, inputs
+from models import Post
 
 
 user_parser = reqparse.RequestParser()
@@ -14,10 +15,41 @@ token_parser.add_argument('expires_in', type=int, default=60)
 subreddit_parser = reqparse.RequestParser()
 subreddit_parser.add_argument('name', str)
 
+subscriptions_parser = reqparse.RequestParser()
+subscriptions_parser.add_argument('names', action='append', required=True,
+                                  help="Please provide the subreddit names in names.")
+
 post_parser = reqparse.RequestParser()
 post_parser.add_argument('title', str)
 post_parser.add_argument('body', str)
 
 
 comment_parser = reqparse.RequestParser()
-comment_parser.add_argument('body', str)
\ No newline at end of file
+comment_parser.add_argument('body', str)
+
+vote_parser = reqparse.RequestParser()
+vote_parser.add_argument('weight', type=int, required=True, choices=(-1, 0, 1),
+                         help="weight must be -1, 0 or 1.")
+
+tree_parser = reqparse.RequestParser()
+tree_parser.add_argument('depth', type=int)
+tree_parser.add_argument('limit', type=int)
+tree_parser.add_argument('after', str)
+
+listing_parser = reqparse.RequestParser()
+listing_parser.add_argument('limit', type=int)
+listing_parser.add_argument('after', str)
+listing_parser.add_argument('stream', type=inputs.boolean, default=False)
+
+fieldset_parser = reqparse.RequestParser()
+fieldset_parser.add_argument('fields')
+fieldset_parser.add_argument('expand')
+fieldset_parser.add_argument('depth', type=int)
+
+feed_parser = reqparse.RequestParser()
+feed_parser.add_argument('sort', choices=Post.SORTS.keys(), default='hot')
+feed_parser.add_argument('t', choices=Post.PERIODS.keys(), default='all')
+
+search_parser = reqparse.RequestParser()
+search_parser.add_argument('q', required=True, help="Please provide the words to search for in q.")
+search_parser.add_argument('r')
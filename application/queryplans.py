@@ -0,0 +1,92 @@
+"""
+Query plan checks.
+Runs EXPLAIN QUERY PLAN over the queries the resources make on every request
+and reports the ones that scan a whole table instead of searching an index,
+including the automatic indexes sqlite builds by scanning the table first.
+Plans name a table by its alias when it has one, so every scan that does not
+go through an index is reported, save those of the query's own CTEs.
+Only sqlite plans are understood, other databases are not checked.
+"""
+import re
+from datetime import datetime
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.selectable import CTE
+from . import db, cursors
+from .models import User, Subreddit, Entry, Post, Vote, subscriptions
+
+SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?(.*)$')
+INDEXED = re.compile(r'\bUSING\b.*\b(?:INDEX|PRIMARY KEY)\b')
+
+
+def hot_queries(username='user', subreddit='subreddit', title='title', entry_id=1,
+                user_id=1, subreddit_id=1):
+    """(name, query) pairs of the lookups made while serving requests."""
+    queries = [
+        ('token user', User.query.filter_by(username=username)),
+        ('subreddit', Subreddit.query.filter_by(name=subreddit)),
+        ('subreddit names', db.session.query(Subreddit.id, Subreddit.name).filter(
+            Subreddit.name.in_([subreddit, subreddit + 'x']))),
+        ('post by title', Post.query.filter_by(subreddit_id=subreddit_id, title=title)),
+        ('entry', Entry.query.filter_by(id=entry_id)),
+        ('author', User.query.filter_by(id=user_id)),
+        ('comment tree', Entry.comment_tree_query([entry_id], 10, limit=100)),
+        ('comment tree page', Entry.comment_tree_query([entry_id], 10, after=entry_id, limit=100)),
+        ('user entries', Entry.query.filter_by(user_id=user_id)),
+        ('vote', Vote.query.filter_by(voter_id=user_id, entry_id=entry_id)),
+        ('vote map', db.session.query(Vote.entry_id, Vote.weight).filter(
+            Vote.voter_id == user_id, Vote.entry_id.in_([entry_id, entry_id + 1]))),
+        ('entry votes', Vote.query.filter_by(entry_id=entry_id, weight=1)),
+        ('subscribers', User.query.join(
+            subscriptions, subscriptions.c.user_id == User.id).filter(
+            subscriptions.c.subreddit_id == subreddit_id)),
+        ('subscriptions', Subreddit.query.join(
+            subscriptions, subscriptions.c.subreddit_id == Subreddit.id).filter(
+            subscriptions.c.user_id == user_id)),
+        ('subscription', db.session.query(subscriptions.c.subreddit_id).filter(
+            subscriptions.c.user_id == user_id,
+            subscriptions.c.subreddit_id.in_([subreddit_id, subreddit_id + 1]))),
+    ]
+    feed = Post.query.filter(Post.subreddit_id == subreddit_id)
+    for sort, keys in sorted(Post.SORTS.items()):
+        queries.append(('{0} feed'.format(sort), cursors.ordered(feed, keys, None).limit(25)))
+    queries.append(('top feed of the week', cursors.ordered(
+        feed.filter(Post.created >= datetime.utcnow()), Post.SORTS['top'], None).limit(25)))
+    return queries
+
+
+def explain(query):
+    """Returns the detail lines of the sqlite query plan of query."""
+    compiled = query.with_labels().statement.compile(dialect=db.engine.dialect)
+    params = [compiled.params[name] for name in compiled.positiontup]
+    cursor = db.session.connection().connection.cursor()
+    try:
+        # The driver caches statements by their text and an EXPLAIN is planned
+        # when it is prepared, so tag it with the schema cookie to replan it
+        # whenever indexes change.
+        cursor.execute("PRAGMA schema_version")
+        cookie = cursor.fetchone()[0]
+        cursor.execute("EXPLAIN QUERY PLAN /* schema {0} */ {1}".format(cookie, compiled), params)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def ctes(query):
+    """Returns the names the CTEs of query go by, including their aliases."""
+    return set(element.name for element in visitors.iterate(query.with_labels().statement, {})
+               if isinstance(element, CTE))
+
+
+def full_scans(queries=None):
+    """Returns (name, plan line) for every full table scan in the plans of queries."""
+    if db.engine.dialect.name != 'sqlite':
+        return []
+    scans = []
+    for name, query in queries if queries is not None else hot_queries():
+        own = ctes(query) | set(['CONSTANT', 'SUBQUERY'])
+        for line in explain(query):
+            match = SCAN.match(line)
+            if match and not INDEXED.search(match.group(3)) and \
+                    (match.group(2) or match.group(1)) not in own or 'AUTOMATIC' in line:
+                scans.append((name, line))
+    return scans
@@ -1,11 +1,20 @@
-from flask.ext.restful import Resource, marshal_with, abort
-from . import db, api
-from flask import g, request
-from fields import user_fields, token_fields, subreddit_fields, post_fields, comment_fields
-from parsers import user_parser, token_parser, subreddit_parser, post_parser, comment_parser
-from models import User, BadSignature, SignatureExpired, Subreddit, Entry, Post, Vote
+from flask.ext.restful import Resource, abort
+from . import db, api, app
+from flask import g, request, url_for
+from fields import user_fields, token_fields, subreddit_fields, post_fields, comment_fields, search_fields
+from parsers import user_parser, token_parser, subreddit_parser, post_parser, comment_parser, tree_parser, listing_parser, feed_parser, search_parser, fieldset_parser, subscriptions_parser, vote_parser
+from models import User, BadSignature, SignatureExpired, Subreddit, Entry, Post, Vote, token_cache
 from functools import wraps
 import base64
+import cursors
+import hashing
+import instrumentation
+import search
+from serializers import marshal_with, fieldset
+from streaming import stream_json
+from httpcache import cached, invalidate, depends_on, response_cache
+from loaders import vote_map, loader, load_by
+from votequeue import queue as vote_queue
 
 
 def token_required(func):
@@ -21,6 +30,8 @@ def token_required(func):
             abort(401, message="Please provide X-Auth-Token header.")
         try:
             g.user = User.verify_auth_token(token)
+            # Lookups of the user later in the request are served from memory
+            loader(User).add(g.user, 'username')
             return func(*args, **kwargs)  # Call wraped function
         except SignatureExpired:
             abort(401, message="Token has expired.")
@@ -29,6 +40,88 @@ def token_required(func):
     return decorator
 
 
+def token_optional(func):
+    """
+    Like token_required, but lets requests without X-Auth-Token through anonymously.
+    Used by read endpoints so that authenticated readers get their own votes back.
+    """
+    @wraps(func)
+    def decorator(*args, **kwargs):
+        if request.headers.get('X-Auth-Token', None) is None:
+            return func(*args, **kwargs)
+        return token_required(func)(*args, **kwargs)
+    return decorator
+
+
+def load_or_404(model, column, value):
+    """The row of model whose unique column is value, loaded once per request, or a 404."""
+    row = load_by(model, column, value)
+    if row is None:
+        abort(404)
+    return row
+
+
+def load_tree(entry):
+    """Loads the comment tree under entry as asked for by the query string."""
+    args = tree_parser.parse_args()
+    if args['depth'] is not None and args['depth'] < 0 or args['limit'] is not None and args['limit'] < 1:
+        abort(400, message="depth must not be negative and limit must be positive.")
+    after = cursors.decode(args['after'], [int])[0] if args['after'] else None
+    Entry.load_comment_trees([entry], args['depth'], args['limit'], after)
+    return entry
+
+
+def request_fieldset(spec, expand=None):
+    """
+    Fieldset of spec asked for by the fields and expand arguments, or the
+    relations in expand expanded when there are neither.
+    marshal_with then outputs only that part of spec.
+    """
+    args = fieldset_parser.parse_args()
+    if args['fields'] is None and args['expand'] is None:
+        args['expand'] = expand
+    if args['depth'] is not None and args['depth'] < 0:
+        abort(400, message="depth must not be negative.")
+    try:
+        g.fieldset = fieldset(spec, args['expand'], args['fields'], args['depth'])
+    except ValueError as error:
+        abort(400, message=str(error))
+    return g.fieldset
+
+
+def page_args():
+    """Parses and checks the limit and after arguments of a listing."""
+    args = listing_parser.parse_args()
+    if args['limit'] is not None and not 0 < args['limit'] <= app.config['MAX_PAGE_SIZE']:
+        abort(400, message="limit must be between 1 and {0}.".format(app.config['MAX_PAGE_SIZE']))
+    return args['limit'] or app.config['PAGE_SIZE'], args['after']
+
+
+def listing(query, keys, view):
+    """
+    Serves a listing of query in keys order, one page at a time,
+    or all of it from after on as a stream when asked with stream=true.
+    Rows are serialized as view, a Fieldset, shows them.
+    """
+    limit, after = page_args()
+    if listing_parser.parse_args()['stream']:
+        return stream_json(cursors.ordered(query, keys, after), lambda row: row.to_dict(view=view), view)
+    rows, cursor = cursors.page(query, keys, limit, after)
+    return [row.to_dict(view=view) for row in rows], 200, next_link(cursor)
+
+
+def next_link(cursor):
+    """
+    Link header pointing at the next page of the current listing.
+    The body stays a plain list, so clients that ignore the header are unaffected.
+    """
+    if cursor is None:
+        return {}
+    args = dict(request.args.items(), **request.view_args)
+    args['after'] = cursor
+    return {'Link': '<{0}>; rel="next"'.format(url_for(request.endpoint, **args))}
+
+
 @api.resource('/tokens', endpoint='token_ep')
 class TokenResource(Resource):
 
@@ -46,9 +139,13 @@ class TokenResource(Resource):
             values = auth.split(':')
             if len(values) != 2:
                 abort(400, message="Malformed X-Auth Header.")
-            user = User.query.get(values[0])
+            user = User.query.filter_by(username=values[0]).first()
             if user is None or not user.verify_pass(values[1]):
                 abort(401, message="Invalid username or password.")
+            if hashing.needs_rehash(user.password_hash):
+                # Upgrade the hash to the configured work factor
+                user.password = values[1]
+                db.session.commit()
             args = token_parser.parse_args()
             return {
                 "token": user.generate_auth_token(args['expires_in']),
@@ -69,9 +166,9 @@ class UsersResource(Resource):
     def get(self):
         """
         Handle HTTP GET method.
-        This method lists all users.
+        This method lists users a page at a time.
         """
-        return [u.to_dict() for u in User.query.all()]
+        return listing(User.query, [(User.username, False)], request_fieldset(user_fields))
 
     def post(self):
         """
@@ -91,16 +188,20 @@ class UsersResource(Resource):
 
 @api.resource('/u/<string:username>', endpoint='user_ep')
 class UserResource(Resource):
-    method_decorators = [marshal_with(user_fields)]
 
+    @token_optional
+    @cached
+    @marshal_with(user_fields)
     def get(self, username):
         """
         Handle HTTP GET method.
         Fetches a single user by username
         """
-        return User.query.get_or_404(username).to_dict()
+        view = request_fieldset(user_fields, 'subscriptions,posts,comments')
+        return load_or_404(User, 'username', username).to_dict(view)
 
     @token_required
+    @marshal_with(user_fields)
     def put(self, username):
         """
         Handles HTTP PUT method.
@@ -117,13 +218,45 @@ class UserResource(Resource):
         return g.user
 
 
+def feed(user):
+    """Serves a page of user's front page, the ranked merge of their subscriptions."""
+    view = request_fieldset(post_fields)
+    limit, after = page_args()
+    args = feed_parser.parse_args()
+    posts, cursor = user.feed_page(limit, after, args['sort'], args['t'])
+    Entry.load_for(posts, view)
+    return [post.to_dict(view) for post in posts], 200, next_link(cursor)
+
+
+@api.resource('/u/<string:username>/feed', endpoint='user_feed_ep')
+class UserFeedResource(Resource):
+
+    @token_optional
+    @cached
+    @marshal_with(post_fields)
+    def get(self, username):
+        """Front page of a user, built from the subreddits they subscribe to"""
+        return feed(load_or_404(User, 'username', username))
+
+
+@api.resource('/feed', endpoint='feed_ep')
+class FeedResource(Resource):
+
+    @token_required
+    @cached
+    @marshal_with(post_fields)
+    def get(self):
+        """Front page of the logged in user"""
+        return feed(g.user)
+
+
 @api.resource('/subreddits', endpoint="subreddits_ep")
 class SubredditsResource(Resource):
     method_decorators = [marshal_with(subreddit_fields)]
 
     def get(self):
-        """List all subreddits"""
-        return [s.to_dict() for s in Subreddit.query.all()]
+        """List subreddits a page at a time"""
+        return listing(Subreddit.query, [(Subreddit.name, False)], request_fieldset(subreddit_fields))
 
     @token_required
     def post(self):
@@ -131,27 +264,38 @@ class SubredditsResource(Resource):
         if len(args['name']) < 1:
             abort(400, message="Subreddit must have a name.")
         s = Subreddit(name=args['name'])
-        s.subscribers.append(g.user)
         db.session.add(s)
+        db.session.flush()
+        g.user.subscribe([s.id])
         db.session.commit()
+        invalidate(s.cache_tag, g.user.cache_tag, 'subreddits')
         return s.to_dict(), 201
 
 
 @api.resource('/r/<string:name>', endpoint="subreddit_ep")
 class SubredditResource(Resource):
 
+    @token_optional
+    @cached
     @marshal_with(subreddit_fields)
     def get(self, name):
         if name == 'all':
-            return [s.to_dict() for s in Subreddit.query.all()]
-        sub = Subreddit.query.get_or_404(name)
-        return sub.to_dict()
+            depends_on('subreddits')
+            return listing(Subreddit.query, [(Subreddit.name, False)], request_fieldset(subreddit_fields))
+        view = request_fieldset(subreddit_fields, 'posts')
+        limit, after = page_args()
+        sub = load_or_404(Subreddit, 'name', name)
+        if not view.expands('posts'):
+            return sub.to_dict(view=view)
+        args = feed_parser.parse_args()
+        posts, cursor = sub.posts_page(limit, after, args['sort'], args['t'])
+        return sub.to_dict(posts, view), 200, next_link(cursor)
 
     @token_required
     @marshal_with(post_fields)
     def post(self, name):
         """post method posts to a subreddit!, How's that for semantic web??!"""
-        sub = Subreddit.query.get_or_404(name)
+        sub = load_or_404(Subreddit, 'name', name)
         args = post_parser.parse_args()
         if len(args['title']) < 5 or len(args['body']) < 10:
             abort(
@@ -165,7 +309,10 @@ class SubredditResource(Resource):
         vote = Vote(voter=g.user, up=True, entry=post)
         post.votes.append(vote)
         db.session.add(vote)
+        post.count_vote(0, vote.weight)
+        search.index_entry(post, sub.name)
         db.session.commit()
+        invalidate(sub.cache_tag, g.user.cache_tag)
         return post.to_dict()
 
 
@@ -174,47 +321,90 @@ class SubredditSubscription(Resource):
     method_decorators = [token_required]
 
     def post(self, name):
-        sub = Subreddit.query.get_or_404(name)
-        sub.subscribers.append(g.user)
-        db.session.add(sub)
+        sub = load_or_404(Subreddit, 'name', name)
+        g.user.subscribe([sub.id])
         db.session.commit()
+        invalidate(sub.cache_tag, g.user.cache_tag)
         return {"message": "subscribed"}, 201
 
     def delete(self, name):
-        sub = Subreddit.query.get_or_404(name)
-        if g.user not in sub.subscribers:
+        sub = load_or_404(Subreddit, 'name', name)
+        if not g.user.unsubscribe([sub.id]):
             abort(422, message="You are not subscribed.")
-        sub.subscribers.remove(g.user)
-        db.session.add(sub)
         db.session.commit()
+        invalidate(sub.cache_tag, g.user.cache_tag)
         return {"message": "unsubscribed"}, 200
 
 
+def subreddit_ids():
+    """
+    Maps the ids of the subreddits sent in names to their names,
+    aborts with 404 if any does not exist.
+    """
+    names = set(subscriptions_parser.parse_args()['names'])
+    found = dict(db.session.query(Subreddit.id, Subreddit.name).filter(Subreddit.name.in_(names)))
+    missing = names - set(found.values())
+    if missing:
+        abort(404, message="No subreddit named {0}.".format(", ".join(sorted(missing))))
+    return found
+
+
+@api.resource('/subscriptions', endpoint="subscriptions_ep")
+class SubscriptionsResource(Resource):
+    method_decorators = [token_required]
+
+    def post(self):
+        """Subscribes to every subreddit in names at once"""
+        names = subreddit_ids()
+        added = g.user.subscribe(names.keys())
+        db.session.commit()
+        invalidate(g.user.cache_tag, *[Subreddit.tag(id) for id in added])
+        return {"subscribed": sorted(names[id] for id in added)}, 200
+
+    def delete(self):
+        """Unsubscribes from every subreddit in names at once"""
+        names = subreddit_ids()
+        removed = g.user.unsubscribe(names.keys())
+        db.session.commit()
+        invalidate(g.user.cache_tag, *[Subreddit.tag(id) for id in removed])
+        return {"unsubscribed": sorted(names[id] for id in removed)}, 200
+
+
 @api.resource('/r/<string:subreddit>/posts/<string:title>', endpoint="post_ep")
 class PostResource(Resource):
 
+    @token_optional
+    @cached
     @marshal_with(post_fields)
     def get(self, subreddit, title):
-        sub = Subreddit.query.get_or_404(subreddit)
-        return Post.query.filter_by(title=title, subreddit=sub).first_or_404().to_dict()
+        view = request_fieldset(post_fields, 'comments.comments')
+        sub = load_or_404(Subreddit, 'name', subreddit)
+        post = Post.query.filter_by(title=title, subreddit=sub).first_or_404()
+        if view.expands('comments'):
+            load_tree(post)
+        return post.to_dict(view)
 
     @token_required
     @marshal_with(comment_fields)
     def post(self, subreddit, title):
         """Adds a comment"""
-        sub = Subreddit.query.get_or_404(subreddit)
+        sub = load_or_404(Subreddit, 'name', subreddit)
         post = Post.query.filter_by(title=title, subreddit=sub).first_or_404()
         args = comment_parser.parse_args()
         if len(args['body']) < 1:
             abort(400, message="Comment must have a body.")
         entry = Entry(body=args['body'])
+        entry.parent = post
         db.session.add(entry)
         g.user.entries.append(entry)
         db.session.add(g.user)
         vote = Vote(voter=g.user, up=True, entry=entry)
         entry.votes.append(vote)
         db.session.add(vote)
+        entry.count_vote(0, vote.weight)
+        search.index_entry(entry, sub.name)
         db.session.commit()
+        invalidate(post.cache_tag, g.user.cache_tag)
         return entry.to_dict(), 201
 
 
@@ -230,21 +420,55 @@ class VoteResource(Resource):
 
     def post(self, id):
         entry = Entry.query.get_or_404(id)
+        if app.config['VOTE_WRITE_BEHIND']:
+            if vote_map().weight(entry) != 0:
+                abort(422, message="You can only vote once")
+            vote_queue.put(g.user.id, entry.id, 1 if self.direction else -1)
+            # The voter's own cached views show the vote they just made
+            invalidate(entry.cache_tag)
+            return {"message": "vote accepted"}, 202
         if entry.votes.filter_by(voter=g.user).count() != 0:
             abort(422, message="You can only vote once")
         vote = Vote(voter=g.user, up=self.direction, entry=entry)
         entry.votes.append(vote)
         db.session.add(vote)
+        entry.count_vote(0, vote.weight)
         db.session.commit()
+        invalidate(*entry.vote_tags())
         return entry.to_dict(), 201
 
     def delete(self, id):
         entry = Entry.query.get_or_404(id)
-        entry.votes.filter_by(voter=g.user).delete(synchronize_session=False)
+        if app.config['VOTE_WRITE_BEHIND']:
+            vote_queue.put(g.user.id, entry.id, 0)
+            invalidate(entry.cache_tag)
+            return {"message": "removed vote"}, 204
+        tags = entry.vote_tags()
+        entry.set_vote(g.user.id, 0)
         db.session.commit()
+        invalidate(*tags)
         return {"message": "removed vote"}, 204
 
 
+@api.resource('/entry/<string:id>/vote', endpoint="vote_ep")
+class VoteWeightResource(Resource):
+    method_decorators = [token_required]
+
+    def put(self, id):
+        """Sets the vote on an entry to weight, 1 up, -1 down or 0 none, whatever it was"""
+        weight = vote_parser.parse_args()['weight']
+        entry = Entry.query.get_or_404(id)
+        if app.config['VOTE_WRITE_BEHIND']:
+            vote_queue.put(g.user.id, entry.id, weight)
+            invalidate(entry.cache_tag)
+            return {"message": "vote accepted"}, 202
+        tags = entry.vote_tags()
+        entry.set_vote(g.user.id, weight)
+        db.session.commit()
+        invalidate(*tags)
+        return {"myvote": weight, "upvotes": entry.upvotes, "downvotes": entry.downvotes}, 200
+
+
 @api.resource('/entry/<string:id>/up', endpoint="upvote_ep")
 class Upvote(VoteResource):
 
@@ -261,7 +485,70 @@ class Downvote(VoteResource):
 
 @api.resource('/comments/<string:id>', endpoint="comment_ep")
 class CommentResource(Resource):
-    method_decorators = [marshal_with(comment_fields)]
 
+    @token_optional
+    @cached
+    @marshal_with(comment_fields)
     def get(self, id):
-        return Entry.query.get_or_404(id).to_dict()
+        view = request_fieldset(comment_fields, 'comments')
+        entry = Entry.query.get_or_404(id)
+        if view.expands('comments'):
+            load_tree(entry)
+        return entry.to_dict(view)
+
+
+@api.resource('/search', endpoint='search_ep')
+class SearchResource(Resource):
+
+    @token_optional
+    @marshal_with(search_fields)
+    def get(self):
+        """Posts and comments matching all the words of q, in subreddit r if given"""
+        if not search.available():
+            abort(501, message="Search is not available on this database.")
+        request_fieldset(search_fields)
+        args = search_parser.parse_args()
+        limit, after = page_args()
+        hits, cursor = search.search(args['q'], args['r'], limit, after)
+        # Authors joined in, rather than batched by a loader, as they are needed anyway
+        entries = Entry.query.with_polymorphic([Post]).options(db.joinedload(Entry.author)).filter(
+            Entry.id.in_([id for id, _ in hits])).all() if hits else []
+        entries = dict((entry.id, entry) for entry in entries)
+        votes = vote_map()
+        if votes is not None:
+            votes.prime(entries.values())
+        results = []
+        for id, subreddit in hits:
+            entry = entries.get(id)
+            if entry is None:
+                continue
+            is_post = isinstance(entry, Post)
+            results.append({
+                "id": entry.id,
+                "type": "post" if is_post else "comment",
+                "title": entry.title if is_post else None,
+                "body": entry.body,
+                "author": entry.author.username,
+                "subreddit": subreddit,
+                "upvotes": entry.upvotes,
+                "downvotes": entry.downvotes,
+                "myvote": votes.weight(entry) if votes is not None else 0,
+                "url": url_for('post_ep', subreddit=subreddit, title=entry.title)
+                if is_post else url_for('comment_ep', id=entry.id)
+            })
+        return results, 200, next_link(cursor)
+
+
+@api.resource('/stats', endpoint='stats_ep')
+class StatsResource(Resource):
+    method_decorators = [token_required]
+
+    def get(self):
+        """Cache counters and endpoint timings of this process, for admins only."""
+        if g.user.username not in app.config['ADMINS']:
+            abort(403, message="You are not an admin.")
+        return {
+            "token_cache": token_cache.stats(),
+            "response_cache": response_cache.stats(),
+            "endpoints": instrumentation.stats()
+        }
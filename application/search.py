@@ -0,0 +1,110 @@
+"""
+Full text search over posts and comments.
+entry_search is an sqlite FTS5 table with a row per entry, the entry id is
+its rowid. Posts index their title and body, comments their body, and both
+keep the name of the subreddit they belong to for filtering. Entries are
+indexed in the transaction that creates them and reindex rebuilds it all.
+Search is only available where sqlite was built with FTS5, which is
+probed once per engine; other databases have no FTS5.
+"""
+import weakref
+from sqlalchemy import event
+from . import db, cursors
+
+CREATE = ("CREATE VIRTUAL TABLE IF NOT EXISTS entry_search USING fts5("
+          "title, body, subreddit UNINDEXED)")
+DROP = "DROP TABLE IF EXISTS entry_search"
+# Every post and, below it, all of its comments with the post's subreddit
+REINDEX = """
+    INSERT INTO entry_search (rowid, title, body, subreddit)
+    WITH RECURSIVE thread(id, subreddit) AS (
+        SELECT post.id, subreddit.name FROM post JOIN subreddit ON post.subreddit_id = subreddit.id
+        UNION ALL
+        SELECT entry.id, thread.subreddit FROM entry JOIN thread ON entry.parent_id = thread.id
+    )
+    SELECT entry.id, post.title, entry.body, thread.subreddit
+    FROM thread JOIN entry ON entry.id = thread.id LEFT JOIN post ON post.id = entry.id
+"""
+# Title matches count twice as much as body matches, lower is better
+SEARCH = """
+    SELECT id, subreddit, score FROM (
+        SELECT rowid AS id, subreddit, bm25(entry_search, 2.0, 1.0) AS score
+        FROM entry_search WHERE entry_search MATCH :match {subreddit}
+    ) {after}
+    ORDER BY score, id LIMIT :limit
+"""
+
+
+# Whether each engine has FTS5
+_fts5 = weakref.WeakKeyDictionary()
+
+
+def available(bind=None):
+    """Whether the database of bind, by default the app's, has FTS5."""
+    bind = bind or db.engine
+    if bind.engine not in _fts5:
+        _fts5[bind.engine] = bind.dialect.name == 'sqlite' and any(
+            row[0] == 'ENABLE_FTS5' for row in bind.execute("PRAGMA compile_options"))
+    return _fts5[bind.engine]
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _create(target, connection, **kwargs):
+    if available(connection):
+        connection.execute(CREATE)
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def _drop(target, connection, **kwargs):
+    if available(connection):
+        connection.execute(DROP)
+
+
+def index_entry(entry, subreddit_name):
+    """Adds a new post or comment in subreddit_name to the index."""
+    if not available():
+        return
+    if entry.id is None:
+        db.session.flush()
+    db.session.execute(db.text(
+        "INSERT INTO entry_search (rowid, title, body, subreddit) "
+        "VALUES (:id, :title, :body, :subreddit)"), {
+        'id': entry.id, 'title': getattr(entry, 'title', None),
+        'body': entry.body, 'subreddit': subreddit_name})
+
+
+def reindex():
+    """Rebuilds the whole index from the entry tables, returns the number of entries indexed."""
+    db.session.execute(DROP)
+    db.session.execute(CREATE)
+    db.session.execute(REINDEX)
+    return db.session.execute("SELECT count(*) FROM entry_search").scalar()
+
+
+def match_query(q):
+    """
+    Turns free text into an FTS5 query matching entries with all of its words.
+    Every word is quoted, so the FTS5 query syntax cannot be used to break it.
+    """
+    words = q.split()
+    return " ".join('"{0}"'.format(word.replace('"', '""')) for word in words)
+
+
+def search(q, subreddit=None, limit=25, after=None):
+    """
+    Finds the entries matching every word of q, best match first.
+    Returns (id, subreddit name) pairs and the cursor of the next page.
+    """
+    match = match_query(q)
+    if not match:
+        return [], None
+    params = {'match': match, 'limit': limit + 1, 'subreddit': subreddit}
+    clauses = {'subreddit': "AND subreddit = :subreddit" if subreddit else "", 'after': ""}
+    if after:
+        params['score'], params['id'] = cursors.decode(after, [float, int])
+        clauses['after'] = "WHERE score > :score OR score = :score AND id > :id"
+    rows = db.session.execute(db.text(SEARCH.format(**clauses)), params).fetchall()
+    if len(rows) <= limit:
+        return [(id, name) for id, name, _ in rows], None
+    rows = rows[:limit]
+    return [(id, name) for id, name, _ in rows], cursors.encode(rows[-1][2], rows[-1][0])
@@ -0,0 +1,124 @@
+"""
+Synthetic data for benchmarks and load tests.
+Everything is drawn from a random generator seeded with a fixed seed, so the
+same arguments always give the same users, posts, comment trees and votes.
+Activity is skewed like on a real site: a few subreddits, posts and users get
+most of the posts, comments and votes. Rows are written with bulk inserts and
+the counters, ranks, id sequences and search index are brought up to date
+once at the end.
+"""
+import random
+from bisect import bisect
+from datetime import datetime, timedelta
+from . import db, hashing, migrations, search
+from .models import User, Subreddit, Entry, Post, Vote, subscriptions
+
+WORDS = ("python flask reddit cats dogs music science space games movies books "
+         "coffee bikes code database index query cache vote comment thread news "
+         "photo garden travel food history physics chess linux sqlite").split()
+PASSWORD = "password"
+BATCH = 1000
+
+
+class Picker(object):
+
+    """Picks items at random, the first ones much more often than the last."""
+
+    def __init__(self, rng, items, skew=1.2):
+        self.rng = rng
+        self.items = list(items)
+        self.totals = []
+        total = 0.0
+        for i in range(len(self.items)):
+            total += 1.0 / (i + 1) ** skew
+            self.totals.append(total)
+
+    def pick(self):
+        return self.items[bisect(self.totals, self.rng.random() * self.totals[-1])]
+
+
+def _sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def _insert(table, rows):
+    for start in range(0, len(rows), BATCH):
+        db.session.execute(table.insert(), rows[start:start + BATCH])
+
+
+def seed(users=100, subreddits=10, posts=500, comments=2000, votes=10000, depth=8,
+         seed=0, rounds=4):
+    """
+    Fills an empty database and returns the number of rows made of each kind.
+    Every user's password is "password", hashed with rounds bcrypt rounds.
+    """
+    if db.session.query(User.query.exists()).scalar():
+        raise ValueError("The database already has users, seed needs an empty one.")
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+
+    user_ids = range(1, users + 1)
+    _insert(User.__table__, [
+        {'id': id, 'username': "user{0:05d}".format(id - 1),
+         'password_hash': hashing.hash_password(PASSWORD, rounds)}
+        for id in user_ids])
+    subreddit_ids = range(1, subreddits + 1)
+    _insert(Subreddit.__table__, [{'id': id, 'name': "sub{0:03d}".format(id - 1)} for id in subreddit_ids])
+    popular_subs = Picker(rng, subreddit_ids)
+    rows = []
+    for user_id in user_ids:
+        for sub in sorted(set(popular_subs.pick() for _ in range(rng.randint(1, 5)))):
+            rows.append({'user_id': user_id, 'subreddit_id': sub})
+    _insert(subscriptions, rows)
+
+    # Authors are shuffled so that the most active ones are not simply the first
+    authors = Picker(rng, rng.sample(user_ids, len(user_ids)))
+    entries, post_rows, threads = [], [], []
+    for id in range(1, posts + 1):
+        created = now - timedelta(seconds=rng.randint(0, 30 * 24 * 3600))
+        entries.append({'id': id, 'type': 'post', 'user_id': authors.pick(),
+                        'body': _sentence(rng, rng.randint(5, 40)), 'parent_id': None,
+                        'created': created})
+        post_rows.append({'id': id, 'subreddit_id': popular_subs.pick(),
+                          'title': "{0} {1}".format(_sentence(rng, rng.randint(2, 8)), id)})
+        threads.append([(id, 0, created)])
+    popular_posts = Picker(rng, rng.sample(range(posts), posts))
+    for id in range(posts + 1, posts + comments + 1):
+        thread = threads[popular_posts.pick()]
+        # Replying to the latest comment of a thread is likely, which grows deep chains
+        parent, level, created = thread[-1] if rng.random() < 0.5 else rng.choice(thread)
+        if level >= depth:
+            parent, level, created = thread[0]
+        created = min(now, created + timedelta(seconds=rng.randint(1, 3600)))
+        entries.append({'id': id, 'type': 'entry', 'user_id': authors.pick(),
+                        'body': _sentence(rng, rng.randint(1, 30)), 'parent_id': parent,
+                        'created': created})
+        thread.append((id, level + 1, created))
+    _insert(Entry.__table__, entries)
+    _insert(Post.__table__, post_rows)
+
+    # Authors upvote their own entries, like the api does
+    cast = dict(((e['user_id'], e['id']), 1) for e in entries)
+    popular_entries = Picker(rng, rng.sample(range(len(entries)), len(entries)))
+    voters = Picker(rng, rng.sample(user_ids, len(user_ids)), skew=0.5)
+    bias = [rng.random() for _ in entries]
+    for _ in range(votes * 3):
+        if len(cast) >= votes + len(entries):
+            break
+        i = popular_entries.pick()
+        key = (voters.pick(), entries[i]['id'])
+        if key not in cast:
+            cast[key] = 1 if rng.random() < bias[i] else -1
+    _insert(Vote.__table__, [{'voter_id': voter, 'entry_id': id, 'weight': weight}
+                             for (voter, id), weight in sorted(cast.items())])
+
+    migrations.reset_sequences()
+    Entry.rebuild_counters()
+    User.rebuild_karma()
+    Subreddit.rebuild_subscriber_counts()
+    Post.rerank_all()
+    if search.available():
+        search.reindex()
+    db.session.commit()
+    return {'users': users, 'subreddits': subreddits, 'subscriptions': len(rows),
+            'posts': posts, 'comments': comments, 'votes': len(cast)}
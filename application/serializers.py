@@ -0,0 +1,314 @@
+"""
+Compiled marshaling.
+flask-restful's marshal walks a field dict for every row and calls url_for
+for every Url field. Here each field dict is compiled once into a flat
+function, and url templates are resolved once per endpoint, producing
+exactly what marshal would.
+Anything the fast path does not know about falls back to the field's own output.
+
+Read endpoints take ?fields= and ?expand= to shape their responses, a
+Fieldset is what they ask for: models only load the relations it expands
+and marshal_with only outputs its fields.
+"""
+from collections import OrderedDict
+from functools import wraps
+from flask import g, url_for, _request_ctx_stack
+from flask.ext.restful import fields, marshal
+from flask.ext.restful.utils import unpack
+from werkzeug.routing import UnicodeConverter
+from werkzeug.wrappers import BaseResponse
+from urlparse import urlparse, urlunparse
+from . import app
+from .instrumentation import timed
+
+_compiled = {}  # id of a field dict -> (field dict, serializer, [(key, output)])
+_templates = {}  # (endpoint, script name) -> url template
+
+
+def _make(field):
+    return field() if isinstance(field, type) else field
+
+
+def _url_template(endpoint):
+    """
+    Returns (argument names, url pieces) for endpoint, such that the url is the
+    pieces joined by the quoted arguments. None if the rule is not simple enough.
+    """
+    key = (endpoint, _request_ctx_stack.top.url_adapter.script_name)
+    if key not in _templates:
+        rules = list(app.url_map.iter_rules(endpoint))
+        template = None
+        if len(rules) == 1 and all(type(c) is UnicodeConverter for c in rules[0]._converters.values()):
+            rule = rules[0]
+            names = sorted(rule.arguments)
+            sentinels = dict((name, 'URLARGUMENT{0}SENTINEL'.format(i)) for i, name in enumerate(names))
+            url = urlunparse(("", "", urlparse(url_for(endpoint, **sentinels)).path, "", "", ""))
+            pieces, order = [url], []
+            while True:
+                found = [(pieces[-1].find(s), name) for name, s in sentinels.items() if s in pieces[-1]]
+                if not found:
+                    break
+                index, name = min(found)
+                tail = pieces.pop()
+                pieces.extend([tail[:index], tail[index + len(sentinels[name]):]])
+                order.append(name)
+            if sorted(order) == names:
+                template = (order, pieces, [rule._converters[name] for name in order])
+        _templates[key] = template
+    return _templates[key]
+
+
+def _url(key, field):
+    if field.absolute:
+        return lambda data: field.output(key, data)
+    endpoint = field.endpoint
+
+    def output(data):
+        template = _url_template(endpoint)
+        if template is None or not isinstance(data, dict):
+            return field.output(key, data)
+        names, pieces, converters = template
+        url = [pieces[0]]
+        for name, converter, piece in zip(names, converters, pieces[1:]):
+            value = data.get(name)
+            if value is None:
+                return field.output(key, data)
+            url.append(converter.to_url(value))
+            url.append(piece)
+        return ''.join(url)
+    return output
+
+
+def _list(key, field):
+    container = field.container
+    if type(container) is not fields.Nested or container.attribute is not None:
+        return lambda data: field.output(key, data)
+    serialize = compile_fields(container.nested)
+    default = field.default
+
+    def output(data):
+        value = data.get(key)
+        if value is None:
+            return default
+        if not isinstance(value, (list, tuple)) or None in value:
+            return field.output(key, data)
+        return [serialize(v) for v in value]
+    return output
+
+
+def _scalar(key, field):
+    default = field.default
+    convert = unicode if type(field) is fields.String else int
+
+    def output(data):
+        value = data.get(key)
+        if value is None:
+            return default
+        try:
+            return convert(value)
+        except ValueError:
+            return field.output(key, data)
+    return output
+
+
+def _compile_field(key, field):
+    """Fast output function of one field, None where only the field itself knows how."""
+    if isinstance(field, dict) or hasattr(dict, key) or '.' in key:
+        return None
+    field = _make(field)
+    if field.attribute is not None:
+        return None
+    if type(field) in (fields.String, fields.Integer):
+        return _scalar(key, field)
+    if type(field) is fields.Url:
+        return _url(key, field)
+    if type(field) is fields.List:
+        return _list(key, field)
+    return None
+
+
+def compile_fields(spec):
+    """Returns a function marshaling data with spec, like marshal(data, spec)."""
+    if id(spec) in _compiled:
+        return _compiled[id(spec)][1]
+    outputs = []
+
+    def serialize(data):
+        if isinstance(data, (list, tuple)):
+            return [serialize(d) for d in data]
+        if not isinstance(data, dict):
+            return marshal(data, spec)
+        return OrderedDict([(key, output(data)) for key, output in outputs])
+    # Registered before compiling the fields, so that specs can nest themselves
+    _compiled[id(spec)] = (spec, serialize, outputs)
+    for key, field in spec.items():
+        output = _compile_field(key, field)
+        if output is None:
+            output = _fallback(key, field)
+        outputs.append((key, output))
+    return serialize
+
+
+def _fallback(key, field):
+    if isinstance(field, dict):
+        return lambda data: marshal(data, field)
+    field = _make(field)
+    return lambda data: field.output(key, data)
+
+
+def relations(spec):
+    """The relations of spec, its lists of nested field dicts, by key."""
+    return dict((key, field.container.nested) for key, field in spec.items()
+                if isinstance(field, fields.List) and isinstance(field.container, fields.Nested))
+
+
+class Fieldset(object):
+
+    """
+    The part of a field dict a response shows: its plain fields, all of them
+    unless some are named, and only the relations that are expanded, each
+    with a fieldset of its own. A relation nesting its own field dict, like
+    replies, shares the fieldset and so expands all the way down.
+    """
+
+    def __init__(self, spec, depth=None):
+        self.spec = spec
+        self.fields = None  # plain fields shown, None for all
+        self.relations = {}  # expanded relation -> its Fieldset
+        self.depth = depth  # levels of the comment trees expanded, None for the default
+
+    def expands(self, key):
+        return key in self.relations
+
+    def shows(self, key):
+        if key in self.relations:
+            return True
+        if key not in self.spec or key in relations(self.spec):
+            return False
+        return self.fields is None or key in self.fields
+
+    def __getitem__(self, key):
+        return self.relations[key]
+
+    def expand(self, key):
+        """Expands the relation key, returns its fieldset."""
+        nested = relations(self.spec).get(key)
+        if nested is None:
+            raise ValueError("{0} is not something that can be expanded.".format(key))
+        if key not in self.relations:
+            self.relations[key] = self if nested is self.spec else Fieldset(nested, self.depth)
+        return self.relations[key]
+
+    def show(self, key):
+        if key in relations(self.spec):
+            self.expand(key)
+        elif key in self.spec:
+            self.fields = (self.fields or set()) | set([key])
+        else:
+            raise ValueError("{0} is not a field.".format(key))
+
+
+def fieldset(spec, expand=None, fields=None, depth=None):
+    """
+    Builds the Fieldset of spec from comma separated dotted paths, like
+    "posts.comments" for expand and "title,posts.url" for fields, naming a
+    relation in fields expands it. Raises ValueError on anything not in spec.
+    depth is how many levels of comments the expanded comment trees show.
+    """
+    root = Fieldset(spec, depth)
+    for path in _paths(expand):
+        node = root
+        for key in path:
+            node = node.expand(key)
+    for path in _paths(fields):
+        node = root
+        for key in path[:-1]:
+            node = node.expand(key)
+        node.show(path[-1])
+    return root
+
+
+def _paths(value):
+    return [path.strip().split('.') for path in (value or '').split(',') if path.strip()]
+
+
+def expands(view, key):
+    """Whether view expands the relation key, a view of None expands everything."""
+    return view is None or view.expands(key)
+
+
+def shows(view, key):
+    """Whether view shows the field key, a view of None shows everything."""
+    return view is None or view.shows(key)
+
+
+def nested(view, key):
+    """The view of the relation key, None for everything."""
+    return None if view is None else view[key]
+
+
+def compile_fieldset(view, _serializers=None):
+    """Returns a function marshaling data with only the part of view.spec in view."""
+    _serializers = {} if _serializers is None else _serializers
+    if id(view) in _serializers:
+        return _serializers[id(view)]
+    compile_fields(view.spec)
+    selected = []
+
+    def serialize(data):
+        if isinstance(data, (list, tuple)):
+            return [serialize(d) for d in data]
+        if not isinstance(data, dict):
+            return marshal(data, view.spec)  # Objects are marshaled in full
+        return OrderedDict([(key, output(data)) for key, output in selected])
+    _serializers[id(view)] = serialize
+    for key, output in _compiled[id(view.spec)][2]:
+        if view.expands(key):
+            output = _relation(key, compile_fieldset(view[key], _serializers))
+        elif not view.shows(key):
+            continue
+        selected.append((key, output))
+    return serialize
+
+
+def _relation(key, serialize):
+    def output(data):
+        value = data.get(key)
+        return None if value is None else [serialize(v) for v in value]
+    return output
+
+
+class marshal_with(object):
+    """
+    Drop in replacement for flask-restful's marshal_with using compiled fields.
+    A handler that sets g.fieldset to a Fieldset of these fields gets only that part.
+    """
+
+    def __init__(self, fields, envelope=None):
+        self.fields = fields
+        self.envelope = envelope
+
+    def __call__(self, f):
+        serialize = compile_fields(self.fields)
+
+        def apply(data):
+            view = g.fieldset
+            with timed('serialize'):
+                if view is not None and view.spec is self.fields:
+                    data = compile_fieldset(view)(data)
+                else:
+                    data = serialize(data)
+            return OrderedDict([(self.envelope, data)]) if self.envelope else data
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            g.fieldset = None
+            resp = f(*args, **kwargs)
+            if isinstance(resp, BaseResponse):
+                # Already serialized, streamed listings for instance
+                return resp
+            if isinstance(resp, tuple):
+                data, code, headers = unpack(resp)
+                return apply(data), code, headers
+            return apply(resp)
+        return wrapper
@@ -0,0 +1,241 @@
+"""
+Pre-fork WSGI server, run by manage.py serve.
+The parent process binds the listening socket, brings the schema up to date
+and then forks the workers, which all accept connections on that one socket
+and serve them on a fixed pool of threads. Each worker has its own
+interpreter, so every core gets used.
+
+A worker leaves after about max_requests requests and the parent starts a
+fresh one, which bounds the cost of anything leaking. Signals to the parent:
+HUP reloads gracefully: the parent re-executes itself, keeping the socket
+open so no connection is refused, and the old workers finish the requests
+they have before exiting. TERM and INT stop the same way.
+
+Caches live in each worker, and a write would only invalidate the cached
+responses of the worker that served it while the others served theirs, and
+their ETags, for RESPONSE_CACHE_TTL. So does the write-behind vote queue,
+and a voter served by another worker would not see their queued votes. With
+more than one worker the response cache and VOTE_WRITE_BEHIND are therefore
+turned off.
+"""
+import errno
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import time
+from Queue import Queue
+from threading import Thread
+from werkzeug.serving import BaseWSGIServer
+from . import db, migrations
+from .httpcache import response_cache
+from .votequeue import queue as vote_queue
+
+LISTEN_FD = 'SERVE_LISTEN_FD'
+
+
+def _log(message, *args):
+    sys.stderr.write("[{0}] {1}\n".format(os.getpid(), message.format(*args)))
+
+
+def _interrupted(error):
+    return error.args and error.args[0] == errno.EINTR
+
+
+class WorkerServer(BaseWSGIServer):
+
+    """Serves connections from a shared listening socket on a pool of threads."""
+
+    multithread = True
+    multiprocess = True
+
+    def __init__(self, listener, app, threads, max_requests):
+        self.listener = listener
+        self.threads = threads
+        self.max_requests = max_requests
+        self.handled = 0
+        self.running = True
+        # Only as many connections are taken as there are threads, the rest
+        # stay queued on the socket for the other workers
+        self.connections = Queue(threads)
+        host, port = listener.getsockname()[:2]
+        BaseWSGIServer.__init__(self, host, port, app)
+
+    def server_bind(self):
+        self.socket.close()
+        self.socket = self.listener
+        host, port = self.socket.getsockname()[:2]
+        self.server_address = (host, port)
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+
+    def server_activate(self):
+        pass  # The parent listens already
+
+    def process_request(self, request, client_address):
+        self.handled += 1
+        self.connections.put((request, client_address))
+
+    def _work(self):
+        while True:
+            connection = self.connections.get()
+            if connection is None:
+                return
+            request, client_address = connection
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def stop(self, *args):
+        self.running = False
+
+    def serve(self):
+        """
+        Serves until stopped or recycled, then finishes the requests in flight
+        and writes the votes still queued.
+        """
+        workers = [Thread(target=self._work) for _ in range(self.threads)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        while self.running and not (self.max_requests and self.handled >= self.max_requests):
+            try:
+                ready = select.select([self.socket], [], [], 0.5)[0]
+            except select.error as error:
+                if not _interrupted(error):
+                    raise
+                continue
+            if ready:
+                self._handle_request_noblock()
+        for worker in workers:
+            self.connections.put(None)
+        for worker in workers:
+            worker.join()
+        # Votes the worker still holds would be lost with it
+        with self.app.app_context():
+            vote_queue.flush()
+
+
+class Arbiter(object):
+
+    """The parent process, keeps workers running on the listening socket."""
+
+    def __init__(self, app, host, port, workers, threads, max_requests, graceful_timeout):
+        self.app = app
+        self.address = (host, port)
+        self.workers = workers
+        self.threads = threads
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.pids = set()
+        self.signal = None
+
+    def listen(self):
+        """Binds the socket, or picks up the one the previous parent left on reload."""
+        fd = os.environ.pop(LISTEN_FD, None)
+        if fd is not None:
+            listener = socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+            os.close(int(fd))
+        else:
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind(self.address)
+            listener.listen(BaseWSGIServer.request_queue_size)
+        # Workers all wait on it, the ones that lose the race must not block
+        listener.setblocking(False)
+        return listener
+
+    def run(self):
+        self.listener = self.listen()
+        with self.app.app_context():
+            migrations.upgrade()
+            db.session.remove()
+        if self.workers > 1 and response_cache.maxsize:
+            response_cache.maxsize = 0
+            _log("The response cache is off, its invalidations cannot reach {0} workers", self.workers)
+        if self.workers > 1 and self.app.config['VOTE_WRITE_BEHIND']:
+            self.app.config['VOTE_WRITE_BEHIND'] = False
+            _log("Write-behind voting is off, its queue cannot be shared by {0} workers", self.workers)
+        # Connections must not be shared with the workers
+        db.engine.dispose()
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.handle_signal)
+        _log("Listening on http://{0}:{1} with {2} workers of {3} threads",
+             self.address[0], self.listener.getsockname()[1], self.workers, self.threads)
+        while self.signal is None:
+            self.reap()
+            while len(self.pids) < self.workers:
+                self.spawn()
+            time.sleep(0.5)
+        if self.signal == signal.SIGHUP:
+            self.reload()
+        self.stop()
+
+    def handle_signal(self, signum, frame):
+        self.signal = signum
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.pids.add(pid)
+            return
+        status = 0
+        try:
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            max_requests = self.max_requests
+            if max_requests:
+                # So that workers do not all recycle at once
+                max_requests += random.randint(0, max_requests // 10)
+            server = WorkerServer(self.listener, self.app, self.threads, max_requests)
+            signal.signal(signal.SIGTERM, server.stop)
+            signal.signal(signal.SIGINT, server.stop)
+            server.serve()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.ECHILD:
+                    return
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            if not pid:
+                return
+            self.pids.discard(pid)
+
+    def reload(self):
+        """Starts over with freshly loaded code, on the same socket."""
+        _log("Reloading")
+        for pid in self.pids:
+            os.kill(pid, signal.SIGTERM)
+        os.environ[LISTEN_FD] = str(self.listener.fileno())
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def stop(self):
+        _log("Stopping")
+        for pid in self.pids:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.time() + self.graceful_timeout
+        while self.pids and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in self.pids:
+            os.kill(pid, signal.SIGKILL)
+        self.listener.close()
+
+
+def serve(app, host, port, workers, threads, max_requests, graceful_timeout):
+    Arbiter(app, host, port, workers, threads, max_requests, graceful_timeout).run()
@@ -0,0 +1,30 @@
+"""
+Streaming listings.
+Instead of building the whole list before encoding it, rows are read from a
+server side cursor a batch at a time and each one is encoded and sent as soon
+as it is serialized. Memory stays flat and the first byte goes out right away
+however long the listing is.
+"""
+import json
+from flask import Response, stream_with_context
+from . import app
+from .serializers import Fieldset, compile_fields, compile_fieldset
+
+
+def stream_json(query, to_dict, spec):
+    """
+    Response streaming every row of query as a JSON array.
+    Each row goes through to_dict and is then marshaled with spec,
+    a field dict or a Fieldset of one.
+    """
+    serialize = compile_fieldset(spec) if isinstance(spec, Fieldset) else compile_fields(spec)
+    batch = app.config['STREAM_BATCH_SIZE']
+
+    def generate():
+        yield '['
+        separator = ''
+        for row in query.yield_per(batch):
+            yield separator + json.dumps(serialize(to_dict(row)))
+            separator = ','
+        yield ']'
+    return Response(stream_with_context(generate()), mimetype='application/json')
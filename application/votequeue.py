@@ -0,0 +1,168 @@
+"""
+Write-behind voting, on when VOTE_WRITE_BEHIND is set.
+Votes are queued in the worker process instead of being written by the
+request, coalesced per voter and entry so only the last one counts, and
+written in one transaction per batch: the vote rows with executemany, then
+the counters and karma moved once per entry and author, and the ranks of
+the posts involved. A batch goes out every VOTE_FLUSH_INTERVAL seconds from
+a background thread, or as soon as VOTE_FLUSH_SIZE votes are waiting.
+
+Until its batch is committed a vote is only known to the worker holding it:
+VoteMap reads through the queue, so the voter sees their own vote right away
+when served by the same worker, while counters catch up on the flush. The
+pre-fork server turns it off when it runs more than one worker.
+"""
+import os
+from threading import Event, Lock, Thread
+from . import app, db
+from .httpcache import invalidate
+from .models import User, Entry, Post, Vote
+
+REMOVED = 0  # Weight queued to delete a vote
+
+
+class VoteQueue(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = {}  # (voter id, entry id) -> weight
+        self.flushing = {}  # the batch being written, still visible to readers
+        self.wakeup = Event()
+        self.pid = None
+
+    def put(self, voter, entry_id, weight):
+        """Queues voter's vote on an entry, replacing any vote they queued on it before."""
+        with self.lock:
+            self.pending[(voter, entry_id)] = weight
+            full = len(self.pending) >= app.config['VOTE_FLUSH_SIZE']
+        if app.config['VOTE_FLUSH_INTERVAL']:
+            self._start()
+            if full:
+                self.wakeup.set()
+        elif full:
+            self.flush()
+
+    def get(self, voter, entry_id):
+        """Returns the weight of voter's queued vote on an entry, None if they queued none."""
+        key = (voter, entry_id)
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            return self.flushing.get(key)
+
+    def overlay(self, voter):
+        """Returns the queued weights of one voter by entry id."""
+        with self.lock:
+            weights = dict((e, w) for (v, e), w in self.flushing.items() if v == voter)
+            weights.update((e, w) for (v, e), w in self.pending.items() if v == voter)
+            return weights
+
+    def __len__(self):
+        with self.lock:
+            return len(self.pending)
+
+    def flush(self):
+        """
+        Writes the queued votes, returns how many there were. On failure the
+        votes are logged and queued again, under any newer ones.
+        """
+        with self.lock:
+            if self.flushing:
+                return 0  # Another thread is at it
+            self.flushing, self.pending = self.pending, {}
+            batch = self.flushing
+        if not batch:
+            return 0
+        try:
+            tags = _write(batch)
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Writing %d queued votes failed, requeued", len(batch))
+            with self.lock:
+                for key, weight in batch.items():
+                    self.pending.setdefault(key, weight)
+            return 0
+        finally:
+            with self.lock:
+                self.flushing = {}
+        invalidate(*tags)
+        return len(batch)
+
+    def _start(self):
+        """Starts the flushing thread, again in a forked worker."""
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(app.config['VOTE_FLUSH_INTERVAL'])
+            self.wakeup.clear()
+            with app.app_context():
+                self.flush()
+
+
+def _write(batch):
+    """Applies a batch of votes in one transaction, returns the cache tags they change."""
+    vote, entry = Vote.__table__, Entry.__table__
+    voters = set(v for v, _ in batch)
+    entry_ids = set(e for _, e in batch)
+    old = dict(((v, e), w) for v, e, w in db.session.query(
+        Vote.voter_id, Vote.entry_id, Vote.weight).filter(
+        Vote.entry_id.in_(entry_ids), Vote.voter_id.in_(voters)))
+    # Votes on entries deleted in the meantime are dropped
+    authors = dict(db.session.query(Entry.id, Entry.user_id).filter(Entry.id.in_(entry_ids)))
+    inserts, updates, deletes = [], [], []
+    counters, karma = {}, {}
+    for (voter, entry_id), weight in batch.items():
+        before = old.get((voter, entry_id), REMOVED)
+        if weight == before or entry_id not in authors:
+            continue
+        key = {'_voter': voter, '_entry': entry_id}
+        if before == REMOVED:
+            inserts.append({'voter_id': voter, 'entry_id': entry_id, 'weight': weight})
+        elif weight == REMOVED:
+            deletes.append(key)
+        else:
+            updates.append(dict(key, _weight=weight))
+        up, down, score = counters.get(entry_id, (0, 0, 0))
+        counters[entry_id] = (up + (weight == 1) - (before == 1),
+                              down + (weight == -1) - (before == -1),
+                              score + weight - before)
+        karma[authors[entry_id]] = karma.get(authors[entry_id], 0) + weight - before
+    if not counters:
+        return []
+    voter_is = db.and_(vote.c.voter_id == db.bindparam('_voter'),
+                       vote.c.entry_id == db.bindparam('_entry'))
+    if inserts:
+        db.session.execute(vote.insert(), inserts)
+    if updates:
+        db.session.execute(vote.update().where(voter_is).values(weight=db.bindparam('_weight')), updates)
+    if deletes:
+        db.session.execute(vote.delete().where(voter_is), deletes)
+    db.session.execute(entry.update().where(entry.c.id == db.bindparam('_id')).values(
+        upvotes=entry.c.upvotes + db.bindparam('_up'),
+        downvotes=entry.c.downvotes + db.bindparam('_down'),
+        score=entry.c.score + db.bindparam('_score')),
+        [{'_id': i, '_up': u, '_down': d, '_score': s} for i, (u, d, s) in counters.items()])
+    karma = [{'_user': u, '_karma': k} for u, k in karma.items() if k]
+    if karma:
+        user = User.__table__
+        db.session.execute(user.update().where(user.c.id == db.bindparam('_user')).values(
+            karma=user.c.karma + db.bindparam('_karma')), karma)
+    tags = []
+    # The entries may be in the session already, with the counters from before
+    for changed in Entry.query.with_polymorphic([Post]).populate_existing().filter(
+            Entry.id.in_(counters.keys())):
+        if isinstance(changed, Post):
+            changed.rerank()
+        tags.extend(changed.vote_tags())
+    db.session.commit()
+    return tags
+
+
+queue = VoteQueue()
@@ -2,6 +2,72 @@
 Configuration for our flask application.
 Variables defined here will be accessible through the app.config dictionary.
 """
+import os
+
 DEBUG = False
 SECRET_KEY = "123?"
-SQLALCHEMY_DATABASE_URI = "sqlite:///flaskReddit.db"
\ No newline at end of file
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', "sqlite:///flaskReddit.db")
+# "sqlite" for a local file database, "server" for postgres and friends
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', "sqlite")
+# Set on every sqlite connection, WAL lets readers run alongside a writer
+SQLITE_PRAGMAS = [
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("busy_timeout", 5000),
+    ("mmap_size", 268435456)
+]
+SERVER_POOL_SIZE = 10
+SERVER_MAX_OVERFLOW = 20
+SERVER_POOL_RECYCLE = 3600
+SERVER_PRE_PING = True
+# How much of a comment tree is loaded at once, deeper or wider threads get
+# continuation links.
+COMMENT_TREE_DEPTH = 10
+COMMENT_TREE_LIMIT = 100
+# Comment trees expanded within listings are shallower, clients may ask for
+# deeper ones with depth.
+EXPANDED_COMMENT_DEPTH = 1
+EXPANDED_COMMENT_LIMIT = 10
+# Listings are paginated, clients may ask for up to MAX_PAGE_SIZE rows
+PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+# Verified auth tokens are cached so that requests skip the signature check
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 300
+# Usernames allowed to read the /stats endpoint
+ADMINS = []
+# bcrypt work factor, existing hashes are upgraded when their owner logs in
+BCRYPT_LOG_ROUNDS = 12
+# Worker processes hashing passwords, 0 hashes on the request thread,
+# and how many hashing jobs may queue up before we answer 503
+HASH_POOL_SIZE = 2
+HASH_QUEUE_DEPTH = 16
+# Cached read responses, a size of 0 turns the cache off, as the pre-fork
+# server does with more than one worker
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_TTL = 60
+# Rows fetched per round trip when a listing is streamed
+STREAM_BATCH_SIZE = 500
+# Rows per insert and per fetch of manage.py import and export
+IMPORT_BATCH_SIZE = 5000
+# Per request SQL and timing instrumentation, adds X-Query-Count and
+# Server-Timing headers and logs requests slower than SLOW_REQUEST_MS
+# with their SLOW_REQUEST_STATEMENTS slowest statements
+INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '') == '1'
+SLOW_REQUEST_MS = 500
+SLOW_REQUEST_STATEMENTS = 10
+# Write-behind voting: votes are answered with 202, queued in the worker and
+# written in batches every VOTE_FLUSH_INTERVAL seconds or as soon as
+# VOTE_FLUSH_SIZE are waiting. An interval of 0 writes only once the size
+# is reached, on the request thread. Only for a single worker process, see
+# application/server.py.
+VOTE_WRITE_BEHIND = os.environ.get('VOTE_WRITE_BEHIND', '') == '1'
+VOTE_FLUSH_INTERVAL = 1.0
+VOTE_FLUSH_SIZE = 500
+# manage.py serve: worker processes (0 for one per cpu), threads per worker,
+# requests after which a worker is replaced (0 for never), and the seconds
+# workers get to finish their requests when stopping
+SERVE_WORKERS = 0
+SERVE_THREADS = 8
+SERVE_MAX_REQUESTS = 1000
+SERVE_GRACEFUL_TIMEOUT = 30
@@ -1,10 +1,16 @@
+import sys
 import urllib
 from flask import url_for
-from flask.ext.script import Manager, Shell
+from flask.ext.script import Command, Manager, Option, Shell
 from application import app, db
 from application.resources import *
+from application.models import Entry, User, Post, Subreddit
+from application import migrations, queryplans, search
+from datetime import datetime, timedelta
 
 manager = Manager(app)
+counters = Manager(usage="Check or rebuild the denormalized vote and subscriber counters.")
+migrate = Manager(usage="Upgrade the database schema.")
 
 def _make_context():
     """Returns app context of shell"""
@@ -12,13 +18,76 @@ def _make_context():
 
 
 manager.add_command("shell", Shell(make_context=_make_context))
+manager.add_command("counters", counters)
+manager.add_command("migrate", migrate)
+
+
+class Import(Command):
+    """Loads a JSONL dump into the database, see application/dump.py."""
+
+    option_list = (
+        Option('-f', '--file', dest='path', default='-', help="Dump to read, - for stdin"),
+        Option('-b', '--batch', dest='batch', type=int, default=None,
+               help="Rows per insert, IMPORT_BATCH_SIZE by default"),
+    )
+
+    def run(self, path, batch):
+        from application import dump
+        migrations.upgrade()
+        lines = sys.stdin if path == '-' else open(path)
+        try:
+            counts = dump.load(lines, batch)
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        print >> sys.stderr, ", ".join("{0} {1}".format(n, kind) for kind, n in sorted(counts.items()))
+
+
+class Export(Command):
+    """Writes the database out as a JSONL dump, see application/dump.py."""
+
+    option_list = (
+        Option('-f', '--file', dest='path', default='-', help="Dump to write, - for stdout"),
+        Option('-b', '--batch', dest='batch', type=int, default=None,
+               help="Rows per fetch, IMPORT_BATCH_SIZE by default"),
+    )
+
+    def run(self, path, batch):
+        from application import dump
+        out = sys.stdout if path == '-' else open(path, 'w')
+        try:
+            counts = dump.dump(out, batch)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        print >> sys.stderr, ", ".join("{0} {1}".format(n, kind) for kind, n in sorted(counts.items()))
+
+
+manager.add_command("import", Import())
+manager.add_command("export", Export())
 
 @manager.command
 def run():
     """Runs the development server."""
-    db.create_all()
+    migrations.upgrade()
     app.run(use_reloader=True, threaded=True, host='0.0.0.0', port=8080)
 
+@manager.option('-H', '--host', dest='host', default='0.0.0.0')
+@manager.option('-p', '--port', dest='port', type=int, default=8080)
+@manager.option('-w', '--workers', dest='workers', type=int, default=None)
+@manager.option('-t', '--threads', dest='threads', type=int, default=None)
+@manager.option('--max-requests', dest='max_requests', type=int, default=None)
+def serve(host, port, workers, threads, max_requests):
+    """Runs the pre-fork production server, see application/server.py."""
+    from multiprocessing import cpu_count
+    from application import server
+    config = app.config
+    server.serve(app, host, port,
+                 workers or config['SERVE_WORKERS'] or cpu_count(),
+                 threads or config['SERVE_THREADS'],
+                 config['SERVE_MAX_REQUESTS'] if max_requests is None else max_requests,
+                 config['SERVE_GRACEFUL_TIMEOUT'])
+
 @manager.command
 def routes():
     """Display application routes."""
@@ -38,5 +107,113 @@ def routes():
     for line in sorted(output):
         print line
 
+@counters.command
+def check():
+    """Lists entries, users and subreddits whose counters disagree with the rows they count."""
+    drift = Entry.counter_drift()
+    for id, up, real_up, down, real_down in drift:
+        print "entry {0}: upvotes {1}/{2} downvotes {3}/{4}".format(
+            id, up, real_up, down, real_down)
+    karma_drift = User.karma_drift()
+    for username, karma, real_karma in karma_drift:
+        print "user {0}: karma {1}/{2}".format(username, karma, real_karma)
+    subscriber_drift = Subreddit.subscriber_drift()
+    for name, count, real_count in subscriber_drift:
+        print "subreddit {0}: subscribers {1}/{2}".format(name, count, real_count)
+    print "{0} entries, {1} users and {2} subreddits out of sync".format(
+        len(drift), len(karma_drift), len(subscriber_drift))
+    if drift or karma_drift or subscriber_drift:
+        sys.exit(1)
+
+@counters.command
+def rebuild():
+    """Recomputes all vote counters, karma and subscriber counts."""
+    Entry.rebuild_counters()
+    User.rebuild_karma()
+    Subreddit.rebuild_subscriber_counts()
+    db.session.commit()
+    print "Rebuilt vote and subscriber counters"
+
+@manager.option('-d', '--days', dest='days', type=int, default=None,
+                help="Only rerank posts from the last DAYS days")
+def rerank(days):
+    """Recomputes the stored feed ranks of posts, run it from cron."""
+    since = datetime.utcnow() - timedelta(days=days) if days else None
+    count = Post.rerank_all(since)
+    db.session.commit()
+    print "Reranked {0} posts".format(count)
+
+@manager.command
+def reindex():
+    """Rebuilds the full text search index of posts and comments."""
+    if not search.available():
+        print "Search needs sqlite"
+        sys.exit(1)
+    count = search.reindex()
+    db.session.commit()
+    print "Indexed {0} entries".format(count)
+
+@manager.option('--users', dest='users', type=int, default=100)
+@manager.option('--subreddits', dest='subreddits', type=int, default=10)
+@manager.option('--posts', dest='posts', type=int, default=500)
+@manager.option('--comments', dest='comments', type=int, default=2000)
+@manager.option('--votes', dest='votes', type=int, default=10000)
+@manager.option('--depth', dest='depth', type=int, default=8, help="Deepest comment level")
+@manager.option('--seed', dest='random_seed', type=int, default=0,
+                help="Random seed, the same seed gives the same data")
+def seed(users, subreddits, posts, comments, votes, depth, random_seed):
+    """Fills an empty database with synthetic data, see application/seed.py."""
+    from application import seed
+    migrations.upgrade()
+    counts = seed.seed(users, subreddits, posts, comments, votes, depth, random_seed)
+    print ", ".join("{0} {1}".format(n, kind) for kind, n in sorted(counts.items()))
+
+@manager.option('-r', '--repeat', dest='repeat', type=int, default=5)
+@manager.option('--no-latency', dest='latency', action='store_false', default=True,
+                help="Only check the SQL statement budgets")
+def bench(repeat, latency):
+    """Times every endpoint and checks its SQL statement and latency budgets."""
+    from application import benchmark
+    results = benchmark.run(repeat=repeat)
+    failed = benchmark.failures(results, latency)
+    print "{0:15s} {1:>6s} {2:>13s} {3:>17s}".format("endpoint", "status", "queries", "ms")
+    for r in results:
+        print "{0:15s} {1:6d} {2:6d} / {3:<4d} {4:8.1f} / {5:<6d}{6}".format(
+            r['name'], r['status'], r['queries'], r['query_budget'], r['ms'], r['ms_budget'],
+            " FAIL" if r in failed else "")
+    if failed:
+        sys.exit(1)
+
+@migrate.option('-v', '--version', dest='version', type=int, default=None,
+                help="Stop at VERSION instead of the latest version")
+def upgrade(version):
+    """Applies the pending migrations."""
+    for name in migrations.upgrade(version):
+        print "Applied {0}".format(name)
+    print "Database is at version {0}".format(migrations.current())
+
+@migrate.command
+def current():
+    """Shows the schema version of the database."""
+    print "Database is at version {0} of {1}".format(migrations.current(), migrations.head())
+
+@migrate.option('-v', '--version', dest='version', type=int, default=None,
+                help="Version to record, the latest version by default")
+def stamp(version):
+    """Records a version as applied without running migrations."""
+    migrations.stamp(migrations.head() if version is None else version)
+    print "Database is at version {0}".format(migrations.current())
+
+@manager.command
+def plans():
+    """Fails if a hot query does a full table scan, sqlite only."""
+    with app.test_request_context():
+        scans = queryplans.full_scans()
+    for name, line in scans:
+        print "{0}: {1}".format(name, line)
+    print "{0} full table scans".format(len(scans))
+    if scans:
+        sys.exit(1)
+
 if __name__ == "__main__":
     manager.run()
\ No newline at end of file
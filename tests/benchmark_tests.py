@@ -0,0 +1,112 @@
+"""
+Seed, dump and benchmark tests, on a small seeded database.
+"""
+import base64
+import json
+from application import api, db
+from application.resources import *
+from StringIO import StringIO
+from application import seed, benchmark, dump, hashing
+from application.models import User, Subreddit, Entry, Vote
+
+
+class TestBenchmark(object):
+
+    def setUp(self):
+        api.app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+        api.app.config['TESTING'] = True
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def make(self, random_seed=0):
+        return seed.seed(users=20, subreddits=4, posts=50, comments=200, votes=400,
+                         depth=5, seed=random_seed)
+
+    def snapshot(self):
+        entries = db.session.query(Entry.id, Entry.user_id, Entry.parent_id, Entry.body,
+                                   Entry.upvotes, Entry.downvotes).order_by(Entry.id).all()
+        votes = db.session.query(Vote.voter_id, Vote.entry_id, Vote.weight).order_by(
+            Vote.voter_id, Vote.entry_id).all()
+        return entries, votes
+
+    def testSeedIsReproducible(self):
+        counts = self.make()
+        assert counts['posts'] == 50 and counts['comments'] == 200
+        assert counts['votes'] == 650
+        first = self.snapshot()
+        assert Entry.counter_drift() == [] and User.karma_drift() == []
+        hashes = [h for h, in db.session.query(User.password_hash)]
+        assert len(set(hashes)) == 20
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        self.make()
+        assert self.snapshot() == first
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        self.make(random_seed=1)
+        assert self.snapshot() != first
+
+    def testCreateAfterSeed(self):
+        self.make()
+        client = api.app.test_client()
+        assert client.post('/users', data={"username": "newcomer", "password": "12345678"}).status_code == 201
+        x_auth = base64.b64encode("newcomer:12345678")
+        headers = {"X-Auth-Token": json.loads(client.post('/tokens', headers={'X-Auth': x_auth}).data)['token']}
+        assert client.post('/subreddits', data={"name": "newsub"}, headers=headers).status_code == 201
+        response = client.post('/r/newsub', data={"title": "A new post", "body": "After the seeded ones."},
+                               headers=headers)
+        assert response.status_code == 200
+        assert int(json.loads(response.data)['id']) == 251
+
+    def testDumpRoundTrip(self):
+        self.make()
+        first = self.snapshot()
+        out = StringIO()
+        counts = dump.dump(out, batch=7)
+        assert counts['post'] == 50 and counts['vote'] == 650
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        out.seek(0)
+        assert dump.load(out, batch=7) == counts
+        assert self.snapshot() == first
+        assert Entry.counter_drift() == [] and User.karma_drift() == []
+        assert Subreddit.subscriber_drift() == []
+        assert out.getvalue() == ''.join(dump.json.dumps(r, sort_keys=True) + '\n' for r in dump.records())
+
+    def testImportPassword(self):
+        dump.load(['{"kind": "user", "username": "ann", "password": "secret"}', ''])
+        assert hashing.check_password(User.query.filter_by(username='ann').one().password_hash, 'secret')
+        try:
+            dump.load(['{"kind": "group", "name": "x"}'])
+            assert False, "bad record accepted"
+        except ValueError as error:
+            assert 'Line 1' in str(error)
+
+    def testImportVotes(self):
+        lines = ['{"kind": "user", "username": "ann", "password_hash": "x"}',
+                 '{"kind": "post", "id": 1, "author": "ann", "subreddit": null, "title": "t", "body": "b"}']
+        dump.load(lines + ['{"kind": "vote", "voter": "ann", "entry": 1, "weight": -1}'])
+        assert [r['weight'] for r in dump.records() if r['kind'] == 'vote'] == [-1]
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        try:
+            dump.load(lines + ['{"kind": "vote", "voter": "ann", "entry": 1, "weight": 0}'])
+            assert False, "vote of no weight accepted"
+        except ValueError as error:
+            assert 'Line 3' in str(error)
+
+    def testBudgets(self):
+        self.make()
+        results = benchmark.run(repeat=1)
+        assert len(results) == len(benchmark.BUDGETS)
+        assert benchmark.failures(results, latency=False) == []
+        # A blown budget is reported
+        budgets = [('users', 'GET', '/users', None, 0, 1000)]
+        assert [r['name'] for r in benchmark.failures(benchmark.run(budgets, repeat=1))] == ['users']
@@ -0,0 +1,97 @@
+"""
+Engine profile tests, run against a local file database.
+"""
+import base64
+import json
+import os
+import shutil
+import tempfile
+from application import api, db
+from application.resources import *
+
+
+class TestEngineProfiles(object):
+
+    def setUp(self):
+        """Creates a file database for each test"""
+        self.directory = tempfile.mkdtemp()
+        api.app.config['TESTING'] = True
+        self.app = api.app.test_client()
+
+    def tearDown(self):
+        """Remove the database file"""
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        api.app.config['DATABASE_PROFILE'] = "sqlite"
+        api.app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+        shutil.rmtree(self.directory)
+
+    def use(self, profile):
+        api.app.config['DATABASE_PROFILE'] = profile
+        api.app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.path.join(
+            self.directory, profile + ".db")
+        db.create_all()
+
+    def register(self):
+        post_data = {
+            "username": "Some User",
+            "password": "12345678"
+        }
+        response = self.app.post('/users', data=post_data)
+        assert response.status_code == 201
+        response = self.app.get('/users')
+        assert len(json.loads(response.data)) == 1
+
+    def testSqliteProfile(self):
+        self.use("sqlite")
+        self.register()
+        assert db.session.execute("PRAGMA journal_mode").scalar() == "wal"
+        assert db.session.execute("PRAGMA synchronous").scalar() == 1
+        assert db.session.execute("PRAGMA busy_timeout").scalar() == 5000
+
+    def testServerProfile(self):
+        from sqlalchemy.pool import QueuePool
+        self.use("server")
+        pool = db.engine.pool
+        assert isinstance(pool, QueuePool)
+        assert pool.size() == api.app.config['SERVER_POOL_SIZE']
+        self.register()
+        db.session.remove()
+        # A connection that died in the pool is replaced on checkout
+        connection = db.engine.raw_connection()
+        connection.connection.close()
+        connection.close()
+        response = self.app.get('/users')
+        assert response.status_code == 200
+        assert db.session.execute("PRAGMA journal_mode").scalar() != "wal"
+
+    def testConcurrentVotes(self):
+        from threading import Event, Thread
+        from application.models import User, Entry
+        self.use("server")
+        self.register()
+        x_auth = base64.b64encode("Some User:12345678")
+        headers = {"X-Auth-Token": json.loads(self.app.post('/tokens', headers={'X-Auth': x_auth}).data)['token']}
+        self.app.post('/subreddits', data={"name": "funny"}, headers=headers)
+        rdata = json.loads(self.app.post('/r/funny', data={"title": "Vote on me", "body": "Two at once."},
+                                         headers=headers).data)
+        db.session.remove()
+        # The same voter from two sessions at once, as two workers would
+        for weight in (-1, 1, -1, 0):
+            start, statuses = Event(), []
+
+            def vote():
+                client = api.app.test_client()
+                start.wait()
+                statuses.append(client.put(rdata['vote_url'], data={"weight": weight},
+                                           headers=headers).status_code)
+            threads = [Thread(target=vote) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+            assert statuses == [200, 200]
+            db.session.remove()
+            assert Entry.counter_drift() == [] and User.karma_drift() == []
@@ -0,0 +1,83 @@
+"""
+Instrumentation tests
+"""
+import base64
+import json
+import logging
+from application import api, db, instrumentation
+from application.resources import *
+from application.models import User
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestInstrumentation(object):
+
+    def setUp(self):
+        api.app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+        api.app.config['TESTING'] = True
+        api.app.config['INSTRUMENTATION'] = True
+        api.app.config['ADMINS'] = ['admin']
+        self.app = api.app.test_client()
+        db.create_all()
+        db.session.add(User(username="admin", password="password"))
+        db.session.commit()
+        instrumentation.reset()
+        auth = base64.b64encode("admin:password")
+        response = self.app.post('/tokens', headers={'X-Auth': auth})
+        self.headers = {"X-Auth-Token": json.loads(response.data)['token']}
+        self.login = response
+
+    def tearDown(self):
+        api.app.config['INSTRUMENTATION'] = False
+        api.app.config['ADMINS'] = []
+        api.app.config['SLOW_REQUEST_MS'] = 500
+        db.session.remove()
+        db.drop_all()
+
+    @staticmethod
+    def timings(response):
+        return dict(part.split(';dur=') for part in response.headers['Server-Timing'].split(', '))
+
+    def testHeaders(self):
+        assert 'bcrypt' in self.timings(self.login)
+        self.app.post('/subreddits', data={"name": "funny"}, headers=self.headers)
+        response = self.app.get('/r/funny')
+        assert int(response.headers['X-Query-Count']) > 0
+        timings = self.timings(response)
+        assert set(['db', 'serialize', 'total']) <= set(timings)
+        assert float(timings['db']) <= float(timings['total'])
+        api.app.config['INSTRUMENTATION'] = False
+        response = self.app.get('/r/funny')
+        assert 'X-Query-Count' not in response.headers
+        assert 'Server-Timing' not in response.headers
+
+    def testSlowLog(self):
+        handler = ListHandler()
+        api.app.logger.addHandler(handler)
+        api.app.config['SLOW_REQUEST_MS'] = 0
+        try:
+            self.app.get('/u/admin')
+        finally:
+            api.app.logger.removeHandler(handler)
+        assert len(handler.messages) == 1
+        assert handler.messages[0].startswith('Slow request GET /u/admin')
+        assert 'FROM user' in handler.messages[0]
+
+    def testHistograms(self):
+        for i in range(3):
+            self.app.get('/u/admin')
+        response = self.app.get('/stats', headers=self.headers)
+        endpoints = json.loads(response.data)['endpoints']
+        user = endpoints['GET user_ep']
+        assert user['total_ms']['count'] == 3
+        assert sum(user['queries']['buckets'].values()) == 3
+        assert endpoints['POST token_ep']['bcrypt_ms']['count'] == 1
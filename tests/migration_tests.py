@@ -0,0 +1,105 @@
+"""
+Migration tests, upgrade a database created with the original schema.
+"""
+import json
+from sqlalchemy import inspect
+from application import api, db
+from application.resources import *
+from application import migrations, queryplans
+from application.models import User, Entry, Post, Subreddit, Vote
+
+BASELINE = [
+    "CREATE TABLE user (username VARCHAR(256) NOT NULL, password_hash VARCHAR(60) NOT NULL, "
+    "PRIMARY KEY (username), UNIQUE (password_hash))",
+    "CREATE TABLE subreddit (name VARCHAR(256) NOT NULL, PRIMARY KEY (name))",
+    "CREATE TABLE subscriptions (user_username VARCHAR(256), subreddit_name VARCHAR(256), "
+    "FOREIGN KEY(user_username) REFERENCES user (username), "
+    "FOREIGN KEY(subreddit_name) REFERENCES subreddit (name))",
+    "CREATE TABLE entry (id INTEGER NOT NULL, user_username VARCHAR(256), body TEXT, "
+    "parent_id INTEGER, type VARCHAR(128), PRIMARY KEY (id), "
+    "FOREIGN KEY(user_username) REFERENCES user (username), "
+    "FOREIGN KEY(parent_id) REFERENCES entry (id))",
+    "CREATE TABLE vote (voter_username VARCHAR(256) NOT NULL, entry_id INTEGER NOT NULL, "
+    "weight INTEGER, PRIMARY KEY (voter_username, entry_id), "
+    "FOREIGN KEY(voter_username) REFERENCES user (username), "
+    "FOREIGN KEY(entry_id) REFERENCES entry (id))",
+    "CREATE TABLE post (id INTEGER NOT NULL, title VARCHAR(512) NOT NULL, "
+    "subreddit_name VARCHAR(256), PRIMARY KEY (id), FOREIGN KEY(id) REFERENCES entry (id), "
+    "FOREIGN KEY(subreddit_name) REFERENCES subreddit (name))",
+    "CREATE INDEX ix_post_title ON post (title)",
+    "INSERT INTO user VALUES ('author', 'hash1'), ('voter', 'hash2')",
+    "INSERT INTO subreddit VALUES ('funny')",
+    "INSERT INTO subscriptions VALUES ('voter', 'funny'), ('voter', 'funny')",
+    "INSERT INTO entry VALUES (1, 'author', 'post body', NULL, 'post'), "
+    "(2, 'voter', 'a comment', 1, 'entry')",
+    "INSERT INTO post VALUES (1, 'a title', 'funny')",
+    "INSERT INTO vote VALUES ('voter', 1, 1), ('author', 1, -1), ('author', 2, 1)",
+]
+
+
+class TestMigrations(object):
+
+    def setUp(self):
+        api.app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+        api.app.config['TESTING'] = True
+        self.app = api.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.engine.execute("DROP TABLE IF EXISTS schema_version")
+
+    def testFreshDatabase(self):
+        assert migrations.current() is None
+        assert migrations.upgrade() == []
+        assert migrations.current() == migrations.head()
+        assert migrations.upgrade() == []
+
+    def testUpgrade(self):
+        for statement in BASELINE:
+            db.session.execute(statement)
+        db.session.commit()
+        assert migrations.current() == 0
+        applied = migrations.upgrade()
+        assert len(applied) == migrations.head()
+        assert migrations.current() == migrations.head()
+
+        inspector = inspect(db.engine)
+        for table in ('user', 'subreddit', 'entry', 'post', 'vote', 'subscriptions'):
+            created = set(index['name'] for index in inspector.get_indexes(table))
+            expected = set(index.name for index in db.metadata.tables[table].indexes)
+            assert expected <= created, (table, expected - created)
+        assert db.session.execute("SELECT count(*) FROM subscriptions").scalar() == 1
+        assert Subreddit.query.filter_by(name='funny').one().subscriber_count == 1
+        assert Entry.counter_drift() == []
+        assert User.karma_drift() == []
+        author = User.query.filter_by(username='author').one()
+        voter = User.query.filter_by(username='voter').one()
+        assert author.karma == 0 and voter.karma == 1
+        assert [v.voter_id for v in Vote.query.filter_by(entry_id=2)] == [author.id]
+        post = Post.query.get(1)
+        assert post.author is author and post.subreddit.name == 'funny'
+        assert [e.id for e in voter.entries] == [2]
+        assert post.created is not None
+        assert post.top_rank == 0 and post.controversy_rank == 2.0
+        assert db.session.execute(
+            "SELECT rowid FROM entry_search WHERE entry_search MATCH 'comment'").fetchall() == [(2,)]
+
+        # The upgraded schema serves requests
+        response = self.app.get('/r/funny/posts/a title')
+        assert response.status_code == 200
+        assert json.loads(response.data)['comments'][0]['body'] == 'a comment'
+
+    def testQueryPlans(self):
+        migrations.upgrade()
+        with api.app.test_request_context():
+            assert queryplans.full_scans() == []
+            db.session.execute("DROP INDEX ix_entry_parent")
+            scans = queryplans.full_scans()
+            # Plans name aliased tables by their alias only
+            db.session.execute("DROP INDEX ix_entry_author")
+            author = db.aliased(Entry)
+            aliased = queryplans.full_scans([
+                ('aliased', db.session.query(author).filter(author.user_id == 1))])
+        assert 'comment tree' in [name for name, line in scans]
+        assert [name for name, line in aliased] == ['aliased']
@@ -116,3 +116,454 @@ class TestPosts(object):
         response = self.app.get('/u/{0}'.format(self.user.username))
         rdata = json.loads(response.data)
         assert rdata['karma'] == 2
+
+    def testCounterRebuild(self):
+        from application.models import Entry
+        data = {
+            "title": "Test post please ignore",
+            "body": "This is a test post, please ignore it."
+        }
+        response = self.app.post('/r/funny', data=data, headers=self.headers)
+        post_id = json.loads(response.data)['id']
+        assert Entry.counter_drift() == []
+        Entry.query.filter_by(id=post_id).update({Entry.upvotes: 7})
+        db.session.commit()
+        assert len(Entry.counter_drift()) == 1
+        Entry.rebuild_counters()
+        db.session.commit()
+        assert Entry.counter_drift() == []
+        response = self.app.get('/r/funny')
+        rdata = json.loads(response.data)
+        assert rdata['posts'][0]['upvotes'] == 1
+        assert rdata['posts'][0]['downvotes'] == 0
+
+    def testMyVoteQueries(self):
+        from sqlalchemy import event
+        data = {
+            "title": "Test post please ignore",
+            "body": "This is a test post, please ignore it."
+        }
+        for i in range(3):
+            data['title'] = "Test post number {0}".format(i)
+            self.app.post('/r/funny', data=data, headers=self.headers)
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = self.app.get('/r/funny', headers=self.headers)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        rdata = json.loads(response.data)
+        assert [p['myvote'] for p in rdata['posts']] == [1, 1, 1]
+        assert len([s for s in statements if 'FROM vote' in s]) == 1
+        response = self.app.get('/r/funny')
+        rdata = json.loads(response.data)
+        assert [p['myvote'] for p in rdata['posts']] == [0, 0, 0]
+
+    def testCommentTree(self):
+        from application.models import Entry, Post
+        data = {
+            "title": "Test post please ignore",
+            "body": "This is a test post, please ignore it."
+        }
+        response = self.app.post('/r/funny', data=data, headers=self.headers)
+        post_url = json.loads(response.data)['url']
+        response = self.app.post(post_url, data={"body": "First"}, headers=self.headers)
+        first_id = json.loads(response.data)['id']
+        self.app.post(post_url, data={"body": "Second"}, headers=self.headers)
+        parent = Entry.query.get(first_id)
+        for i in range(3):
+            reply = Entry(body="Reply {0}".format(i))
+            reply.parent = parent
+            reply.author = self.user
+            db.session.add(reply)
+            parent = reply
+        db.session.commit()
+        rdata = json.loads(self.app.get(post_url).data)
+        assert [c['body'] for c in rdata['comments']] == ["First", "Second"]
+        assert rdata['comments'][0]['comments'][0]['comments'][0]['body'] == "Reply 1"
+        # Depth cut short
+        rdata = json.loads(self.app.get(post_url + '?depth=2').data)
+        reply = rdata['comments'][0]['comments'][0]
+        assert reply['comments'] == []
+        assert reply['more'] == reply['url']
+        # Width cut short, follow the continuation
+        rdata = json.loads(self.app.get(post_url + '?limit=1').data)
+        assert [c['body'] for c in rdata['comments']] == ["First"]
+        rdata = json.loads(self.app.get(rdata['more']).data)
+        assert [c['body'] for c in rdata['comments']] == ["Second"]
+        assert rdata['more'] is None
+        response = self.app.get(post_url + '?after=garbage')
+        assert response.status_code == 400
+
+    def testCommentTreeLimit(self):
+        from application.models import Entry
+        data = {
+            "title": "Test post please ignore",
+            "body": "This is a test post, please ignore it."
+        }
+        response = self.app.post('/r/funny', data=data, headers=self.headers)
+        post_url = json.loads(response.data)['url']
+        post_id = int(json.loads(self.app.get(post_url).data)['id'])
+        ids = []
+        for i in range(6):
+            response = self.app.post(post_url, data={"body": "Comment {0}".format(i)}, headers=self.headers)
+            ids.append(int(json.loads(response.data)['id']))
+        parent = Entry.query.get(ids[0])
+        for i in range(6):
+            reply = Entry(body="Reply {0}".format(i))
+            reply.parent = parent
+            reply.author = User.query.filter_by(username=self.user.username).one()
+            db.session.add(reply)
+        db.session.commit()
+        # Only the replies within the limit and the one past it leave the database
+        rows = Entry.comment_tree_query([post_id], 10, limit=2).all()
+        assert len(rows) == 1 + 3 + 3
+        rows = Entry.comment_tree_query([post_id], 10, after=ids[3], limit=2).all()
+        assert [e.id for e, depth, replies in rows] == [post_id, ids[4], ids[5]]
+        rdata = json.loads(self.app.get(post_url + '?limit=2').data)
+        assert [c['body'] for c in rdata['comments']] == ["Comment 0", "Comment 1"]
+        assert [c['body'] for c in rdata['comments'][0]['comments']] == ["Reply 0", "Reply 1"]
+        assert rdata['more'] is not None
+        assert rdata['comments'][0]['more'] is not None
+        assert rdata['comments'][1]['more'] is None
+
+    def testRankedFeeds(self):
+        from application.models import Post
+        urls = []
+        for i in range(3):
+            data = {
+                "title": "Test post number {0}".format(i),
+                "body": "This is a test post, please ignore it."
+            }
+            response = self.app.post('/r/funny', data=data, headers=self.headers)
+            urls.append(json.loads(response.data))
+        voter = User(username='voter', password="password")
+        db.session.add(voter)
+        db.session.commit()
+        headers = self.get_token_header(voter)
+        self.app.post(urls[0]['upvote_url'], headers=headers)
+        self.app.post(urls[2]['downvote_url'], headers=headers)
+
+        def titles(query):
+            rdata = json.loads(self.app.get('/r/funny' + query).data)
+            return [p['title'][-1] for p in rdata['posts']]
+        assert titles('?sort=new') == ['2', '1', '0']
+        assert titles('?sort=top&t=week') == ['0', '1', '2']
+        assert titles('?sort=controversial')[0] == '2'
+        assert titles('?sort=hot')[0] == '0'
+        assert titles('?sort=top&limit=1') == ['0']
+        assert self.app.get('/r/funny?sort=best').status_code == 400
+        Post.query.update({Post.hot_rank: 0})
+        db.session.commit()
+        assert Post.rerank_all() == 3
+        db.session.commit()
+        assert titles('?sort=hot')[0] == '0'
+
+    def testResponseCache(self):
+        from application.httpcache import response_cache
+        data = {
+            "title": "Test post please ignore",
+            "body": "This is a test post, please ignore it."
+        }
+        rdata = json.loads(self.app.post('/r/funny', data=data, headers=self.headers).data)
+        response = self.app.get('/r/funny')
+        etag = response.headers['ETag']
+        assert response.headers['Last-Modified']
+        hits = response_cache.hits
+        response = self.app.get('/r/funny', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response_cache.hits == hits + 1
+        # Authenticated readers are cached apart, they see their own votes
+        response = self.app.get('/r/funny', headers=self.headers)
+        assert json.loads(response.data)['posts'][0]['myvote'] == 1
+        response = self.app.get('/u/{0}'.format(self.user.username))
+        assert json.loads(response.data)['karma'] == 1
+        # Votes invalidate every response showing the entry
+        voter = User(username='voter', password="password")
+        db.session.add(voter)
+        db.session.commit()
+        self.app.post(rdata['downvote_url'], headers=self.get_token_header(voter))
+        response = self.app.get('/r/funny', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert json.loads(response.data)['posts'][0]['downvotes'] == 1
+        response = self.app.get('/u/{0}'.format(self.user.username))
+        assert json.loads(response.data)['karma'] == 0
+        self.app.post(rdata['url'], data={"body": "A comment"}, headers=self.headers)
+        response = self.app.get(rdata['url'])
+        assert len(json.loads(response.data)['comments']) == 1
+        response = self.app.get('/u/{0}'.format(self.user.username))
+        assert json.loads(response.data)['karma'] == 1
+
+    def testCachedListingOfAll(self):
+        names = lambda: [s['name'] for s in json.loads(self.app.get('/r/all').data)]
+        assert names() == ['funny']
+        # A new subreddit shows up in the cached listing of all of them
+        self.app.post('/subreddits', data={"name": "pics"}, headers=self.headers)
+        assert names() == ['funny', 'pics']
+
+    def testCompiledMarshaling(self):
+        from flask.ext.restful import marshal
+        from application.models import Subreddit
+        from application.fields import subreddit_fields, user_fields
+        from application.serializers import compile_fields
+        data = {
+            "title": u"T\xeftle with spaces/and ?odd& chars",
+            "body": "This is a test post, please ignore it."
+        }
+        rdata = json.loads(self.app.post('/r/funny', data=data, headers=self.headers).data)
+        self.app.post(rdata['url'], data={"body": "A comment"}, headers=self.headers)
+        with api.app.test_request_context('/'):
+            sub = Subreddit.query.filter_by(name='funny').one().to_dict()
+            user = User.query.filter_by(username=self.user.username).one()
+            for spec, value in [(subreddit_fields, sub), (subreddit_fields, [sub, sub]),
+                                (user_fields, user.to_dict()), (user_fields, user)]:
+                expected = json.dumps(marshal(value, spec))
+                assert json.dumps(compile_fields(spec)(value)) == expected
+
+    def testSearch(self):
+        from application import search
+        for i, body in enumerate(["Cats are better than dogs, discuss.",
+                                  "Dogs are loyal and cats are not, discuss.",
+                                  "Nothing to see here, move along."]):
+            data = {
+                "title": "Test post number {0}".format(i),
+                "body": body
+            }
+            self.app.post('/r/funny', data=data, headers=self.headers)
+        self.app.post('/subreddits', data={"name": "pics"}, headers=self.headers)
+        self.app.post('/r/pics', data={"title": "Pictures of cats",
+                                       "body": "Only pictures, no words."}, headers=self.headers)
+        self.app.post('/r/funny/posts/Test post number 2', data={"body": "dogs dogs dogs"},
+                      headers=self.headers)
+
+        def search_for(query):
+            return json.loads(self.app.get('/search?' + query).data)
+        assert set(hit['title'] for hit in search_for('q=cats')) == set(
+            ["Test post number 0", "Test post number 1", "Pictures of cats"])
+        # Title matches rank first
+        assert search_for('q=cats')[0]['title'] == "Pictures of cats"
+        assert [hit['title'] for hit in search_for('q=cats&r=pics')] == ["Pictures of cats"]
+        hits = search_for('q=dogs')
+        assert hits[0]['type'] == 'comment' and hits[0]['subreddit'] == 'funny'
+        assert self.app.get(hits[0]['url']).status_code == 200
+        assert search_for('q=cats dogs discuss') and len(search_for('q=cats dogs discuss')) == 2
+        assert search_for('q="unbalanced') == []
+        assert self.app.get('/search').status_code == 400
+
+        response = self.app.get('/search?q=cats&limit=2')
+        assert len(json.loads(response.data)) == 2
+        response = self.app.get(response.headers['Link'].split('>')[0][1:])
+        assert len(json.loads(response.data)) == 1
+
+        assert search.reindex() == 5
+        db.session.commit()
+        assert len(search_for('q=cats')) == 3
+
+    def testSearchUnavailable(self):
+        from sqlalchemy import inspect
+        from application import search
+        assert search.available()
+        db.session.remove()
+        db.drop_all()
+        # As on an sqlite built without FTS5
+        search._fts5[db.engine] = False
+        try:
+            self.setUp()
+            assert 'entry_search' not in inspect(db.engine).get_table_names()
+            data = {
+                "title": "Test post please ignore",
+                "body": "This is a test post, please ignore it."
+            }
+            assert self.app.post('/r/funny', data=data, headers=self.headers).status_code == 200
+            assert self.app.get('/search?q=test').status_code == 501
+        finally:
+            del search._fts5[db.engine]
+
+    def testWriteBehindVotes(self):
+        from application.models import Entry
+        from application.votequeue import queue
+        config = api.app.config
+        config.update(VOTE_WRITE_BEHIND=True, VOTE_FLUSH_INTERVAL=0, VOTE_FLUSH_SIZE=100)
+        try:
+            data = {"title": "Test post please ignore", "body": "Vote on me."}
+            rdata = json.loads(self.app.post('/r/funny', data=data, headers=self.headers).data)
+            post_url, up_url, down_url = rdata['url'], rdata['upvote_url'], rdata['downvote_url']
+            voter = User(username='voter', password="password")
+            db.session.add(voter)
+            db.session.commit()
+            headers = self.get_token_header(voter)
+            assert self.app.post(down_url, headers=headers).status_code == 202
+            assert self.app.post(down_url, headers=headers).status_code == 422
+            # The voter reads their own vote before it is written
+            rdata = json.loads(self.app.get(post_url, headers=headers).data)
+            assert rdata['myvote'] == -1 and rdata['downvotes'] == 0
+            assert self.app.delete(down_url, headers=headers).status_code == 204
+            assert self.app.post(up_url, headers=headers).status_code == 202
+            assert json.loads(self.app.get(post_url, headers=headers).data)['myvote'] == 1
+            # Coalesced into one write
+            assert len(queue) == 1
+            assert queue.flush() == 1
+            rdata = json.loads(self.app.get(post_url).data)
+            assert rdata['upvotes'] == 2 and rdata['downvotes'] == 0
+            assert json.loads(self.app.get('/u/subuser1').data)['karma'] == 2
+            assert Entry.counter_drift() == [] and User.karma_drift() == []
+            # A full queue is written right away
+            config['VOTE_FLUSH_SIZE'] = 1
+            assert self.app.delete(up_url, headers=headers).status_code == 204
+            assert len(queue) == 0
+            rdata = json.loads(self.app.get(post_url, headers=headers).data)
+            assert rdata['upvotes'] == 1 and rdata['myvote'] == 0
+        finally:
+            config.update(VOTE_WRITE_BEHIND=False, VOTE_FLUSH_INTERVAL=1.0, VOTE_FLUSH_SIZE=500)
+
+    def testPutVote(self):
+        from application.models import Entry
+        data = {"title": "Test post please ignore", "body": "Vote on me."}
+        rdata = json.loads(self.app.post('/r/funny', data=data, headers=self.headers).data)
+        post_url, vote_url = rdata['url'], rdata['vote_url']
+        voter = User(username='voter', password="password")
+        db.session.add(voter)
+        db.session.commit()
+        headers = self.get_token_header(voter)
+        for weight, up, down in ((1, 2, 0), (1, 2, 0), (-1, 1, 1), (0, 1, 0), (0, 1, 0), (-1, 1, 1)):
+            response = self.app.put(vote_url, data={"weight": weight}, headers=headers)
+            assert response.status_code == 200
+            rdata = json.loads(response.data)
+            assert rdata == {"myvote": weight, "upvotes": up, "downvotes": down}
+            assert json.loads(self.app.get(post_url, headers=headers).data)['myvote'] == weight
+        assert json.loads(self.app.get('/u/subuser1').data)['karma'] == 0
+        assert Entry.counter_drift() == [] and User.karma_drift() == []
+        assert self.app.put(vote_url, data={"weight": 2}, headers=headers).status_code == 400
+        assert self.app.put(vote_url, data={"weight": 1}).status_code == 401
+
+    def testFieldsets(self):
+        from sqlalchemy import event
+        from application.models import Entry
+        data = {"title": "Test post please ignore", "body": "This is a test post."}
+        rdata = json.loads(self.app.post('/r/funny', data=data, headers=self.headers).data)
+        post_url = rdata['url']
+        comment = json.loads(self.app.post(post_url, data={"body": "First"}, headers=self.headers).data)
+        reply = Entry(body="Reply")
+        reply.parent = Entry.query.get(comment['id'])
+        reply.author = User.query.filter_by(username=self.user.username).one()
+        db.session.add(reply)
+        db.session.commit()
+
+        def get(url):
+            response = self.app.get(url)
+            assert response.status_code == 200, url
+            return json.loads(response.data)
+        # Listings are shallow
+        post = get('/r/funny')['posts'][0]
+        assert post['comment_count'] == 1 and 'comments' not in post
+        post = get('/r/funny?expand=posts.comments')['posts'][0]
+        assert [c['body'] for c in post['comments']] == ["First"]
+        assert 'comments' not in post['comments'][0]
+        assert get('/r/funny?fields=name') == {"name": "funny"}
+        assert get('/r/funny?fields=name,posts.title') == {
+            "name": "funny", "posts": [{"title": data['title']}]}
+        # Single entries come with their whole tree unless told otherwise
+        post = get(post_url)
+        assert post['comment_count'] == 1
+        assert post['comments'][0]['comments'][0]['body'] == "Reply"
+        assert 'comments' not in get(post_url + '?expand=')
+        assert get(comment['url'] + '?fields=body,comments.body') == {
+            "body": "First", "comments": [{"body": "Reply", "comments": []}]}
+        user = get('/u/subuser1')
+        assert len(user['subscriptions']) == 1 and 'posts' not in user['subscriptions'][0]
+        assert [c['body'] for c in user['comments']] == ["First", "Reply"]
+        assert 'comments' not in user['posts'][0]
+        for url in ['/r/funny?expand=title', '/u/subuser1?fields=nope', '/users?expand=posts.nope']:
+            assert self.app.get(url).status_code == 400
+        # Relations nobody asked for are not loaded at all
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            assert get('/u/subuser1?fields=username,karma') == {"username": "subuser1", "karma": 2}
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        assert len(statements) == 1
+
+    def testExpandedCommentTrees(self):
+        from sqlalchemy import event
+        from application.models import Entry
+        data = {"title": "Test post please ignore", "body": "This is a test post."}
+        post_url = json.loads(self.app.post('/r/funny', data=data, headers=self.headers).data)['url']
+        ids = [json.loads(self.app.post(post_url, data={"body": "Comment {0}".format(i)},
+                                        headers=self.headers).data)['id'] for i in range(12)]
+        parent = Entry.query.get(ids[0])
+        for i in range(5):
+            reply = Entry(body="Reply {0}".format(i))
+            reply.parent = parent
+            reply.author = User.query.filter_by(username=self.user.username).one()
+            db.session.add(reply)
+            parent = reply
+        db.session.commit()
+        statements, loaded = [], []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        def load(entry, context):
+            loaded.append(entry.id)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        event.listen(Entry, 'load', load, propagate=True)
+        try:
+            response = self.app.get('/r/funny?expand=posts.comments.comments')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+            event.remove(Entry, 'load', load)
+        post = json.loads(response.data)['posts'][0]
+        # One level of the first comments, past them only continuation links
+        assert [c['body'] for c in post['comments']] == ["Comment {0}".format(i) for i in range(10)]
+        assert post['more'] is not None
+        assert post['comments'][0]['comments'] == []
+        assert post['comments'][0]['more'] is not None
+        # The post, its ten comments and the one telling there are more
+        assert len(loaded) == 1 + 11
+        assert len([s for s in statements if 'WITH RECURSIVE' in s]) == 1
+        # Deeper when asked
+        post = json.loads(self.app.get('/r/funny?expand=posts.comments.comments&depth=3').data)['posts'][0]
+        assert post['comments'][0]['comments'][0]['comments'][0]['body'] == "Reply 1"
+        assert post['comments'][0]['comments'][0]['comments'][0]['comments'] == []
+        assert self.app.get('/r/funny?expand=posts.comments&depth=-1').status_code == 400
+
+    def testLoaders(self):
+        from sqlalchemy import event
+        for i in range(3):
+            author = User(username='author{0}'.format(i), password="password")
+            db.session.add(author)
+            db.session.commit()
+            headers = self.get_token_header(author)
+            for title in ("First post of {0}", "Second post of {0}"):
+                data = {"title": title.format(i), "body": "A post to list."}
+                assert self.app.post('/r/funny', data=data, headers=headers).status_code == 200
+            url = json.loads(self.app.post('/r/funny', data={"title": "Third post {0}".format(i),
+                             "body": "Comment on me."}, headers=headers).data)['url']
+            self.app.post(url, data={"body": "A reply"}, headers=self.headers)
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            rdata = json.loads(self.app.get('/r/funny?expand=posts&fields=name,posts.author,posts.url').data)
+            assert len(rdata['posts']) == 9
+            assert set(p['author'] for p in rdata['posts']) == set(['author0', 'author1', 'author2'])
+            assert all(p['url'].startswith('/r/funny/posts/') for p in rdata['posts'])
+            # The authors of the whole page in one query, the subreddit loaded once
+            assert len([s for s in statements if 'FROM user' in s]) == 1
+            assert len([s for s in statements if 'FROM subreddit' in s]) == 1
+            del statements[:]
+            rdata = json.loads(self.app.get(url, headers=self.headers).data)
+            assert rdata['author'] == 'author2' and len(rdata['comments']) == 1
+            # The reader's token, who also wrote the reply, and the post's author
+            assert len([s for s in statements if 'FROM user' in s]) == 2
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
@@ -0,0 +1,89 @@
+"""
+Pre-fork server tests, run manage.py serve in a subprocess.
+"""
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib2
+from nose.plugins.skip import SkipTest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def children(pid):
+    """Pids of the child processes of pid, read from /proc."""
+    pids = set()
+    for name in os.listdir('/proc'):
+        try:
+            with open('/proc/{0}/stat'.format(name)) as stat:
+                fields = stat.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        if int(fields[1]) == pid:
+            pids.add(int(name))
+    return pids
+
+
+class TestServer(object):
+
+    def setUp(self):
+        if not os.path.isdir('/proc'):
+            raise SkipTest("Needs /proc to find the workers")
+        self.directory = tempfile.mkdtemp()
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        self.port = listener.getsockname()[1]
+        listener.close()
+        env = dict(os.environ, DATABASE_URL="sqlite:///" + os.path.join(self.directory, "serve.db"),
+                   VOTE_WRITE_BEHIND='1')
+        self.log = open(os.path.join(self.directory, "serve.log"), "w")
+        self.process = subprocess.Popen(
+            [sys.executable, 'manage.py', 'serve', '-H', '127.0.0.1', '-p', str(self.port),
+             '-w', '2', '-t', '2', '--max-requests', '3'],
+            cwd=ROOT, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        self.wait(lambda: len(children(self.process.pid)) == 2)
+
+    def tearDown(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def wait(condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline, "timed out"
+            time.sleep(0.1)
+
+    def get(self, path):
+        return urllib2.urlopen("http://127.0.0.1:{0}{1}".format(self.port, path), timeout=10)
+
+    def testServe(self):
+        workers = children(self.process.pid)
+        # The workers would not see each other's queued votes or invalidations
+        with open(self.log.name) as log:
+            output = log.read()
+        assert "Write-behind voting is off" in output
+        assert "The response cache is off" in output
+        for i in range(8):
+            assert self.get('/subreddits').getcode() == 200
+        # Workers leave after a few requests and are replaced
+        self.wait(lambda: len(children(self.process.pid) - workers) == 2)
+
+        workers = children(self.process.pid)
+        self.process.send_signal(signal.SIGHUP)
+        self.wait(lambda: len(children(self.process.pid) - workers) == 2)
+        assert self.process.poll() is None
+        assert self.get('/subreddits').getcode() == 200
+
+        self.process.send_signal(signal.SIGTERM)
+        self.wait(lambda: self.process.poll() is not None)
+        assert self.process.returncode == 0
+        assert children(self.process.pid) == set()
@@ -69,3 +69,192 @@ class TestSubreddit(object):
         response = self.app.get('/u/{0}'.format(self.user_two.username))
         rdata = json.loads(response.data)
         assert len(rdata['subscriptions']) == 0
+
+    def testPagination(self):
+        headers = self.get_token_header(self.user_one)
+        for name in ["funny", "pics", "news"]:
+            self.app.post('/subreddits', data={"name": name}, headers=headers)
+        response = self.app.get('/subreddits?limit=2')
+        assert [s['name'] for s in json.loads(response.data)] == ["funny", "news"]
+        next_url = response.headers['Link'].split('>')[0][1:]
+        response = self.app.get(next_url)
+        assert [s['name'] for s in json.loads(response.data)] == ["pics"]
+        assert 'Link' not in response.headers
+        assert self.app.get('/subreddits?limit=0').status_code == 400
+        assert self.app.get('/subreddits?after=nonsense').status_code == 400
+        for i in range(3):
+            data = {
+                "title": "Test post number {0}".format(i),
+                "body": "This is a test post, please ignore it."
+            }
+            self.app.post('/r/funny', data=data, headers=headers)
+        response = self.app.get('/r/funny?limit=2')
+        rdata = json.loads(response.data)
+        assert [p['title'] for p in rdata['posts']] == ["Test post number 2", "Test post number 1"]
+        response = self.app.get(response.headers['Link'].split('>')[0][1:])
+        rdata = json.loads(response.data)
+        assert [p['title'] for p in rdata['posts']] == ["Test post number 0"]
+
+    def testFeed(self):
+        from application.models import User
+        headers = self.get_token_header(self.user_one)
+        reader = self.get_token_header(User.query.filter_by(username="subuser2").one())
+        for name in ["funny", "pics", "news"]:
+            self.app.post('/subreddits', data={"name": name}, headers=headers)
+        for i, name in enumerate(["funny", "pics", "news", "funny", "pics"]):
+            data = {
+                "title": "Test post number {0}".format(i),
+                "body": "This is a test post, please ignore it."
+            }
+            self.app.post('/r/' + name, data=data, headers=headers)
+        self.app.post('/r/funny/subscribe', headers=reader)
+        self.app.post('/r/news/subscribe', headers=reader)
+
+        response = self.app.get('/feed?sort=new&limit=2', headers=reader)
+        assert [p['title'][-1] for p in json.loads(response.data)] == ['3', '2']
+        response = self.app.get(response.headers['Link'].split('>')[0][1:], headers=reader)
+        assert [p['title'][-1] for p in json.loads(response.data)] == ['0']
+        assert 'Link' not in response.headers
+        response = self.app.get('/u/subuser1/feed')
+        assert [p['title'][-1] for p in json.loads(response.data)] == ['4', '3', '2', '1', '0']
+        assert self.app.get('/feed').status_code == 401
+
+        # Subscribing shows up in the cached feed straight away
+        self.app.post('/r/pics/subscribe', headers=reader)
+        response = self.app.get('/feed?sort=new&limit=2', headers=reader)
+        assert [p['title'][-1] for p in json.loads(response.data)] == ['4', '3']
+
+    def testBulkSubscribe(self):
+        from application.models import User, Subreddit
+        owner = self.get_token_header(self.user_one)
+        headers = self.get_token_header(User.query.filter_by(username="subuser2").one())
+        for name in ["funny", "pics", "news"]:
+            self.app.post('/subreddits', data={"name": name}, headers=owner)
+        self.app.post('/r/funny/subscribe', headers=headers)
+        # Subscribing again changes nothing
+        assert self.app.post('/r/funny/subscribe', headers=headers).status_code == 201
+        assert json.loads(self.app.get('/r/funny').data)['subscriber_count'] == 2
+
+        response = self.app.post('/subscriptions', headers=headers,
+                                 data=json.dumps({"names": ["funny", "pics", "news"]}),
+                                 content_type='application/json')
+        assert json.loads(response.data)['subscribed'] == ["news", "pics"]
+        rdata = json.loads(self.app.get('/u/subuser2').data)
+        assert sorted(s['name'] for s in rdata['subscriptions']) == ["funny", "news", "pics"]
+        assert [s['subscriber_count'] for s in json.loads(self.app.get('/subreddits').data)] == [2, 2, 2]
+
+        # A missing subreddit fails the whole request
+        response = self.app.delete('/subscriptions?names=funny&names=nope', headers=headers)
+        assert response.status_code == 404
+        assert len(json.loads(self.app.get('/u/subuser2').data)['subscriptions']) == 3
+        response = self.app.delete('/subscriptions?names=funny&names=pics', headers=headers)
+        assert json.loads(response.data)['unsubscribed'] == ["funny", "pics"]
+        assert self.app.delete('/r/pics/subscribe', headers=headers).status_code == 422
+        assert self.app.post('/subscriptions', headers=headers).status_code == 400
+        assert Subreddit.subscriber_drift() == []
+        assert json.loads(self.app.get('/r/pics').data)['subscriber_count'] == 1
+
+    def testSubscribeRace(self):
+        from application.models import User, Subreddit, subscriptions
+        self.app.post('/subreddits', data={"name": "funny"}, headers=self.get_token_header(self.user_one))
+        user = User.query.filter_by(username="subuser2").one()
+        funny = Subreddit.query.filter_by(name="funny").one()
+        # Another request subscribes between the check and the insert
+        stale = User.subscribed_to
+        User.subscribed_to = lambda self, ids: set()
+        try:
+            db.session.execute(subscriptions.insert(), {'user_id': user.id, 'subreddit_id': funny.id})
+            Subreddit.count_subscribers([funny.id], 1)
+            assert user.subscribe([funny.id]) == []
+            db.session.commit()
+            # ... and unsubscribes between the check and the delete
+            User.subscribed_to = lambda self, ids: set(ids)
+            db.session.execute(subscriptions.delete().where(subscriptions.c.user_id == user.id))
+            Subreddit.count_subscribers([funny.id], -1)
+            assert user.unsubscribe([funny.id]) == []
+            db.session.commit()
+        finally:
+            User.subscribed_to = stale
+        assert Subreddit.subscriber_drift() == []
+        assert json.loads(self.app.get('/r/funny').data)['subscriber_count'] == 1
+
+    def testForgedCursors(self):
+        from application import cursors
+        headers = self.get_token_header(self.user_one)
+        self.app.post('/subreddits', data={"name": "funny"}, headers=headers)
+        self.app.post('/r/funny/subscribe', headers=headers)
+        data = {
+            "title": "Test post please ignore",
+            "body": "This is a test post, please ignore it."
+        }
+        self.app.post('/r/funny', data=data, headers=headers)
+        # Cursors that decode, but not to values of the key columns
+        for values in [(None,), ([1],), ({},), (True, 1), ("1", 1), (1.5, "x"), (1, 2.5)]:
+            after = cursors.encode(*values)
+            for url in ['/subreddits', '/r/funny?sort=top', '/r/funny?sort=hot',
+                        '/u/subuser1/feed', '/feed', '/search?q=test',
+                        '/r/funny/posts/Test post please ignore']:
+                response = self.app.get('{0}{1}after={2}'.format(url, '&' if '?' in url else '?', after),
+                                        headers=headers)
+                assert response.status_code == 400, (url, values)
+        # Numbers stand in for floats
+        after = cursors.encode(1, 1)
+        assert self.app.get('/r/funny?sort=hot&after=' + after).status_code == 200
+        assert self.app.get('/search?q=test&after=' + after).status_code == 200
+
+    def testFeedStatements(self):
+        from sqlalchemy import event
+        headers = self.get_token_header(self.user_one)
+        data = {
+            "title": "Test post please ignore",
+            "body": "This is a test post, please ignore it."
+        }
+        counts = []
+        for name in ["funny", "pics", "news", "gifs"]:
+            self.app.post('/subreddits', data={"name": name}, headers=headers)
+            self.app.post('/r/{0}/subscribe'.format(name), headers=headers)
+            self.app.post('/r/' + name, data=data, headers=headers)
+            statements = []
+
+            def record(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                response = self.app.get('/feed?sort=top&limit=2', headers=headers)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            assert len(json.loads(response.data)) == min(len(counts) + 1, 2)
+            counts.append(len([s for s in statements if 'FROM post' in s or 'JOIN post' in s]))
+        # The subscribed feeds are merged by a single statement
+        assert counts == [1, 1, 1, 1]
+
+    def testFeedMerge(self):
+        from sqlalchemy import event
+        from application.models import Entry
+        headers = self.get_token_header(self.user_one)
+        names = ["funny", "pics", "news", "gifs", "books", "music"]
+        for name in names:
+            self.app.post('/subreddits', data={"name": name}, headers=headers)
+            self.app.post('/r/{0}/subscribe'.format(name), headers=headers)
+        # Most posts in one subreddit, so its head runs dry and is read again
+        titles = []
+        for i, name in enumerate(["funny"] * 6 + names + ["funny"] * 3):
+            title = "Test post number {0:02d}".format(i)
+            self.app.post('/r/' + name, data={"title": title, "body": "This is a test post."}, headers=headers)
+            titles.append(title)
+        loaded = []
+
+        def load(entry, context):
+            loaded.append(entry.id)
+        event.listen(Entry, 'load', load, propagate=True)
+        try:
+            response = self.app.get('/feed?sort=new&limit=4', headers=headers)
+        finally:
+            event.remove(Entry, 'load', load)
+        # limit // 6 + 2 rows of each head, and the one head read again
+        assert len(loaded) <= 6 * 2 + 4
+        seen = [p['title'] for p in json.loads(response.data)]
+        while 'Link' in response.headers:
+            response = self.app.get(response.headers['Link'].split('>')[0][1:], headers=headers)
+            seen += [p['title'] for p in json.loads(response.data)]
+        assert seen == titles[::-1]
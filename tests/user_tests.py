@@ -74,7 +74,180 @@ class TestLogin(object):
         response = self.app.post('/tokens', headers={'X-Auth': x_auth})
         assert response.status_code == 201
 
+    def testTokenCache(self):
+        from application.models import token_cache
+        x_auth = self.create_auth(self.user.username, "password")
+        response = self.app.post('/tokens', headers={'X-Auth': x_auth})
+        headers = {
+            "X-Auth-Token": json.loads(response.data)['token']
+        }
+        hits = token_cache.hits
+        response = self.app.get('/stats', headers=headers)
+        assert response.status_code == 403
+        api.app.config['ADMINS'] = [self.user.username]
+        try:
+            response = self.app.get('/stats', headers=headers)
+        finally:
+            api.app.config['ADMINS'] = []
+        assert response.status_code == 200
+        assert token_cache.hits == hits + 1
+        assert json.loads(response.data)['token_cache']['hits'] == hits + 1
+        token = headers["X-Auth-Token"]
+        user = User.query.filter_by(username=self.user.username).one()
+        assert token_cache.get(token) == user.id
+        self.app.put('/u/{0}'.format(self.user.username),
+                     data={"password": "12345678"}, headers=headers)
+        assert token_cache.get(token) is None
+        # Deleting the user drops the tokens cached since
+        assert self.app.get('/feed', headers=headers).status_code == 200
+        assert token_cache.get(token) == user.id
+        db.session.delete(User.query.get(user.id))
+        db.session.commit()
+        assert token_cache.get(token) is None
+        assert self.app.get('/feed', headers=headers).status_code == 401
+        headers["X-Auth-Token"] = "garbage"
+        assert self.app.get('/stats', headers=headers).status_code == 401
+
+    def testCacheBounds(self):
+        from application.cache import LRUCache
+        cache = LRUCache(2, ttl=60)
+        cache.set('a', 1, tags=['x'])
+        cache.set('b', 2, tags=['x'])
+        cache.get('a')
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.stats()['evictions'] == 1
+        cache.set('d', 4, ttl=-1)
+        assert cache.get('d') is None
+        cache.invalidate('x')
+        assert cache.get('a') is None
+        assert cache.get('c') == 3
+
+    def tearDown(self):
+        """Clear db after a test"""
+        db.session.remove()
+        db.drop_all()
+
+
+class TestKarma(object):
+
+    def setUp(self):
+        """Creates tables before test cases"""
+        from application.models import User
+        api.app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+        api.app.config['TESTING'] = True
+        self.app = api.app.test_client()
+        db.create_all()
+        self.user = User(username="karmatester", password="password")
+        db.session.add(self.user)
+        db.session.commit()
+        x_auth = base64.b64encode("{0}:{1}".format(self.user.username, "password"))
+        response = self.app.post('/tokens', headers={'X-Auth': x_auth})
+        self.headers = {"X-Auth-Token": json.loads(response.data)['token']}
+        self.app.post('/subreddits', data={"name": "funny"}, headers=self.headers)
+
     def tearDown(self):
         """Clear db after a test"""
         db.session.remove()
         db.drop_all()
+
+    def testBatchKarma(self):
+        from application.models import User
+        data = {
+            "title": "Test post please ignore",
+            "body": "This is a test post, please ignore it."
+        }
+        self.app.post('/r/funny', data=data, headers=self.headers)
+        self.app.post('/users', data={"username": "lurker", "password": "12345678"})
+        assert User.compute_karma(["karmatester", "lurker"]) == {"karmatester": 1, "lurker": 0}
+        assert User.karma_drift() == []
+        User.query.filter_by(username="karmatester").update({User.karma: 5})
+        db.session.commit()
+        assert User.karma_drift() == [("karmatester", 5, 1)]
+        User.rebuild_karma()
+        db.session.commit()
+        response = self.app.get('/users')
+        karma = dict((u['username'], u['karma']) for u in json.loads(response.data))
+        assert karma == {"karmatester": 1, "lurker": 0}
+
+
+class TestHashing(object):
+
+    def setUp(self):
+        """Creates tables before test cases"""
+        from application.models import User
+        api.app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+        api.app.config['TESTING'] = True
+        api.app.config['BCRYPT_LOG_ROUNDS'] = 4
+        self.app = api.app.test_client()
+        db.create_all()
+        self.user = User(username="hashtester", password="password")
+        db.session.add(self.user)
+        db.session.commit()
+        self.x_auth = base64.b64encode("hashtester:password")
+
+    def tearDown(self):
+        """Clear db after a test"""
+        api.app.config['BCRYPT_LOG_ROUNDS'] = 12
+        api.app.config['HASH_QUEUE_DEPTH'] = 16
+        db.session.remove()
+        db.drop_all()
+
+    def testRehashOnLogin(self):
+        from application.models import User
+        assert self.user.password_hash.startswith('$2a$04$')
+        api.app.config['BCRYPT_LOG_ROUNDS'] = 5
+        response = self.app.post('/tokens', headers={'X-Auth': self.x_auth})
+        assert response.status_code == 201
+        assert User.query.filter_by(username="hashtester").one().password_hash.startswith('$2a$05$')
+        response = self.app.post('/tokens', headers={'X-Auth': self.x_auth})
+        assert response.status_code == 201
+
+    def testQueueFull(self):
+        from application import hashing
+        api.app.config['HASH_QUEUE_DEPTH'] = 0
+        pool, slots = hashing._pool()
+        for i in range(api.app.config['HASH_POOL_SIZE']):
+            slots.acquire()
+        try:
+            response = self.app.post('/tokens', headers={'X-Auth': self.x_auth})
+        finally:
+            for i in range(api.app.config['HASH_POOL_SIZE']):
+                slots.release()
+        assert response.status_code == 503
+        response = self.app.post('/tokens', headers={'X-Auth': self.x_auth})
+        assert response.status_code == 201
+
+
+class TestStreaming(object):
+
+    def setUp(self):
+        """Create tables before test cases"""
+        from application.models import User
+        api.app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
+        api.app.config['TESTING'] = True
+        api.app.config['STREAM_BATCH_SIZE'] = 2
+        self.app = api.app.test_client()
+        db.create_all()
+        for i in range(5):
+            db.session.add(User(username="streamer{0}".format(i), password="password"))
+        db.session.commit()
+
+    def tearDown(self):
+        """Clear db after a test"""
+        api.app.config['STREAM_BATCH_SIZE'] = 500
+        db.session.remove()
+        db.drop_all()
+
+    def testStreamUsers(self):
+        response = self.app.get('/users?stream=true')
+        assert response.status_code == 200
+        streamed = json.loads(response.data)
+        assert [u['username'] for u in streamed] == ["streamer{0}".format(i) for i in range(5)]
+        paged = json.loads(self.app.get('/users').data)
+        assert streamed == paged
+        response = self.app.get('/users?limit=2')
+        after = response.headers['Link'].split('after=')[1].split('&')[0].split('>')[0]
+        streamed = json.loads(self.app.get('/users?stream=1&after=' + after).data)
+        assert [u['username'] for u in streamed] == ["streamer2", "streamer3", "streamer4"]
+        assert json.loads(self.app.get('/r/all?stream=true').data) == []